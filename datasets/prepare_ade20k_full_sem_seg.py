@@ -5,8 +5,12 @@ All Bytedance's Modifications are Copyright (year) Bytedance Ltd. and/or its aff
 Reference: https://github.com/NVlabs/ODISE/blob/main/datasets/prepare_ade20k_full_sem_seg.py
 """
 
+import argparse
+import json
 import os
 import pickle as pkl
+from functools import partial
+from multiprocessing import Pool
 from pathlib import Path
 
 import cv2
@@ -945,16 +949,83 @@ def loadAde20K(file):
     return {"img_name": file, "segm_name": fileseg, "class_mask": ObjectClassMasks}
 
 
+def build_lut():
+    # ObjectClassMasks are at most (255 / 10) * 256 + 255, so a dense table covers every id
+    lut = np.full(26 * 256, 65535, dtype=np.uint16)
+    for cat in ADE20K_SEM_SEG_FULL_CATEGORIES:
+        lut[cat["id"]] = cat["trainId"]
+    return lut
+
+
+def output_paths(file_name, dataset_dir):
+    split = "validation" if file_name.split("_")[1] == "val" else "training"
+    output_img = dataset_dir / "ade/ADE20K_2021_17_01" / "images_detectron2" / split / file_name
+    output_lab = (
+        dataset_dir
+        / "ade/ADE20K_2021_17_01"
+        / "annotations_detectron2"
+        / split
+        / file_name.replace(".jpg", ".tif")
+    )
+    return output_img, output_lab
+
+
+def process_image(item, dataset_dir, lut):
+    folder_name, file_name = item
+    info = loadAde20K(str(dataset_dir / "ade" / folder_name / file_name))
+
+    # resize image and label
+    img = np.asarray(Image.open(info["img_name"]))
+    lab = np.asarray(info["class_mask"])
+
+    h, w = img.shape[0], img.shape[1]
+    max_size = 512
+    resize = True
+    if w >= h > max_size:
+        h_new, w_new = max_size, round(w / float(h) * max_size)
+    elif h >= w > max_size:
+        h_new, w_new = round(h / float(w) * max_size), max_size
+    else:
+        resize = False
+
+    if resize:
+        img = cv2.resize(img, (w_new, h_new), interpolation=cv2.INTER_LINEAR)
+        lab = cv2.resize(lab, (w_new, h_new), interpolation=cv2.INTER_NEAREST)
+
+    assert img.dtype == np.uint8
+    assert lab.dtype == np.int32
+
+    # apply label conversion and save into uint16 images, ids outside the 847 classes become 65535
+    output = lut[lab]
+
+    output_img, output_lab = output_paths(file_name, dataset_dir)
+    Image.fromarray(img).save(output_img)
+
+    assert output.dtype == np.uint16
+    Image.fromarray(output).save(output_lab)
+    return file_name
+
+
+def load_manifest(manifest_file):
+    """
+    Returns the images whose outputs were completely written by a previous run.
+    """
+    if not manifest_file.exists():
+        return set()
+    with open(manifest_file) as f:
+        return {json.loads(line)["file_name"] for line in f if line.strip()}
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert ADE20K-full to the detectron2 format")
+    parser.add_argument("--nproc", default=16, type=int, help="number of processes")
+    args = parser.parse_args()
+
     dataset_dir = Path(os.getenv("DETECTRON2_DATASETS", "datasets"))
     index_file = dataset_dir / "ade/ADE20K_2021_17_01" / "index_ade20k.pkl"
     with open(index_file, "rb") as f:
         index_ade20k = pkl.load(f)
 
-    id_map = {}
-    for cat in ADE20K_SEM_SEG_FULL_CATEGORIES:
-        id_map[cat["id"]] = cat["trainId"]
-
     # make output dir
     for name in ["training", "validation"]:
         image_dir = dataset_dir / "ade/ADE20K_2021_17_01" / "images_detectron2" / name
@@ -962,50 +1033,19 @@ if __name__ == "__main__":
         annotation_dir = dataset_dir / "ade/ADE20K_2021_17_01" / "annotations_detectron2" / name
         annotation_dir.mkdir(parents=True, exist_ok=True)
 
-    # process image and gt
-    for folder_name, file_name in tqdm.tqdm(
-        zip(index_ade20k["folder"], index_ade20k["filename"]),
-        total=len(index_ade20k["filename"]),
-    ):
-        split = "validation" if file_name.split("_")[1] == "val" else "training"
-        info = loadAde20K(str(dataset_dir / "ade" / folder_name / file_name))
-
-        # resize image and label
-        img = np.asarray(Image.open(info["img_name"]))
-        lab = np.asarray(info["class_mask"])
+    # an image is recorded only once both of its outputs are saved, so an interrupted run resumes
+    manifest_file = dataset_dir / "ade/ADE20K_2021_17_01" / "detectron2_manifest.jsonl"
+    done = load_manifest(manifest_file)
+    items = [
+        (folder_name, file_name)
+        for folder_name, file_name in zip(index_ade20k["folder"], index_ade20k["filename"])
+        if file_name not in done
+    ]
+    print("{} images to process, {} already done".format(len(items), len(index_ade20k["filename"]) - len(items)))
 
-        h, w = img.shape[0], img.shape[1]
-        max_size = 512
-        resize = True
-        if w >= h > max_size:
-            h_new, w_new = max_size, round(w / float(h) * max_size)
-        elif h >= w > max_size:
-            h_new, w_new = round(h / float(w) * max_size), max_size
-        else:
-            resize = False
-
-        if resize:
-            img = cv2.resize(img, (w_new, h_new), interpolation=cv2.INTER_LINEAR)
-            lab = cv2.resize(lab, (w_new, h_new), interpolation=cv2.INTER_NEAREST)
-
-        assert img.dtype == np.uint8
-        assert lab.dtype == np.int32
-
-        # apply label conversion and save into uint16 images
-        output = np.zeros_like(lab, dtype=np.uint16) + 65535
-        for obj_id in np.unique(lab):
-            if obj_id in id_map:
-                output[lab == obj_id] = id_map[obj_id]
-
-        output_img = dataset_dir / "ade/ADE20K_2021_17_01" / "images_detectron2" / split / file_name
-        output_lab = (
-            dataset_dir
-            / "ade/ADE20K_2021_17_01"
-            / "annotations_detectron2"
-            / split
-            / file_name.replace(".jpg", ".tif")
-        )
-        Image.fromarray(img).save(output_img)
-
-        assert output.dtype == np.uint16
-        Image.fromarray(output).save(output_lab)
\ No newline at end of file
+    # process image and gt
+    fn = partial(process_image, dataset_dir=dataset_dir, lut=build_lut())
+    with Pool(args.nproc) as pool, open(manifest_file, "a") as manifest:
+        for file_name in tqdm.tqdm(pool.imap_unordered(fn, items, chunksize=16), total=len(items), unit="img"):
+            manifest.write(json.dumps({"file_name": file_name}) + "\n")
+            manifest.flush()
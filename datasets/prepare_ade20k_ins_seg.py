@@ -7,10 +7,13 @@ All Bytedance's Modifications are Copyright (year) Bytedance Ltd. and/or its aff
 Reference: https://github.com/facebookresearch/Mask2Former/blob/main/datasets/prepare_ade20k_ins_seg.py
 """
 
+import argparse
 import glob
 import json
 import os
 from collections import Counter
+from functools import partial
+from multiprocessing import Pool
 
 import numpy as np
 import tqdm
@@ -18,8 +21,57 @@ from panopticapi.utils import IdGenerator, save_json
 from PIL import Image
 import pycocotools.mask as mask_util
 
+from segment_stats import instance_categories, segment_areas_and_bboxes
+
+
+def process_image(filename, instance_dir, map_id):
+    image = {}
+    image_id = os.path.basename(filename).split(".")[0]
+
+    image["id"] = image_id
+    image["file_name"] = os.path.basename(filename)
+
+    with Image.open(filename) as img:
+        # only the size is needed, the header is enough
+        image["width"], image["height"] = img.size
+
+    filename_instance = os.path.join(instance_dir, image_id + ".png")
+    ins_seg = np.asarray(Image.open(filename_instance))
+    assert ins_seg.dtype == np.uint8
+
+    instance_cat_ids = ins_seg[..., 0]
+    # instance id starts from 1!
+    # because 0 is reserved as VOID label
+    instance_ins_ids = ins_seg[..., 1]
+
+    # process things, the ids are assigned by the caller
+    annotations = []
+    thing_cat_ids = instance_categories(instance_ins_ids, instance_cat_ids)
+    for thing_id, (area, bbox) in segment_areas_and_bboxes(instance_ins_ids).items():
+        if thing_id == 0:
+            continue
+        mask = instance_ins_ids == thing_id
+
+        anno = {}
+        anno['image_id'] = image['id']
+        anno["iscrowd"] = int(0)
+        anno["category_id"] = int(map_id[thing_cat_ids[thing_id]])
+        anno["bbox"] = bbox
+        # if xmax <= xmin or ymax <= ymin:
+        #     continue
+        rle = mask_util.encode(np.array(mask[:, :, None], order="F", dtype="uint8"))[0]
+        rle["counts"] = rle["counts"].decode("utf-8")
+        anno["segmentation"] = rle
+        anno["area"] = area
+        annotations.append(anno)
+    return image, annotations
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert ADE20k to the COCO instance format")
+    parser.add_argument("--nproc", default=16, type=int, help="number of processes")
+    args = parser.parse_args()
+
     dataset_dir = os.getenv("DETECTRON2_DATASETS", "datasets")
 
     for name, dirname in [("train", "training"), ("val", "validation")]:
@@ -61,54 +113,17 @@ if __name__ == "__main__":
         images = []
         annotations = []
 
-        for idx, filename in enumerate(tqdm.tqdm(filenames)):
-            image = {}
-            image_id = os.path.basename(filename).split(".")[0]
-
-            image["id"] = image_id
-            image["file_name"] = os.path.basename(filename)
-
-            original_format = np.array(Image.open(filename))
-            image["width"] = original_format.shape[1]
-            image["height"] = original_format.shape[0]
-
-            images.append(image)
-
-            filename_instance = os.path.join(instance_dir, image_id + ".png")
-            ins_seg = np.asarray(Image.open(filename_instance))
-            assert ins_seg.dtype == np.uint8
-
-            instance_cat_ids = ins_seg[..., 0]
-            # instance id starts from 1!
-            # because 0 is reserved as VOID label
-            instance_ins_ids = ins_seg[..., 1]
-
-            # process things
-            for thing_id in np.unique(instance_ins_ids):
-                if thing_id == 0:
-                    continue
-                mask = instance_ins_ids == thing_id
-                instance_cat_id = np.unique(instance_cat_ids[mask])
-                assert len(instance_cat_id) == 1
-
-                anno = {}
-                anno['id'] = ann_id
-                ann_id += 1
-                anno['image_id'] = image['id']
-                anno["iscrowd"] = int(0)
-                anno["category_id"] = int(map_id[instance_cat_id[0]])
-
-                inds = np.nonzero(mask)
-                ymin, ymax = inds[0].min(), inds[0].max()
-                xmin, xmax = inds[1].min(), inds[1].max()
-                anno["bbox"] = [int(xmin), int(ymin), int(xmax - xmin + 1), int(ymax - ymin + 1)]
-                # if xmax <= xmin or ymax <= ymin:
-                #     continue
-                rle = mask_util.encode(np.array(mask[:, :, None], order="F", dtype="uint8"))[0]
-                rle["counts"] = rle["counts"].decode("utf-8")
-                anno["segmentation"] = rle
-                anno["area"] = int(mask_util.area(rle))
-                annotations.append(anno)
+        fn = partial(process_image, instance_dir=instance_dir, map_id=map_id)
+        with Pool(args.nproc) as pool:
+            # imap keeps the sorted file order, so annotation ids are assigned as before
+            for image, image_annotations in tqdm.tqdm(
+                pool.imap(fn, filenames, chunksize=8), total=len(filenames)
+            ):
+                images.append(image)
+                for anno in image_annotations:
+                    anno['id'] = ann_id
+                    ann_id += 1
+                    annotations.append(anno)
 
         # save this
         ann_dict['images'] = images
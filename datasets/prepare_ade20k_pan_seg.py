@@ -7,16 +7,21 @@ All Bytedance's Modifications are Copyright (year) Bytedance Ltd. and/or its aff
 Reference: https://github.com/facebookresearch/Mask2Former/blob/main/datasets/prepare_ade20k_pan_seg.py
 """
 
+import argparse
 import glob
 import json
 import os
 from collections import Counter
+from functools import partial
+from multiprocessing import Pool
 
 import numpy as np
 import tqdm
 from panopticapi.utils import IdGenerator, save_json
 from PIL import Image
 
+from segment_stats import instance_categories, segment_areas_and_bboxes
+
 ADE20K_SEM_SEG_CATEGORIES = [
     "wall",
     "building",
@@ -324,7 +329,100 @@ PALETTE = [
 ]
 
 
+def process_image(filename, semantic_dir, instance_dir, out_folder, categories_dict, map_id):
+    panoptic_json_image = {}
+
+    image_id = os.path.basename(filename).split(".")[0]
+
+    panoptic_json_image["id"] = image_id
+    panoptic_json_image["file_name"] = os.path.basename(filename)
+
+    with Image.open(filename) as img:
+        # only the size is needed, the header is enough
+        panoptic_json_image["width"], panoptic_json_image["height"] = img.size
+
+    id_generator = IdGenerator(categories_dict)
+
+    filename_semantic = os.path.join(semantic_dir, image_id + ".png")
+    filename_instance = os.path.join(instance_dir, image_id + ".png")
+
+    sem_seg = np.asarray(Image.open(filename_semantic))
+    ins_seg = np.asarray(Image.open(filename_instance))
+
+    assert sem_seg.dtype == np.uint8
+    assert ins_seg.dtype == np.uint8
+
+    semantic_cat_ids = sem_seg - 1
+    instance_cat_ids = ins_seg[..., 0] - 1
+    # instance id starts from 1!
+    # because 0 is reserved as VOID label
+    instance_ins_ids = ins_seg[..., 1]
+
+    segm_info = []
+
+    # NOTE: there is some overlap between semantic and instance annotation
+    # thus we paste stuffs first
+
+    # process stuffs, every label is painted at once through a color lookup table
+    stuff_colors = np.zeros((256, 3), dtype=np.uint8)
+    for semantic_cat_id, (area, bbox) in segment_areas_and_bboxes(semantic_cat_ids).items():
+        if semantic_cat_id == 255:
+            continue
+        if categories_dict[semantic_cat_id]["isthing"]:
+            continue
+
+        segment_id, color = id_generator.get_id_and_color(semantic_cat_id)
+        stuff_colors[semantic_cat_id] = color
+
+        segm_info.append(
+            {
+                "id": int(segment_id),
+                "category_id": int(semantic_cat_id),
+                "area": area,
+                "bbox": bbox,
+                "iscrowd": 0,
+            }
+        )
+    pan_seg = stuff_colors[semantic_cat_ids]
+
+    # process things
+    thing_colors = np.zeros((256, 3), dtype=np.uint8)
+    thing_cat_ids = instance_categories(instance_ins_ids, instance_cat_ids)
+    for thing_id, (area, bbox) in segment_areas_and_bboxes(instance_ins_ids).items():
+        if thing_id == 0:
+            continue
+        semantic_cat_id = map_id[thing_cat_ids[thing_id]]
+
+        segment_id, color = id_generator.get_id_and_color(semantic_cat_id)
+        thing_colors[thing_id] = color
+
+        segm_info.append(
+            {
+                "id": int(segment_id),
+                "category_id": int(semantic_cat_id),
+                "area": area,
+                "bbox": bbox,
+                "iscrowd": 0,
+            }
+        )
+    things = instance_ins_ids != 0
+    pan_seg[things] = thing_colors[instance_ins_ids[things]]
+
+    panoptic_json_annotation = {
+        "image_id": image_id,
+        "file_name": image_id + ".png",
+        "segments_info": segm_info,
+    }
+
+    Image.fromarray(pan_seg).save(os.path.join(out_folder, image_id + ".png"))
+    return panoptic_json_image, panoptic_json_annotation
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert ADE20k to the panoptic format")
+    parser.add_argument("--nproc", default=16, type=int, help="number of processes")
+    args = parser.parse_args()
+
     dataset_dir = os.getenv("DETECTRON2_DATASETS", "datasets")
 
     for name, dirname in [("train", "training"), ("val", "validation")]:
@@ -377,124 +475,21 @@ if __name__ == "__main__":
         panoptic_json_annotations = []
 
         filenames = sorted(glob.glob(os.path.join(image_dir, "*.jpg")))
-        for idx, filename in enumerate(tqdm.tqdm(filenames)):
-            panoptic_json_image = {}
-            panoptic_json_annotation = {}
-
-            image_id = os.path.basename(filename).split(".")[0]
-
-            panoptic_json_image["id"] = image_id
-            panoptic_json_image["file_name"] = os.path.basename(filename)
-
-            original_format = np.array(Image.open(filename))
-            panoptic_json_image["width"] = original_format.shape[1]
-            panoptic_json_image["height"] = original_format.shape[0]
-
-            pan_seg = np.zeros(
-                (original_format.shape[0], original_format.shape[1], 3), dtype=np.uint8
-            )
-            id_generator = IdGenerator(categories_dict)
-
-            filename_semantic = os.path.join(semantic_dir, image_id + ".png")
-            filename_instance = os.path.join(instance_dir, image_id + ".png")
-
-            sem_seg = np.asarray(Image.open(filename_semantic))
-            ins_seg = np.asarray(Image.open(filename_instance))
-
-            assert sem_seg.dtype == np.uint8
-            assert ins_seg.dtype == np.uint8
-
-            semantic_cat_ids = sem_seg - 1
-            instance_cat_ids = ins_seg[..., 0] - 1
-            # instance id starts from 1!
-            # because 0 is reserved as VOID label
-            instance_ins_ids = ins_seg[..., 1]
-
-            segm_info = []
-
-            # NOTE: there is some overlap between semantic and instance annotation
-            # thus we paste stuffs first
-
-            # process stuffs
-            for semantic_cat_id in np.unique(semantic_cat_ids):
-                if semantic_cat_id == 255:
-                    continue
-                if categories_dict[semantic_cat_id]["isthing"]:
-                    continue
-                mask = semantic_cat_ids == semantic_cat_id
-                # should not have any overlap
-                assert pan_seg[mask].sum() == 0
-
-                segment_id, color = id_generator.get_id_and_color(semantic_cat_id)
-                pan_seg[mask] = color
-
-                area = np.sum(mask)  # segment area computation
-                # bbox computation for a segment
-                hor = np.sum(mask, axis=0)
-                hor_idx = np.nonzero(hor)[0]
-                x = hor_idx[0]
-                width = hor_idx[-1] - x + 1
-                vert = np.sum(mask, axis=1)
-                vert_idx = np.nonzero(vert)[0]
-                y = vert_idx[0]
-                height = vert_idx[-1] - y + 1
-                bbox = [int(x), int(y), int(width), int(height)]
-
-                segm_info.append(
-                    {
-                        "id": int(segment_id),
-                        "category_id": int(semantic_cat_id),
-                        "area": int(area),
-                        "bbox": bbox,
-                        "iscrowd": 0,
-                    }
-                )
-
-            # process things
-            for thing_id in np.unique(instance_ins_ids):
-                if thing_id == 0:
-                    continue
-                mask = instance_ins_ids == thing_id
-                instance_cat_id = np.unique(instance_cat_ids[mask])
-                assert len(instance_cat_id) == 1
-
-                semantic_cat_id = map_id[instance_cat_id[0]]
-
-                segment_id, color = id_generator.get_id_and_color(semantic_cat_id)
-                pan_seg[mask] = color
-
-                area = np.sum(mask)  # segment area computation
-                # bbox computation for a segment
-                hor = np.sum(mask, axis=0)
-                hor_idx = np.nonzero(hor)[0]
-                x = hor_idx[0]
-                width = hor_idx[-1] - x + 1
-                vert = np.sum(mask, axis=1)
-                vert_idx = np.nonzero(vert)[0]
-                y = vert_idx[0]
-                height = vert_idx[-1] - y + 1
-                bbox = [int(x), int(y), int(width), int(height)]
-
-                segm_info.append(
-                    {
-                        "id": int(segment_id),
-                        "category_id": int(semantic_cat_id),
-                        "area": int(area),
-                        "bbox": bbox,
-                        "iscrowd": 0,
-                    }
-                )
-
-            panoptic_json_annotation = {
-                "image_id": image_id,
-                "file_name": image_id + ".png",
-                "segments_info": segm_info,
-            }
-
-            Image.fromarray(pan_seg).save(os.path.join(out_folder, image_id + ".png"))
-
-            panoptic_json_images.append(panoptic_json_image)
-            panoptic_json_annotations.append(panoptic_json_annotation)
+        fn = partial(
+            process_image,
+            semantic_dir=semantic_dir,
+            instance_dir=instance_dir,
+            out_folder=out_folder,
+            categories_dict=categories_dict,
+            map_id=map_id,
+        )
+        with Pool(args.nproc) as pool:
+            # imap keeps the sorted file order in the json
+            for panoptic_json_image, panoptic_json_annotation in tqdm.tqdm(
+                pool.imap(fn, filenames, chunksize=8), total=len(filenames)
+            ):
+                panoptic_json_images.append(panoptic_json_image)
+                panoptic_json_annotations.append(panoptic_json_annotation)
 
         # save this
         d = {
@@ -1,11 +1,12 @@
 import argparse
+import contextlib
 import os
 import os.path as osp
-import shutil
+import time
 from functools import partial
 from glob import glob
+from multiprocessing import Pool
 
-import mmcv
 import numpy as np
 from PIL import Image
 
@@ -187,21 +188,90 @@ full_clsID_to_trID = {
 }
 
 
+def build_lut(clsID_to_trID):
+    # COCO-stuff maps are uint8, so a 256-entry table converts a whole map in one indexing pass
+    lut = np.full(256, 255, dtype=np.uint8)
+    for clsID, trID in clsID_to_trID.items():
+        lut[clsID] = trID
+    return lut
+
+
+full_clsID_to_trID_lut = build_lut(full_clsID_to_trID)
+
+
+def output_path(maskpath, out_mask_dir, is_train, suffix=""):
+    return osp.join(out_mask_dir, ("train2017" if is_train else "val2017") + suffix, osp.basename(maskpath))
+
+
+def all_ignore_list_path(out_mask_dir, is_train):
+    # the maps without any labelled pixel are not written, they are listed in this file instead
+    return osp.join(out_mask_dir, ("train2017" if is_train else "val2017") + "_all_ignore.txt")
+
+
+def read_all_ignore_list(path):
+    """
+    Returns the basenames listed in `path` and its modification time, or an empty set and None.
+    """
+    if not osp.exists(path):
+        return set(), None
+    with open(path) as f:
+        return set(f.read().split()), osp.getmtime(path)
+
+
+def is_up_to_date(maskpath, seg_filename, all_ignore=(), all_ignore_mtime=None):
+    if osp.basename(maskpath) in all_ignore:
+        return all_ignore_mtime >= osp.getmtime(maskpath)
+    return osp.exists(seg_filename) and osp.getmtime(seg_filename) >= osp.getmtime(maskpath)
+
+
 def convert_to_trainID(
-    maskpath, out_mask_dir, is_train, clsID_to_trID=full_clsID_to_trID, suffix=""
+    maskpath, out_mask_dir, is_train, lut=full_clsID_to_trID_lut, suffix=""
 ):
     mask = np.array(Image.open(maskpath))
-    mask_copy = np.ones_like(mask, dtype=np.uint8) * 255
-    for clsID, trID in clsID_to_trID.items():
-        mask_copy[mask == clsID] = trID
-    seg_filename = (
-        osp.join(out_mask_dir, "train2017" + suffix, osp.basename(maskpath))
-        if is_train
-        else osp.join(out_mask_dir, "val2017" + suffix, osp.basename(maskpath))
-    )
-    if len(np.unique(mask_copy)) == 1 and np.unique(mask_copy)[0] == 255:
-        return
+    assert mask.dtype == np.uint8, "{} is not an 8-bit label map".format(maskpath)
+    mask_copy = lut[mask]
+    seg_filename = output_path(maskpath, out_mask_dir, is_train, suffix)
+    if (mask_copy == 255).all():
+        return maskpath
     Image.fromarray(mask_copy).save(seg_filename, "PNG")
+    return None
+
+
+def convert_all(mask_list, out_mask_dir, is_train, nproc):
+    """
+    Converts the label maps of `mask_list` which are not up to date yet, reporting the throughput.
+    """
+    list_path = all_ignore_list_path(out_mask_dir, is_train)
+    all_ignore, all_ignore_mtime = read_all_ignore_list(list_path)
+    todo = [
+        m
+        for m in mask_list
+        if not is_up_to_date(m, output_path(m, out_mask_dir, is_train), all_ignore, all_ignore_mtime)
+    ]
+    print(
+        "{}: {} maps to convert, {} up to date".format(
+            "train2017" if is_train else "val2017", len(todo), len(mask_list) - len(todo)
+        )
+    )
+    fn = partial(convert_to_trainID, out_mask_dir=out_mask_dir, is_train=is_train)
+    # the maps converted now are listed again only if they are still all ignore
+    all_ignore -= {osp.basename(m) for m in todo}
+    start = time.perf_counter()
+    with Pool(nproc) if nproc > 1 else contextlib.nullcontext() as pool:
+        if pool is not None:
+            # large chunks keep the inter-process overhead small next to a ~1ms conversion
+            results = pool.imap_unordered(fn, todo, chunksize=max(1, min(256, len(todo) // (nproc * 8))))
+        else:
+            results = map(fn, todo)
+        for i, skipped in enumerate(results, 1):
+            if skipped is not None:
+                all_ignore.add(osp.basename(skipped))
+            if i % 5000 == 0 or i == len(todo):
+                elapsed = time.perf_counter() - start
+                print("{}/{} done, {:.1f} images/s".format(i, len(todo), i / elapsed))
+    with open(list_path + ".tmp", "w") as f:
+        f.write("".join(name + "\n" for name in sorted(all_ignore)))
+    os.replace(list_path + ".tmp", list_path)
 
 
 def parse_args():
@@ -218,7 +288,6 @@ def main():
     args = parse_args()
     coco_path = args.coco_path
     nproc = args.nproc
-    print(full_clsID_to_trID)
     out_mask_dir = osp.join(coco_path, "stuffthingmaps_detectron2")
     for dir_name in [
         "train2017",
@@ -233,26 +302,8 @@ def main():
         len(train_list), len(test_list)
     )
 
-    if args.nproc > 1:
-        mmcv.track_parallel_progress(
-            partial(convert_to_trainID, out_mask_dir=out_mask_dir, is_train=True),
-            train_list,
-            nproc=nproc,
-        )
-        mmcv.track_parallel_progress(
-            partial(convert_to_trainID, out_mask_dir=out_mask_dir, is_train=False),
-            test_list,
-            nproc=nproc,
-        )
-    else:
-        mmcv.track_progress(
-            partial(convert_to_trainID, out_mask_dir=out_mask_dir, is_train=True),
-            train_list,
-        )
-        mmcv.track_progress(
-            partial(convert_to_trainID, out_mask_dir=out_mask_dir, is_train=False),
-            test_list,
-        )
+    convert_all(train_list, out_mask_dir, True, nproc)
+    convert_all(test_list, out_mask_dir, False, nproc)
     print("Done!")
 
 
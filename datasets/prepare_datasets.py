@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs any subset of the dataset preparation scripts with one shared worker pool.
+
+Every task records, per source file, the source size and mtime and the hash of the
+outputs it produced in `$DETECTRON2_DATASETS/.manifests/<task>.json`. A re-run skips
+the sources that did not change and whose outputs are still there, so it only redoes
+what failed or what a new dataset version changed.
+
+Usage:
+    python datasets/prepare_datasets.py                      # all tasks
+    python datasets/prepare_datasets.py ade20k_sem coco_stuff --nproc 32
+"""
+
+import argparse
+import functools
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+import tqdm
+
+DATASET_DIR = Path(os.getenv("DETECTRON2_DATASETS", "datasets"))
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+
+def output_hash(path):
+    """
+    sha1 of an output file, or of the names and sizes of the files of an output directory.
+    """
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for e in sorted(os.scandir(path), key=lambda e: e.name):
+            h.update("{}:{}\n".format(e.name, e.stat().st_size).encode("utf-8"))
+        return h.hexdigest()
+    with open(path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_fingerprint(path):
+    """
+    Size and mtime of a source file, or of all the files of a source directory.
+    """
+    path = Path(path)
+    if path.is_dir():
+        stats = [e.stat() for e in os.scandir(path) if e.is_file()]
+        return {"size": sum(s.st_size for s in stats), "mtime": max((s.st_mtime for s in stats), default=0)}
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+class Manifest:
+    """
+    The record of one task: for every job, keyed by its first source path, the size and
+    mtime of all its sources and the hash of every output it wrote.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def is_up_to_date(self, sources):
+        entry = self.entries.get(str(sources[0]))
+        if entry is None:
+            return False
+        if entry["sources"] != [source_fingerprint(s) for s in sources]:
+            return False
+        return all(os.path.exists(o) for o in entry["outputs"])
+
+    def record(self, sources, fingerprints, outputs):
+        self.entries[str(sources[0])] = {
+            "source_paths": [str(s) for s in sources],
+            "sources": fingerprints,
+            "outputs": outputs,
+        }
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # never leave a truncated manifest behind, it would force a full re-run
+        with open(str(self.path) + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(str(self.path) + ".tmp", self.path)
+
+
+class Job:
+    """
+    One unit of work: `fn(*args)` reads `sources` and writes (some of) `outputs`.
+    """
+
+    def __init__(self, fn, args, sources, outputs):
+        self.fn = fn
+        self.args = args
+        self.sources = [Path(s) for s in sources]
+        self.outputs = [Path(o) for o in outputs]
+
+
+def run_job(job):
+    # fingerprint the sources before running, a source changing meanwhile is then redone next time
+    fingerprints = [source_fingerprint(s) for s in job.sources]
+    job.fn(*job.args)
+    # some converters do not write anything, e.g. COCO-stuff maps that are all ignore
+    outputs = {str(o): output_hash(o) for o in job.outputs if o.exists()}
+    return job.sources, fingerprints, outputs
+
+
+def run_script(script, *args):
+    subprocess.run([sys.executable, str(SCRIPT_DIR / script), *args], check=True)
+
+
+# ---------------------------------------------------------------------------
+# tasks: each returns the jobs of one dataset, the script modules are only
+# imported when their task is selected, so unrelated dependencies are not needed
+# ---------------------------------------------------------------------------
+
+
+def ade20k_sem_jobs(nproc):
+    from prepare_ade20k_sem_seg import convert
+
+    dataset_dir = DATASET_DIR / "ADEChallengeData2016"
+    for name in ["training", "validation"]:
+        output_dir = dataset_dir / "annotations_detectron2" / name
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for file in sorted((dataset_dir / "annotations" / name).iterdir()):
+            yield Job(convert, (file, output_dir / file.name), [file], [output_dir / file.name])
+
+
+def ade20k_script_jobs(script, outputs, nproc):
+    dataset_dir = DATASET_DIR / "ADEChallengeData2016"
+    # the json aggregates every image, so the whole script is one job
+    sources = [SCRIPT_DIR / "ade20k_instance_imgCatIds.json", SCRIPT_DIR / "ade20k_instance_catid_mapping.txt"]
+    for dirname in ["training", "validation"]:
+        sources += [dataset_dir / "annotations" / dirname, dataset_dir / "annotations_instance" / dirname]
+    yield Job(run_script, (script, "--nproc", str(nproc)), sources, [dataset_dir / o for o in outputs])
+
+
+def ade20k_pan_jobs(nproc):
+    yield from ade20k_script_jobs(
+        "prepare_ade20k_pan_seg.py", ["ade20k_panoptic_train.json", "ade20k_panoptic_val.json"], nproc
+    )
+
+
+def ade20k_ins_jobs(nproc):
+    yield from ade20k_script_jobs(
+        "prepare_ade20k_ins_seg.py", ["ade20k_instance_train.json", "ade20k_instance_val.json"], nproc
+    )
+
+
+def ade20k_full_jobs(nproc):
+    import pickle as pkl
+
+    from prepare_ade20k_full_sem_seg import build_lut, output_paths, process_image
+
+    with open(DATASET_DIR / "ade/ADE20K_2021_17_01" / "index_ade20k.pkl", "rb") as f:
+        index_ade20k = pkl.load(f)
+    for name in ["training", "validation"]:
+        (DATASET_DIR / "ade/ADE20K_2021_17_01" / "images_detectron2" / name).mkdir(parents=True, exist_ok=True)
+        (DATASET_DIR / "ade/ADE20K_2021_17_01" / "annotations_detectron2" / name).mkdir(parents=True, exist_ok=True)
+    lut = build_lut()
+    for folder_name, file_name in zip(index_ade20k["folder"], index_ade20k["filename"]):
+        image = DATASET_DIR / "ade" / folder_name / file_name
+        yield Job(
+            process_image,
+            ((folder_name, file_name), DATASET_DIR, lut),
+            [image, Path(str(image).replace(".jpg", "_seg.png"))],
+            output_paths(file_name, DATASET_DIR),
+        )
+
+
+def coco_stuff_jobs(nproc):
+    from prepare_coco_stuff_sem_seg import convert_to_trainID, output_path
+
+    out_mask_dir = str(DATASET_DIR / "coco" / "stuffthingmaps_detectron2")
+    for is_train, split in [(True, "train2017"), (False, "val2017")]:
+        os.makedirs(os.path.join(out_mask_dir, split), exist_ok=True)
+        for mask in sorted(glob.glob(str(DATASET_DIR / "coco" / "stuffthingmaps" / split / "*.png"))):
+            yield Job(
+                convert_to_trainID, (mask, out_mask_dir, is_train), [mask], [output_path(mask, out_mask_dir, is_train)]
+            )
+
+
+def coco_panoptic_semseg_jobs(nproc):
+    from prepare_coco_semantic_annos_from_panoptic_annos import COCO_CATEGORIES, _process_panoptic_to_semantic
+
+    id_map = {k["id"]: i for i, k in enumerate(COCO_CATEGORIES)}
+    for split in ["val2017", "train2017"]:
+        panoptic_json = DATASET_DIR / "coco" / "annotations" / f"panoptic_{split}.json"
+        sem_seg_root = DATASET_DIR / "coco" / f"panoptic_semseg_{split}"
+        sem_seg_root.mkdir(parents=True, exist_ok=True)
+        with open(panoptic_json) as f:
+            annotations = json.load(f)["annotations"]
+        for anno in annotations:
+            input = DATASET_DIR / "coco" / f"panoptic_{split}" / anno["file_name"]
+            output = sem_seg_root / anno["file_name"]
+            yield Job(
+                _process_panoptic_to_semantic, (str(input), str(output), anno["segments_info"], id_map), [input], [output]
+            )
+
+
+def copy_image(img_path, output_img_dir):
+    shutil.copy2(img_path, output_img_dir)
+
+
+def convert_pascal_voc(ann_path, output_21, output_20):
+    from prepare_pascal_voc_sem_seg import convert_pas20, convert_pas21
+
+    convert_pas21(ann_path, output_21)
+    convert_pas20(ann_path, output_20)
+
+
+def pascal_voc_jobs(nproc):
+    dataset_dir = DATASET_DIR / "pascal_voc_d2"
+    voc_dir = DATASET_DIR / "VOCdevkit/VOC2012"
+    for split, image_set in [("training", "train"), ("validation", "val")]:
+        output_img_dir = dataset_dir / "images" / split
+        output_ann_dir_21 = dataset_dir / "annotations_pascal21" / split
+        output_ann_dir_20 = dataset_dir / "annotations_pascal20" / split
+        for d in [output_img_dir, output_ann_dir_21, output_ann_dir_20]:
+            d.mkdir(parents=True, exist_ok=True)
+        with open(voc_dir / f"ImageSets/Segmentation/{image_set}.txt") as f:
+            img_names = [line.strip() for line in f]
+        for img_name in img_names:
+            img_path = voc_dir / "JPEGImages" / f"{img_name}.jpg"
+            ann_path = voc_dir / "SegmentationClass" / f"{img_name}.png"
+            yield Job(copy_image, (img_path, output_img_dir), [img_path], [output_img_dir / img_path.name])
+            outputs = [output_ann_dir_21 / f"{img_name}.png", output_ann_dir_20 / f"{img_name}.png"]
+            yield Job(convert_pascal_voc, (ann_path, *outputs), [ann_path], outputs)
+
+
+def pascal_ctx_jobs(nproc):
+    # the Detail API object cannot be shared with a pool, the script runs its own
+    voc_dir = DATASET_DIR / "VOCdevkit/VOC2010"
+    outputs = [DATASET_DIR / "pascal_ctx_d2" / "annotations_ctx59" / split for split in ["training", "validation"]]
+    yield Job(run_script, ("prepare_pascal_ctx_sem_seg.py",), [voc_dir / "trainval_merged.json"], outputs)
+
+
+def pascal_ctx_full_jobs(nproc):
+    from prepare_pascal_ctx_full_sem_seg import generate_labels
+
+    dataset_dir = DATASET_DIR / "pascal_ctx_d2"
+    mat_dir = DATASET_DIR / "VOCdevkit/VOC2010" / "trainval"
+    for split in ["training", "validation"]:
+        output_ann_dir = dataset_dir / "annotations_ctx459" / split
+        output_ann_dir.mkdir(parents=True, exist_ok=True)
+        # the images are written by the pascal_ctx task
+        for file_name in sorted((dataset_dir / "images" / split).glob("*.jpg")):
+            mat_file = mat_dir / f"{file_name.stem}.mat"
+            yield Job(generate_labels, (mat_file, output_ann_dir), [mat_file], [output_ann_dir / f"{file_name.stem}.tif"])
+
+
+# in dependency order: pascal_ctx_full reads the images written by pascal_ctx
+TASKS = {
+    "coco_panoptic_semseg": coco_panoptic_semseg_jobs,
+    "coco_stuff": coco_stuff_jobs,
+    "ade20k_sem": ade20k_sem_jobs,
+    "ade20k_pan": ade20k_pan_jobs,
+    "ade20k_ins": ade20k_ins_jobs,
+    "ade20k_full": ade20k_full_jobs,
+    "pascal_voc": pascal_voc_jobs,
+    "pascal_ctx": pascal_ctx_jobs,
+    "pascal_ctx_full": pascal_ctx_full_jobs,
+}
+
+
+def run_task(name, pool, nproc):
+    manifest = Manifest(DATASET_DIR / ".manifests" / f"{name}.json")
+    jobs = list(TASKS[name](nproc))
+    todo = [job for job in jobs if not manifest.is_up_to_date(job.sources)]
+    print("{}: {} jobs to run, {} up to date".format(name, len(todo), len(jobs) - len(todo)))
+    if not todo:
+        return
+
+    # whole-script jobs start their own pool
+    runner = map if all(job.fn is run_script for job in todo) else pool.imap_unordered
+    start = time.perf_counter()
+    try:
+        for i, (sources, fingerprints, outputs) in enumerate(
+            tqdm.tqdm(runner(run_job, todo), total=len(todo), desc=name), 1
+        ):
+            manifest.record(sources, fingerprints, outputs)
+            if i % 1000 == 0:
+                manifest.save()
+    finally:
+        # whatever finished before a failure is kept
+        manifest.save()
+    elapsed = time.perf_counter() - start
+    print("{}: done in {:.1f}s ({:.1f} jobs/s)".format(name, elapsed, len(todo) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the Mask-Adapter datasets incrementally")
+    parser.add_argument("tasks", nargs="*", help="tasks to run, all by default: " + ", ".join(TASKS))
+    parser.add_argument("--nproc", default=16, type=int, help="number of worker processes")
+    args = parser.parse_args()
+    unknown = set(args.tasks) - set(TASKS)
+    if unknown:
+        parser.error("unknown tasks: {}".format(", ".join(sorted(unknown))))
+
+    sys.path.insert(0, str(SCRIPT_DIR))
+    tasks = [name for name in TASKS if not args.tasks or name in args.tasks]
+    with Pool(args.nproc) as pool:
+        for name in tasks:
+            run_task(name, pool, args.nproc)
+
+
+if __name__ == "__main__":
+    main()
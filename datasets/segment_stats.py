@@ -0,0 +1,51 @@
+"""
+Helpers shared by the ADE20k panoptic and instance preparation scripts.
+"""
+
+import numpy as np
+
+
+def segment_areas_and_bboxes(label_map, num_labels=256):
+    """
+    Computes the area and the bounding box of every label of `label_map` in one pass,
+    instead of building a full-size boolean mask per segment.
+
+    Args:
+        label_map (np.ndarray): HxW integer array with values in [0, num_labels).
+        num_labels (int): number of possible labels.
+
+    Returns:
+        dict[int, tuple[int, list[int]]]: for every label present in `label_map`,
+            its area and its COCO-style [x, y, width, height] bbox.
+    """
+    h, w = label_map.shape
+    labels = label_map.astype(np.int64)
+    areas = np.bincount(labels.ravel(), minlength=num_labels)
+    # which rows / columns contain each label, from which the extents are the first and last hit
+    rows = np.bincount((labels * h + np.arange(h)[:, None]).ravel(), minlength=num_labels * h)
+    cols = np.bincount((labels * w + np.arange(w)[None, :]).ravel(), minlength=num_labels * w)
+    rows = rows.reshape(num_labels, h) > 0
+    cols = cols.reshape(num_labels, w) > 0
+
+    present = np.nonzero(areas)[0]
+    y_min = rows[present].argmax(axis=1)
+    y_max = h - 1 - rows[present, ::-1].argmax(axis=1)
+    x_min = cols[present].argmax(axis=1)
+    x_max = w - 1 - cols[present, ::-1].argmax(axis=1)
+
+    stats = {}
+    for label, area, x0, y0, x1, y1 in zip(present, areas[present], x_min, y_min, x_max, y_max):
+        stats[int(label)] = (int(area), [int(x0), int(y0), int(x1 - x0 + 1), int(y1 - y0 + 1)])
+    return stats
+
+
+def instance_categories(instance_ids, category_ids, num_labels=256):
+    """
+    Returns the category of every instance id of `instance_ids` but the VOID id 0,
+    checking that all the pixels of an instance share the same category.
+    """
+    valid = instance_ids != 0
+    pairs = np.unique(instance_ids[valid].astype(np.int64) * num_labels + category_ids[valid])
+    ins, cat = pairs // num_labels, pairs % num_labels
+    assert len(np.unique(ins)) == len(ins), "an instance spans several categories"
+    return {int(i): int(c) for i, c in zip(ins, cat)}
@@ -31,6 +31,15 @@ from .data.dataset_mappers.mask_former_panoptic_dataset_mapper import (
 from .data.dataset_mappers.mask_former_semantic_dataset_mapper import (
     MaskFormerSemanticDatasetMapper,
 )
+from .data.teacher_store import (
+    TeacherStore,
+    TeacherStoreDatasetMapper,
+    TeacherStoreWriter,
+    get_teacher_store_dataset_dicts,
+)
+
+# checkpointing
+from .checkpoint import TrainableCheckpointer
 
 # models
 from .fcclip import FCCLIP
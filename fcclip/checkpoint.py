@@ -0,0 +1,174 @@
+# Copyright (c) 2024 ByteDance. All Rights Reserved.
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import struct
+import time
+
+import torch
+
+from detectron2.checkpoint import DetectionCheckpointer
+
+__all__ = ["TrainableCheckpointer", "trainable_state_dict", "load_safetensors"]
+
+# torch >= 2.1 can memory-map the tensors of a checkpoint instead of reading them into memory
+_TORCH_LOAD_MMAP = "mmap" in inspect.signature(torch.load).parameters
+
+# sha1 of the base weight files hashed by this process, keyed by (path, size, mtime)
+_FILE_SHA1 = {}
+
+
+def trainable_state_dict(model):
+    """
+    Returns the entries of `model.state_dict()` that training changes: the parameters that
+    require grad, and the buffers (e.g. norm statistics) of the modules holding some of them.
+    """
+    param_names = {name for name, _ in model.named_parameters()}
+    trainable = {name for name, p in model.named_parameters() if p.requires_grad}
+    trainable_modules = {name.rpartition(".")[0] for name in trainable}
+    return {
+        k: v
+        for k, v in model.state_dict().items()
+        if k in trainable or (k not in param_names and k.rpartition(".")[0] in trainable_modules)
+    }
+
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def load_safetensors(path):
+    """
+    Returns the tensors of a safetensors file (e.g. written by tools/weight_fuse.py) as views
+    of a private memory mapping of the file, so they are only read when they are used.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    tensors = {}
+    for key, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            tensors[key] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=torch.uint8, count=end - begin, offset=data_start + begin)
+        tensors[key] = tensor.view(dtype).reshape(info["shape"])
+    return tensors
+
+
+def _file_sha1(path):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _FILE_SHA1:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                sha1.update(chunk)
+        _FILE_SHA1[key] = sha1.hexdigest()
+    return _FILE_SHA1[key]
+
+
+class TrainableCheckpointer(DetectionCheckpointer):
+    """
+    A :class:`DetectionCheckpointer` that can save only the trainable weights of the model
+    (see :func:`trainable_state_dict`), with a reference to the checkpoint holding the frozen
+    ones (its path and sha1). Such a checkpoint is a small fraction of the full one, since
+    the CLIP backbone is frozen.
+
+    When loading, the referenced base checkpoint is loaded first and the saved weights
+    are applied over it. Native .pth files are memory-mapped when torch supports it, and
+    .safetensors files always are, so the tensors are only read when they are copied into the model.
+    """
+
+    def __init__(self, model, save_dir="", *, trainable_only=False, base_weights="", **checkpointables):
+        """
+        Args:
+            trainable_only (bool): save only the trainable weights.
+            base_weights (str): the checkpoint that holds the frozen weights, usually cfg.MODEL.WEIGHTS.
+                "" if they come from the model construction (e.g. the open_clip pretrained weights).
+        """
+        super().__init__(model, save_dir, **checkpointables)
+        self.trainable_only = trainable_only
+        self.base_weights = base_weights
+
+    def save(self, name, **kwargs):
+        if not self.trainable_only:
+            return super().save(name, **kwargs)
+        if not self.save_dir or not self.save_to_disk:
+            return
+
+        start_time = time.perf_counter()
+        data = {"model": trainable_state_dict(self.model)}
+        if self.base_weights:
+            base_path = self.path_manager.get_local_path(self.base_weights)
+            data["base_weights"] = {"path": base_path, "sha1": _file_sha1(base_path)}
+        for key, obj in self.checkpointables.items():
+            data[key] = obj.state_dict()
+        data.update(kwargs)
+
+        basename = "{}.pth".format(name)
+        save_file = os.path.join(self.save_dir, basename)
+        assert os.path.basename(save_file) == basename, basename
+        with self.path_manager.open(save_file, "wb") as f:
+            torch.save(data, f)
+        self.tag_last_checkpoint(basename)
+        self.logger.info(
+            "Saved {} trainable tensors to {} ({:.1f} MiB) in {:.2f} s".format(
+                len(data["model"]),
+                save_file,
+                os.path.getsize(save_file) / 1024 ** 2,
+                time.perf_counter() - start_time,
+            )
+        )
+
+    def _torch_load(self, f):
+        # DetectionCheckpointer._load_file reads native .pth files with this, and then marks
+        # them for heuristic matching as usual
+        if _TORCH_LOAD_MMAP:
+            return torch.load(f, map_location="cpu", mmap=True, weights_only=False)
+        return super()._torch_load(f)
+
+    def _load_file(self, filename):
+        start_time = time.perf_counter()
+        if filename.endswith(".safetensors"):
+            loaded = {"model": load_safetensors(filename)}
+        else:
+            loaded = super()._load_file(filename)
+
+        base = loaded.pop("base_weights", None)
+        if base is not None:
+            if _file_sha1(base["path"]) != base["sha1"]:
+                raise ValueError(
+                    "{} was saved on top of {}, which has changed since.".format(filename, base["path"])
+                )
+            base_loaded = self._load_file(base["path"])
+            # the saved weights use the model names, so the base weights must too for the frozen ones
+            frozen = set(self.model.state_dict()) - set(loaded["model"])
+            if frozen and frozen.isdisjoint(base_loaded["model"]):
+                raise ValueError(
+                    "The base weights {} do not match the model names.".format(base["path"])
+                )
+            model = base_loaded["model"]
+            model.update(loaded["model"])
+            loaded["model"] = model
+            # the checkpoints saved from here on refer to the same base weights
+            self.base_weights = base["path"]
+
+        self.logger.info("Loaded {} in {:.2f} s".format(filename, time.perf_counter() - start_time))
+        return loaded
@@ -135,6 +135,12 @@ def add_mask_adapter_config(cfg):
     cfg.MODEL.MASK_ADAPTER.MASK_IN_CHANNELS = 16
     cfg.MODEL.MASK_ADAPTER.NUM_CHANNELS = 768
     cfg.MODEL.MASK_ADAPTER.USE_CHECKPOINT = False
+    # blocks of MASKAdapterHead recomputed one by one in the backward pass, among "mask_downscaling",
+    # "fuse", "cnext1", "cnext2", "cnext3" and "final" (USE_CHECKPOINT recomputes all but the first as one)
+    cfg.MODEL.MASK_ADAPTER.CHECKPOINT_BLOCKS = []
+    # if > 0, budget in MiB of the activations MASKAdapterHead keeps for the backward pass: the blocks
+    # to recompute are then planned for the shapes of every batch, at the lowest recompute cost
+    cfg.MODEL.MASK_ADAPTER.CHECKPOINT_MEMORY_BUDGET = 0
     cfg.MODEL.MASK_ADAPTER.NUM_OUTPUT_MAPS = 16
     cfg.MODEL.MASK_ADAPTER.IOU_THRESHOLD = 0.7
     cfg.MODEL.MASK_ADAPTER.MASK_THRESHOLD  = 0.50
@@ -142,6 +148,15 @@ def add_mask_adapter_config(cfg):
     cfg.MODEL.MASK_ADAPTER.COS_WEIGHT = 5.0
     cfg.MODEL.MASK_ADAPTER.NUM_GT_MASKS = 16
     cfg.MODEL.MASK_ADAPTER.NUM_PRED_MASKS = 8
+    # longer side of the masks the matching IoUs are computed at, 0 for the prediction resolution
+    cfg.MODEL.MASK_ADAPTER.IOU_RESOLUTION = 0
+    # count the IoU intersections on bit-packed masks instead of a dense float product
+    cfg.MODEL.MASK_ADAPTER.IOU_BITPACKED = False
+    # directory of the frozen-teacher outputs written by tools/build_teacher_store.py; when set,
+    # training reads the CLIP features and Mask2Former candidates from it instead of running them
+    cfg.MODEL.MASK_ADAPTER.TEACHER_STORE = ""
+    # number of seeded augmentations of every image in the teacher store
+    cfg.MODEL.MASK_ADAPTER.TEACHER_STORE_VARIANTS = 4
     
     cfg.MODEL.MASK_ADAPTER.NAME = "MASKAdapterHead"
     
@@ -150,4 +165,13 @@ def add_mask_adapter_config(cfg):
     cfg.DATALOADER.DATASET_BS = [2, 2]
     cfg.DATALOADER.USE_RFS = [False, False]
     cfg.DATALOADER.MULTI_DATASET_GROUPING = True
-    cfg.DATALOADER.DATASET_ANN = ['box', 'box']
\ No newline at end of file
+    cfg.DATALOADER.DATASET_ANN = ['box', 'box']
+    # save only the trainable weights in the training checkpoints, with a reference to
+    # MODEL.WEIGHTS for the frozen ones (see TrainableCheckpointer)
+    cfg.SOLVER.CHECKPOINT_TRAINABLE_ONLY = False
+    # autocast dtype of the training forward when SOLVER.AMP.ENABLED: "float16" or "bfloat16"
+    # (bfloat16 has the float32 exponent range: the loss scaling of AMPTrainer is kept but not needed)
+    cfg.SOLVER.AMP.PRECISION = "float16"
+    # autocast dtype of the inference forward: "float32" (no autocast), "bfloat16" (also on CPU) or "float16";
+    # LayerNorm2d, the mask pooling, the CLIP classification and the post-processing stay in float32
+    cfg.TEST.PRECISION = "float32"
@@ -0,0 +1,181 @@
+# Copyright (c) 2024 ByteDance. All Rights Reserved.
+"""
+Store of the outputs of the frozen part of the model (CLIP backbone and Mask2Former head),
+generated once offline by tools/build_teacher_store.py, so that mixed-mask training only
+runs the Mask-Adapter.
+
+Every image gets `num_variants` augmentations, each drawn with a seed derived from the image
+and the variant index, so that the training data loader can reproduce the augmentation of a
+stored variant exactly. The store is a directory of compressed .npz shards plus one index
+file per writer, mapping the key of every variant to its shard.
+"""
+import contextlib
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+
+import numpy as np
+import torch
+
+from detectron2.data import get_detection_dataset_dicts
+
+__all__ = [
+    "get_teacher_store_dataset_dicts",
+    "sample_key",
+    "seeded",
+    "TeacherStoreWriter",
+    "TeacherStore",
+    "TeacherStoreDatasetMapper",
+]
+
+
+def get_teacher_store_dataset_dicts(dataset_names, filter_empty=True):
+    """
+    Same as :func:`detectron2.data.get_detection_dataset_dicts`, with the name of its
+    dataset under "dataset_name" in every dict, which :func:`sample_key` is made of.
+    """
+    if isinstance(dataset_names, str):
+        dataset_names = [dataset_names]
+    dataset_dicts = []
+    for name in dataset_names:
+        for d in get_detection_dataset_dicts(name, filter_empty=filter_empty):
+            d["dataset_name"] = name
+            dataset_dicts.append(d)
+    return dataset_dicts
+
+
+def sample_key(dataset_dict, variant):
+    """
+    Returns the key of augmentation `variant` of `dataset_dict` in the store: its dataset
+    name and image id (or file name), since several training datasets can share their images.
+    """
+    image = dataset_dict.get("image_id", dataset_dict["file_name"])
+    return "{}:{}#{}".format(dataset_dict["dataset_name"], image, variant)
+
+
+@contextlib.contextmanager
+def seeded(key):
+    """
+    Seeds the python, numpy and torch (CPU) random generators from `key` for the duration
+    of the block, and restores their states afterwards.
+    """
+    seed = int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16)
+    py_state = random.getstate()
+    np_state = np.random.get_state()
+    with torch.random.fork_rng(devices=[]):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.default_generator.manual_seed(seed)
+        try:
+            yield
+        finally:
+            random.setstate(py_state)
+            np.random.set_state(np_state)
+
+
+class TeacherStoreWriter:
+    """
+    Writes the teacher outputs of a process to compressed shards of `shard_size` samples.
+    Several processes can write to the same directory with different `prefix`es.
+    """
+
+    def __init__(self, root, prefix="rank0", shard_size=256):
+        self.root = root
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self._pending = {}
+        self._index = {}
+        self._num_shards = 0
+        os.makedirs(root, exist_ok=True)
+
+    def add(self, key, outputs):
+        """
+        Args:
+            key (str): see :func:`sample_key`.
+            outputs (dict[str, np.ndarray]): the teacher outputs of the sample.
+        """
+        self._pending[key] = outputs
+        if len(self._pending) >= self.shard_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        shard = "{}_{:05d}.npz".format(self.prefix, self._num_shards)
+        arrays = {}
+        for i, (key, outputs) in enumerate(self._pending.items()):
+            for name, value in outputs.items():
+                arrays["{}.{}".format(i, name)] = value
+            self._index[key] = [shard, i]
+        np.savez_compressed(os.path.join(self.root, shard), **arrays)
+        self._num_shards += 1
+        self._pending = {}
+
+    def close(self):
+        self._flush()
+        with open(os.path.join(self.root, "index_{}.json".format(self.prefix)), "w") as f:
+            json.dump(self._index, f)
+
+
+class TeacherStore:
+    """
+    Reads the samples written by :class:`TeacherStoreWriter`. A shard is only open while a
+    sample is read from it, so the data loader workers do not hold a handle to every shard.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._index = {}
+        for path in sorted(glob.glob(os.path.join(root, "index_*.json"))):
+            with open(path) as f:
+                self._index.update(json.load(f))
+        assert self._index, "No teacher store index found in {}".format(root)
+        logging.getLogger(__name__).info("Teacher store {}: {} samples".format(root, len(self._index)))
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def load(self, key):
+        """
+        Returns the teacher outputs of the sample `key` as a dict of tensors.
+        """
+        if key not in self._index:
+            raise KeyError("{} is not in the teacher store {}".format(key, self.root))
+        shard, i = self._index[key]
+        prefix = "{}.".format(i)
+        with np.load(os.path.join(self.root, shard)) as data:
+            return {
+                name[len(prefix):]: torch.as_tensor(data[name])
+                for name in data.files
+                if name.startswith(prefix)
+            }
+
+
+class TeacherStoreDatasetMapper:
+    """
+    Wraps a training dataset mapper so that every image is augmented with the seed of one
+    of its `num_variants` stored variants (or of dataset_dict["aug_variant"] if set), and
+    attaches the stored teacher outputs of that variant under "teacher" when a store is given.
+    """
+
+    def __init__(self, mapper, store=None, num_variants=1):
+        self.mapper = mapper
+        self.store = store
+        self.num_variants = num_variants
+
+    def __call__(self, dataset_dict):
+        variant = dataset_dict.get("aug_variant")
+        if variant is None:
+            variant = np.random.randint(self.num_variants)
+        key = sample_key(dataset_dict, variant)
+        with seeded(key):
+            dataset_dict = self.mapper(dataset_dict)
+        if dataset_dict is None:
+            return None
+        dataset_dict["teacher_key"] = key
+        if self.store is not None:
+            dataset_dict["teacher"] = self.store.load(key)
+        return dataset_dict
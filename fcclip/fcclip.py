@@ -4,6 +4,7 @@ All Bytedance's Modifications are Copyright (year) Bytedance Ltd. and/or its aff
 
 Reference: https://github.com/facebookresearch/Mask2Former/blob/main/mask2former/maskformer_model.py
 """
+import math
 from typing import Tuple
 import torch
 from torch import nn
@@ -19,7 +20,9 @@ from detectron2.utils.memory import retry_if_cuda_oom
 import torch.utils.checkpoint as cp
 from .modeling.meta_arch.mask_adapter_head import build_mask_adapter
 
-from .modeling.transformer_decoder.fcclip_transformer_decoder import MaskPooling, get_classification_logits
+from .modeling.transformer_decoder.fcclip_transformer_decoder import MaskPooling, get_classification_logits, pool_clip_feature
+from .utils.mask_packing import pack_bitmasks, packed_mask_counts, unpack_bitmasks
+from .utils.precision import autocast_forward, float32
 VILD_PROMPT = [
     "a photo of a {}.",
     "This is a photo of a {}",
@@ -76,6 +79,10 @@ class FCCLIP(nn.Module):
         mask_threshold: float,
         num_gt_masks: int,
         num_pred_masks: int,
+        iou_resolution: int = 0,
+        iou_bitpacked: bool = False,
+        train_precision: str = "float32",
+        test_precision: str = "float32",
     ):
         """
         Args:
@@ -142,6 +149,10 @@ class FCCLIP(nn.Module):
         self.mask_threshold = mask_threshold
         self.num_gt_masks = num_gt_masks
         self.num_pred_masks = num_pred_masks
+        self.iou_resolution = iou_resolution
+        self.iou_bitpacked = iou_bitpacked
+        self.train_precision = train_precision
+        self.test_precision = test_precision
         
         _, self.train_num_templates, self.train_class_names = self.prepare_class_names_from_metadata(train_metadata, train_metadata)
         self.category_overlapping_mask, self.test_num_templates, self.test_class_names = self.prepare_class_names_from_metadata(test_metadata, train_metadata)
@@ -274,12 +285,17 @@ class FCCLIP(nn.Module):
             "mask_threshold": cfg.MODEL.MASK_ADAPTER.MASK_THRESHOLD,
             "num_gt_masks": cfg.MODEL.MASK_ADAPTER.NUM_GT_MASKS,
             "num_pred_masks": cfg.MODEL.MASK_ADAPTER.NUM_PRED_MASKS,
+            "iou_resolution": cfg.MODEL.MASK_ADAPTER.IOU_RESOLUTION,
+            "iou_bitpacked": cfg.MODEL.MASK_ADAPTER.IOU_BITPACKED,
+            "train_precision": cfg.SOLVER.AMP.PRECISION if cfg.SOLVER.AMP.ENABLED else "float32",
+            "test_precision": cfg.TEST.PRECISION,
         }
 
     @property
     def device(self):
         return self.pixel_mean.device
 
+    @autocast_forward
     def forward(self, batched_inputs):
         """
         Args:
@@ -310,22 +326,25 @@ class FCCLIP(nn.Module):
         images = [(x - self.pixel_mean) / self.pixel_std for x in images]
         images = ImageList.from_tensors(images, self.size_divisibility)
         
-        features = self.backbone(images.tensor)
-        
-        clip_feature = features['clip_vis_dense']
-        
         text_classifier, num_templates = self.get_text_classifier()
         
         text_classifier = torch.cat([text_classifier, F.normalize(self.void_embedding.weight, dim=-1)], dim=0)
         
-        
-        features['text_classifier'] = text_classifier
-        features['num_templates'] = num_templates
-        
-        with torch.no_grad():
-            outputs = self.sem_seg_head(features)
-        
-            clip_vis_dense = self.visual_prediction_forward_convnext_2d(clip_feature)
+        if self.training and "teacher" in batched_inputs[0]:
+            # the frozen backbone and Mask2Former head were run offline, see tools/build_teacher_store.py
+            clip_feature, clip_vis_dense, outputs = self.load_teacher_outputs(batched_inputs, images)
+        else:
+            features = self.backbone(images.tensor)
+            
+            clip_feature = features['clip_vis_dense']
+            
+            features['text_classifier'] = text_classifier
+            features['num_templates'] = num_templates
+            
+            with torch.no_grad():
+                outputs = self.sem_seg_head(features)
+            
+                clip_vis_dense = self.visual_prediction_forward_convnext_2d(clip_feature)
         
         if self.training:
             # mask classification target
@@ -338,7 +357,7 @@ class FCCLIP(nn.Module):
             mask_pred_results = outputs["pred_masks"]
             mask_cls_results = outputs["pred_logits"]
 
-            src_masks, target_masks, mask_labels = self.match_via_iou(mask_pred_results, mask_cls_results, targets, iou_threshold=self.iou_threshold,max_matches=self.num_pred_masks)
+            src_masks, target_masks, mask_labels = self.match_via_iou(mask_pred_results, mask_cls_results, targets, iou_threshold=self.iou_threshold,max_matches=self.num_pred_masks, above=outputs.get("above"))
             binary_src_masks = src_masks.sigmoid() > self.mask_threshold
             binary_src_masks = binary_src_masks.float()
             
@@ -357,8 +376,7 @@ class FCCLIP(nn.Module):
                 B,C = clip_feature.size(0),clip_feature.size(1)
                 N = maps_for_pooling.size(1)
                 num_instances = N // self.num_output_maps
-                maps_for_pooling = F.softmax(F.logsigmoid(maps_for_pooling).view(B, N,-1), dim=-1)
-                pooled_clip_feature = torch.bmm(maps_for_pooling, clip_feature.view(B, C, -1).permute(0, 2, 1))
+                pooled_clip_feature = pool_clip_feature(maps_for_pooling, clip_feature)
                 pooled_clip_feature = self.backbone.visual_prediction_forward(pooled_clip_feature)
                 pooled_clip_feature = (pooled_clip_feature.reshape(B, num_instances, self.num_output_maps, -1).mean(dim=-2).contiguous())
             else:
@@ -393,8 +411,7 @@ class FCCLIP(nn.Module):
                 B,C = clip_feature.size(0),clip_feature.size(1)
                 N = maps_for_pooling.size(1)
                 num_instances = N // self.num_output_maps
-                maps_for_pooling = F.softmax(F.logsigmoid(maps_for_pooling).view(B, N,-1), dim=-1)
-                pooled_clip_feature = torch.bmm(maps_for_pooling, clip_feature.view(B, C, -1).permute(0, 2, 1))
+                pooled_clip_feature = pool_clip_feature(maps_for_pooling, clip_feature)
                 pooled_clip_feature = self.backbone.visual_prediction_forward(pooled_clip_feature)
                 pooled_clip_feature = (pooled_clip_feature.reshape(B,num_instances, self.num_output_maps, -1).mean(dim=-2).contiguous())
             else:
@@ -473,6 +490,102 @@ class FCCLIP(nn.Module):
 
             return processed_results
 
+    @torch.no_grad()
+    def teacher_outputs(self, batched_inputs):
+        """
+        Runs the frozen part of the model (CLIP backbone and Mask2Former head) on a training batch,
+        and returns for every image the outputs that mixed-mask training can read from the teacher
+        store instead (see tools/build_teacher_store.py), as numpy arrays cropped to the image:
+
+            * "clip_feature", "clip_vis_dense": the dense CLIP features, in float16.
+            * "candidate_masks": the bit-packed binary masks of the predictions whose IoU with some
+              target is above the threshold, the only ones :meth:`match_via_iou` can pick.
+            * "candidate_above": C' x T bool, the targets every candidate is above the threshold with.
+            * "candidate_width", "feature_stride", "mask_stride": to unpack and pad them back.
+        """
+        images = [x["image"].to(self.device) for x in batched_inputs]
+        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
+        images = ImageList.from_tensors(images, self.size_divisibility)
+
+        text_classifier, num_templates = self.get_text_classifier()
+        text_classifier = torch.cat([text_classifier, F.normalize(self.void_embedding.weight, dim=-1)], dim=0)
+        features = self.backbone(images.tensor)
+        features['text_classifier'] = text_classifier
+        features['num_templates'] = num_templates
+        outputs = self.sem_seg_head(features)
+
+        clip_feature = features['clip_vis_dense']
+        clip_vis_dense = self.visual_prediction_forward_convnext_2d(clip_feature)
+
+        gt_instances = [x["instances"].to(self.device) for x in batched_inputs]
+        targets, _, _ = self.prepare_targets_for_maskadapter(gt_instances, images)
+        mask_pred_results = outputs["pred_masks"]
+        tgt_mask, _, _ = self.pad_targets(targets, self.device)
+        above = self.ious_above(mask_pred_results, tgt_mask, self.iou_threshold)
+
+        feature_stride = images.tensor.shape[-1] // clip_feature.shape[-1]
+        mask_stride = images.tensor.shape[-1] // mask_pred_results.shape[-1]
+        results = []
+        for b, (image_size, targets_per_image) in enumerate(zip(images.image_sizes, targets)):
+            fh, fw = (math.ceil(s / feature_stride) for s in image_size)
+            mh, mw = (math.ceil(s / mask_stride) for s in image_size)
+            above_per_image = above[b, :, : targets_per_image["masks"].shape[0]]
+            candidates = above_per_image.any(dim=1)
+            candidate_masks = mask_pred_results[b, candidates, :mh, :mw].sigmoid() > self.mask_threshold
+            results.append(
+                {
+                    "clip_feature": clip_feature[b, :, :fh, :fw].half().cpu().numpy(),
+                    "clip_vis_dense": clip_vis_dense[b, :, :fh, :fw].half().cpu().numpy(),
+                    "candidate_masks": pack_bitmasks(candidate_masks).cpu().numpy(),
+                    "candidate_above": above_per_image[candidates].cpu().numpy(),
+                    "candidate_width": np.int64(mw),
+                    "feature_stride": np.int64(feature_stride),
+                    "mask_stride": np.int64(mask_stride),
+                }
+            )
+        return results
+
+    def load_teacher_outputs(self, batched_inputs, images):
+        """
+        Rebuilds the CLIP features and the Mask2Former outputs that training reads from the
+        "teacher" outputs of the batch (see :meth:`teacher_outputs`), zero-padded like `images`.
+        The candidate masks come back as saturated logits, and "above" gives the pairs that
+        :meth:`match_via_iou` can match, so the IoUs are not computed again.
+        """
+        teachers = [x["teacher"] for x in batched_inputs]
+        batch_size = len(teachers)
+        h_pad, w_pad = images.tensor.shape[-2:]
+        feature_stride = int(teachers[0]["feature_stride"])
+        mask_stride = int(teachers[0]["mask_stride"])
+
+        def pad_features(name):
+            channels = teachers[0][name].shape[0]
+            padded = torch.zeros((batch_size, channels, h_pad // feature_stride, w_pad // feature_stride))
+            for b, teacher in enumerate(teachers):
+                feature = teacher[name]
+                padded[b, :, : feature.shape[-2], : feature.shape[-1]] = feature
+            return padded.to(self.device, non_blocking=True)
+
+        clip_feature = pad_features("clip_feature")
+        clip_vis_dense = pad_features("clip_vis_dense")
+
+        num_candidates = max(max(t["candidate_above"].shape[0] for t in teachers), 1)
+        num_targets = max(t["candidate_above"].shape[1] for t in teachers)
+        pred_masks = torch.full((batch_size, num_candidates, h_pad // mask_stride, w_pad // mask_stride), -20.0)
+        above = torch.zeros((batch_size, num_candidates, num_targets), dtype=torch.bool)
+        for b, teacher in enumerate(teachers):
+            bits = unpack_bitmasks(teacher["candidate_masks"], int(teacher["candidate_width"]))
+            c, h, w = bits.shape
+            pred_masks[b, :c, :h, :w] = bits.float() * 40.0 - 20.0
+            above[b, :c, : teacher["candidate_above"].shape[1]] = teacher["candidate_above"]
+
+        outputs = {
+            "pred_masks": pred_masks.to(self.device, non_blocking=True),
+            "pred_logits": None,
+            "above": above.to(self.device, non_blocking=True),
+        }
+        return clip_feature, clip_vis_dense, outputs
+
     def prepare_targets_for_maskadapter(self, targets, images):
         h_pad, w_pad = images.tensor.shape[-2:]
         new_targets = []
@@ -486,49 +599,37 @@ class FCCLIP(nn.Module):
             gt_masks = targets_per_image.gt_masks
             if isinstance(gt_masks, BitMasks):
                 gt_masks = gt_masks.tensor
-            valid_mask_indices = [i for i, mask in enumerate(gt_masks) if mask.sum() > min_mask_area]  # 筛选掉面积小于阈值的掩码
-
-            if len(valid_mask_indices) > 0:
-                valid_gt_masks = gt_masks[valid_mask_indices]
-                valid_gt_classes = targets_per_image.gt_classes[valid_mask_indices]
-
-                padded_masks = torch.zeros((valid_gt_masks.shape[0], h_pad, w_pad), dtype=valid_gt_masks.dtype, device=valid_gt_masks.device)
-                padded_masks[:, :valid_gt_masks.shape[1], :valid_gt_masks.shape[2]] = valid_gt_masks
-                new_targets.append(
-                    {
-                        "labels": valid_gt_classes,
-                        "masks": padded_masks,
-                    }
-                )
-
-                total_masks = torch.zeros((num_masks, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-                selected_labels = torch.full((num_masks,), -1, dtype=valid_gt_classes.dtype, device=gt_masks.device)
-
-                if valid_gt_masks.shape[0] > num_masks:
-                    selected_indices = torch.randperm(valid_gt_masks.shape[0])[:num_masks]
-                    for idx, mask_idx in enumerate(selected_indices):
-                        total_masks[idx, :valid_gt_masks[mask_idx].shape[0], :valid_gt_masks[mask_idx].shape[1]] = valid_gt_masks[mask_idx]
-                        selected_labels[idx] = valid_gt_classes[mask_idx]
-                else:
-                    for idx in range(valid_gt_masks.shape[0]):
-                        total_masks[idx, :valid_gt_masks[idx].shape[0], :valid_gt_masks[idx].shape[1]] = valid_gt_masks[idx]
-                        selected_labels[idx] = valid_gt_classes[idx]
-                    
-                    for idx in range(valid_gt_masks.shape[0], num_masks):
-                        total_masks[idx] = torch.zeros((h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-                        selected_labels[idx] = -1
+            # one area reduction for all the masks instead of a .sum() (and a host sync) per mask
+            valid = gt_masks.flatten(1).sum(-1) > min_mask_area
+            valid_gt_masks = gt_masks[valid]
+            num_valid = valid_gt_masks.shape[0]
+            if num_valid > 0:
+                valid_gt_classes = targets_per_image.gt_classes[valid]
             else:
-                total_masks = torch.zeros((num_masks, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-                selected_labels = torch.full((num_masks,), -1, dtype=torch.long, device=gt_masks.device)
-                
-                padded_masks = torch.zeros((0, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
                 valid_gt_classes = torch.zeros((0), device=gt_masks.device)
-                new_targets.append(
-                    {
-                        "labels": valid_gt_classes,
-                        "masks": padded_masks,
-                    }
-                )
+
+            padded_masks = torch.zeros((num_valid, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
+            padded_masks[:, : gt_masks.shape[1], : gt_masks.shape[2]] = valid_gt_masks
+            new_targets.append(
+                {
+                    "labels": valid_gt_classes,
+                    "masks": padded_masks,
+                }
+            )
+
+            # at most num_masks masks are kept, drawn with the same (CPU) randperm as before
+            if num_valid > num_masks:
+                selected_indices = torch.randperm(num_valid)[:num_masks].to(gt_masks.device)
+                selected_masks = padded_masks[selected_indices]
+                selected_classes = valid_gt_classes[selected_indices]
+            else:
+                selected_masks = padded_masks
+                selected_classes = valid_gt_classes
+
+            total_masks = torch.zeros((num_masks, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
+            total_masks[: selected_masks.shape[0]] = selected_masks
+            selected_labels = torch.full((num_masks,), -1, dtype=torch.long, device=gt_masks.device)
+            selected_labels[: selected_classes.shape[0]] = selected_classes
 
             masks_list.append(total_masks)
             labels_list.append(selected_labels)
@@ -539,70 +640,95 @@ class FCCLIP(nn.Module):
 
         return new_targets, masks, labels
     
-    @torch.no_grad()                            
-    def match_via_iou(self, mask_pred_results, mask_cls_results, targets, iou_threshold=0.7, max_matches=8):
-        batch_size = mask_pred_results.shape[0]
-        matched_src_masks = []
-        matched_target_masks = []
-        matched_labels = []
-
-        for b in range(batch_size):
-            tgt_label = targets[b]["labels"]  
-            tgt_mask = targets[b]["masks"].to(mask_pred_results.device) 
-            num_tgt_masks = tgt_mask.shape[0]
-
-            pred_mask = mask_pred_results[b]  
-            pred_cls = mask_cls_results[b] 
-            num_pred_masks = pred_mask.shape[0]
-
-            tgt_mask = F.interpolate(tgt_mask[:, None].float(), size=pred_mask.shape[-2:], mode='bilinear', align_corners=False).squeeze(1)
+    def pad_targets(self, targets, device):
+        """
+        Pads the targets to the largest number of targets in the batch; the shapes are known on the host.
+        Returns the B x T x H x W masks, the B x T labels (-1 for padding) and the B x T validity.
+        """
+        batch_size = len(targets)
+        num_tgt_masks = max(t["masks"].shape[0] for t in targets)
+        h_pad, w_pad = targets[0]["masks"].shape[-2:]
+        tgt_mask = torch.zeros((batch_size, num_tgt_masks, h_pad, w_pad), device=device)
+        tgt_label = torch.full((batch_size, num_tgt_masks), -1, dtype=torch.long, device=device)
+        tgt_valid = torch.zeros((batch_size, num_tgt_masks), dtype=torch.bool, device=device)
+        for b, targets_per_image in enumerate(targets):
+            n = targets_per_image["masks"].shape[0]
+            tgt_mask[b, :n] = targets_per_image["masks"]
+            tgt_label[b, :n] = targets_per_image["labels"]
+            tgt_valid[b, :n] = True
+        return tgt_mask, tgt_label, tgt_valid
+
+    @torch.no_grad()
+    def ious_above(self, mask_pred_results, tgt_mask, iou_threshold):
+        """
+        Returns the B x Q x T mask of the prediction / target pairs with an IoU above `iou_threshold`.
+        """
+        batch_size, num_tgt_masks = tgt_mask.shape[:2]
+
+        # the IoUs only decide the matches, so they can be computed at a lower resolution
+        pred_size = tuple(mask_pred_results.shape[-2:])
+        iou_pred_masks = mask_pred_results
+        if 0 < self.iou_resolution < max(pred_size):
+            scale = self.iou_resolution / max(pred_size)
+            iou_size = tuple(max(int(round(s * scale)), 1) for s in pred_size)
+            iou_pred_masks = F.interpolate(mask_pred_results, size=iou_size, mode='bilinear', align_corners=False)
+        if num_tgt_masks > 0:
+            iou_tgt_masks = F.interpolate(tgt_mask, size=iou_pred_masks.shape[-2:], mode='bilinear', align_corners=False)
+        else:
+            iou_tgt_masks = tgt_mask.new_zeros((batch_size, 0, *iou_pred_masks.shape[-2:]))
 
-            pred_mask_flat = pred_mask.flatten(1)
-            tgt_mask_flat = tgt_mask.flatten(1)
+        ious = compute_mask_iou(iou_pred_masks.flatten(2), iou_tgt_masks.flatten(2), bitpacked=self.iou_bitpacked)  # B x Q x T
+        return ious > iou_threshold
 
-            with torch.no_grad():
-                ious = compute_mask_iou(pred_mask_flat, tgt_mask_flat)
+    @torch.no_grad()
+    def match_via_iou(self, mask_pred_results, mask_cls_results, targets, iou_threshold=0.7, max_matches=8, above=None):
+        """
+        Matches every target to a random prediction among the ones whose IoU with it is above
+        `iou_threshold`, and keeps at most `max_matches` random matches per image (padded with
+        empty masks and -1 labels). Runs on the padded batch without any host sync.
 
-            matched_pred_idx = []
-            matched_tgt_idx = []
-            
-            for j in range(num_tgt_masks):
-                valid_pred_idx = (ious[:, j] > iou_threshold).nonzero(as_tuple=True)[0]
-                if len(valid_pred_idx) > 0:
-                    random_idx = torch.randint(0, len(valid_pred_idx), (1,)).item()
-                    best_pred_idx = valid_pred_idx[random_idx]
-                    matched_pred_idx.append(best_pred_idx.item())
-                    matched_tgt_idx.append(j)
-
-
-            if len(matched_pred_idx) > max_matches:
-                selected_indices = torch.randperm(len(matched_pred_idx))[:max_matches]
-                matched_pred_idx = [matched_pred_idx[i] for i in selected_indices]
-                matched_tgt_idx = [matched_tgt_idx[i] for i in selected_indices]
-
-            if len(matched_pred_idx) < max_matches:
-                num_to_add = max_matches - len(matched_pred_idx)
-                
-                matched_src_masks.append(
-                    torch.cat([pred_mask[matched_pred_idx], 
-                            torch.zeros((num_to_add, *pred_mask.shape[1:]), device=pred_mask.device)], dim=0)
-                )
-                matched_target_masks.append(
-                    torch.cat([tgt_mask[matched_tgt_idx], 
-                            torch.zeros((num_to_add, *tgt_mask.shape[1:]), device=tgt_mask.device)], dim=0)
-                )
-                matched_labels.append(
-                    torch.cat([tgt_label[matched_tgt_idx], 
-                            torch.full((num_to_add,), -1, dtype=tgt_label.dtype, device=tgt_label.device)], dim=0)
-                )
-            else:
-                matched_src_masks.append(pred_mask[matched_pred_idx])
-                matched_target_masks.append(tgt_mask[matched_tgt_idx])
-                matched_labels.append(tgt_label[matched_tgt_idx])
+        `above` (B x Q x T) can give the pairs above the threshold, e.g. read from the teacher store.
+        """
+        batch_size = mask_pred_results.shape[0]
+        device = mask_pred_results.device
+        pred_size = tuple(mask_pred_results.shape[-2:])
+
+        tgt_mask, tgt_label, tgt_valid = self.pad_targets(targets, device)
+        num_tgt_masks = tgt_mask.shape[1]
+        if above is None:
+            above = self.ious_above(mask_pred_results, tgt_mask, iou_threshold)
+        assert above.shape[-1] == num_tgt_masks, "the stored teacher outputs do not match the targets"
+
+        # a random prediction above the threshold for every target: argmax of random scores
+        # restricted to the predictions above the threshold
+        scores = torch.rand(above.shape, device=device).masked_fill_(~above, -1)
+        pred_idx = scores.argmax(dim=1)  # B x T
+        matched = above.any(dim=1) & tgt_valid
+
+        # at most max_matches random matched targets, the matched ones first
+        num_selected = min(num_tgt_masks, max_matches)
+        priority = torch.rand((batch_size, num_tgt_masks), device=device) + matched.float()
+        selected_tgt_idx = priority.topk(num_selected, dim=1).indices  # B x K
+        selected_matched = matched.gather(1, selected_tgt_idx)
+        selected_pred_idx = pred_idx.gather(1, selected_tgt_idx)
+
+        batch_idx = torch.arange(batch_size, device=device)[:, None]
+        unmatched = ~selected_matched
+        matched_src_masks = mask_pred_results[batch_idx, selected_pred_idx].masked_fill(unmatched[..., None, None], 0)
+        # only the selected targets are resized to the prediction resolution
+        matched_target_masks = tgt_mask[batch_idx, selected_tgt_idx]
+        if num_selected > 0:
+            matched_target_masks = F.interpolate(matched_target_masks, size=pred_size, mode='bilinear', align_corners=False)
+        else:
+            matched_target_masks = matched_target_masks.new_zeros((batch_size, 0, *pred_size))
+        matched_target_masks = matched_target_masks.masked_fill(unmatched[..., None, None], 0)
+        matched_labels = tgt_label.gather(1, selected_tgt_idx).masked_fill(unmatched, -1)
 
-        matched_src_masks = torch.stack(matched_src_masks, dim=0) 
-        matched_target_masks = torch.stack(matched_target_masks, dim=0)
-        matched_labels = torch.stack(matched_labels, dim=0)
+        if num_selected < max_matches:
+            num_to_add = max_matches - num_selected
+            matched_src_masks = F.pad(matched_src_masks, (0, 0, 0, 0, 0, num_to_add))
+            matched_target_masks = F.pad(matched_target_masks, (0, 0, 0, 0, 0, num_to_add))
+            matched_labels = F.pad(matched_labels, (0, num_to_add), value=-1)
 
         return matched_src_masks, matched_target_masks, matched_labels
 
@@ -632,12 +758,14 @@ class FCCLIP(nn.Module):
         cosine_similarity_loss[f"loss_cosine"] = 1 - cosine_sim.mean()
         return cosine_similarity_loss
 
+    @float32
     def semantic_inference(self, mask_cls, mask_pred):
         mask_cls = F.softmax(mask_cls, dim=-1)[..., :-1]
         mask_pred = mask_pred.sigmoid()
         semseg = torch.einsum("qc,qhw->chw", mask_cls, mask_pred)
         return semseg
 
+    @float32
     def panoptic_inference(self, mask_cls, mask_pred):
 
         
@@ -698,6 +826,7 @@ class FCCLIP(nn.Module):
 
             return panoptic_seg, segments_info
 
+    @float32
     def instance_inference(self, mask_cls, mask_pred):
         # mask_pred is already processed to have the same shape as original input
         image_size = mask_pred.shape[-2:]
@@ -750,19 +879,32 @@ class FCCLIP(nn.Module):
 
 
     
-def compute_mask_iou(pred_masks, tgt_masks):
-    
+def compute_mask_iou(pred_masks, tgt_masks, bitpacked=False):
+    """
+    IoUs between binarized predicted masks (logits) and target masks, of shape (..., N, C)
+    and (..., M, C). With `bitpacked`, the masks are packed to 1 bit per pixel and the
+    intersections are counted with a popcount instead of a dense float product.
+    """
     pred_masks = pred_masks.sigmoid()
     
-    binarized_pred_masks = (pred_masks >= 0.4).float()
-    binarized_tgt_masks = (tgt_masks > 0.5).float()
-
-    intersection = torch.einsum('nc,mc->nm', binarized_pred_masks, binarized_tgt_masks)
-    
-    pred_area = binarized_pred_masks.sum(dim=-1)  
-    tgt_area = binarized_tgt_masks.sum(dim=-1)    
+    binarized_pred_masks = pred_masks >= 0.4
+    binarized_tgt_masks = tgt_masks > 0.5
+
+    if bitpacked:
+        intersection, pred_area, tgt_area = packed_mask_counts(
+            pack_bitmasks(binarized_pred_masks), pack_bitmasks(binarized_tgt_masks)
+        )
+        intersection, pred_area, tgt_area = intersection.float(), pred_area.float(), tgt_area.float()
+    else:
+        binarized_pred_masks = binarized_pred_masks.float()
+        binarized_tgt_masks = binarized_tgt_masks.float()
+
+        intersection = torch.einsum('...nc,...mc->...nm', binarized_pred_masks, binarized_tgt_masks)
+        
+        pred_area = binarized_pred_masks.sum(dim=-1)  
+        tgt_area = binarized_tgt_masks.sum(dim=-1)    
     
-    union = pred_area[:, None] + tgt_area[None, :] - intersection
+    union = pred_area[..., :, None] + tgt_area[..., None, :] - intersection
     
     iou_matrix = intersection / (union + 1e-6)
     
@@ -7,6 +7,11 @@ Reference: https://github.com/facebookresearch/Mask2Former/blob/main/mask2former
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
 
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn.functional as F
 from scipy.optimize import linear_sum_assignment
@@ -14,6 +19,7 @@ from torch import nn
 from torch.cuda.amp import autocast
 
 from detectron2.projects.point_rend.point_features import point_sample
+from detectron2.utils.logger import log_every_n_seconds
 
 
 def batch_dice_loss(inputs: torch.Tensor, targets: torch.Tensor):
@@ -71,6 +77,26 @@ batch_sigmoid_ce_loss_jit = torch.jit.script(
 )  # type: torch.jit.ScriptModule
 
 
+_ASSIGNMENT_POOL = None
+
+
+def _assignment_pool():
+    # shared by all the matchers, created on first use
+    global _ASSIGNMENT_POOL
+    if _ASSIGNMENT_POOL is None:
+        _ASSIGNMENT_POOL = ThreadPoolExecutor(
+            max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="linear_sum_assignment"
+        )
+    return _ASSIGNMENT_POOL
+
+
+def _solve_assignment(C, copied):
+    # waits for the asynchronous copy of the cost matrix to the host, without holding the GIL
+    if copied is not None:
+        copied.synchronize()
+    return linear_sum_assignment(C)
+
+
 class HungarianMatcher(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
 
@@ -100,8 +126,11 @@ class HungarianMatcher(nn.Module):
     def memory_efficient_forward(self, outputs, targets):
         """More memory-friendly matching"""
         bs, num_queries = outputs["pred_logits"].shape[:2]
+        start_time = time.perf_counter()
 
-        indices = []
+        # the assignment of an image is solved on a thread while the costs of the next images
+        # are computed; the cost matrices are copied to the host asynchronously
+        futures = []
 
         # Iterate through batch size
         for b in range(bs):
@@ -150,10 +179,22 @@ class HungarianMatcher(nn.Module):
                 + self.cost_class * cost_class
                 + self.cost_dice * cost_dice
             )
-            C = C.reshape(num_queries, -1).cpu()
-
-            indices.append(linear_sum_assignment(C))
-
+            C = C.reshape(num_queries, -1)
+            if C.is_cuda:
+                C = C.to("cpu", non_blocking=True)
+                copied = torch.cuda.Event()
+                copied.record()
+            else:
+                copied = None
+
+            futures.append(_assignment_pool().submit(_solve_assignment, C, copied))
+
+        indices = [f.result() for f in futures]
+        log_every_n_seconds(
+            logging.INFO,
+            "Hungarian matching of {} images: {:.2f} ms".format(bs, (time.perf_counter() - start_time) * 1000),
+            n=60,
+        )
         return [
             (torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
             for i, j in indices
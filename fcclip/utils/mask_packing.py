@@ -0,0 +1,79 @@
+# Copyright (c) 2024 ByteDance. All Rights Reserved.
+"""
+Bit-packing of binary masks, and popcount-style pixel counts on the packed masks,
+used to compute mask IoUs on 1 bit per pixel instead of a dense float product.
+"""
+import torch
+
+__all__ = ["pack_bitmasks", "unpack_bitmasks", "packed_mask_counts"]
+
+
+def _bit_weights(device):
+    # most significant bit first, as np.packbits
+    return torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=device)
+
+
+def _popcount(x):
+    # number of set bits of every byte of a uint8 tensor, with in-register bit tricks
+    x = x - ((x >> 1) & 0x55)
+    x = (x & 0x33) + ((x >> 2) & 0x33)
+    return (x + (x >> 4)) & 0x0F
+
+
+def pack_bitmasks(masks):
+    """
+    Args:
+        masks (Tensor): bool or 0/1 tensor of shape (..., C).
+
+    Returns:
+        Tensor: uint8 tensor of shape (..., ceil(C / 8)).
+    """
+    c = masks.shape[-1]
+    masks = masks.to(torch.uint8)
+    if c % 8:
+        masks = torch.nn.functional.pad(masks, (0, 8 - c % 8))
+    masks = masks.reshape(*masks.shape[:-1], -1, 8)
+    return (masks * _bit_weights(masks.device)).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_bitmasks(packed, width):
+    """
+    Inverse of :func:`pack_bitmasks`.
+
+    Args:
+        packed (Tensor): uint8 tensor of shape (..., ceil(C / 8)).
+        width (int): the size C of the last dimension of the original masks.
+
+    Returns:
+        Tensor: bool tensor of shape (..., C).
+    """
+    bits = packed.unsqueeze(-1) & _bit_weights(packed.device)
+    return bits.bool().flatten(-2)[..., :width]
+
+
+def packed_mask_counts(packed_a, packed_b, chunk_size=8):
+    """
+    Pixel counts of bit-packed masks, from a popcount of every byte.
+
+    Args:
+        packed_a (Tensor): uint8 tensor of shape (..., N, C8), see :func:`pack_bitmasks`.
+        packed_b (Tensor): uint8 tensor of shape (..., M, C8).
+        chunk_size (int): number of masks of `packed_b` intersected at once, which bounds
+            the temporary (..., N, chunk_size, C8) byte tensor.
+
+    Returns:
+        intersection (Tensor): int32 tensor of shape (..., N, M).
+        area_a (Tensor): int32 tensor of shape (..., N).
+        area_b (Tensor): int32 tensor of shape (..., M).
+    """
+    area_a = _popcount(packed_a).sum(dim=-1, dtype=torch.int32)
+    area_b = _popcount(packed_b).sum(dim=-1, dtype=torch.int32)
+    intersection = [
+        _popcount(packed_a.unsqueeze(-2) & chunk.unsqueeze(-3)).sum(dim=-1, dtype=torch.int32)
+        for chunk in packed_b.split(chunk_size, dim=-2)
+    ]
+    if intersection:
+        intersection = torch.cat(intersection, dim=-1)
+    else:
+        intersection = area_a.new_zeros((*area_a.shape, 0))
+    return intersection, area_a, area_b
@@ -19,28 +19,36 @@ class MA_Loss(nn.Module):
         # Softmax to get class probabilities
         logits_per_image = F.softmax(out_vocab_cls_results[...,:-1], dim=-1)  # shape: (bs, 100, 171)
 
-        total_loss = 0
-        total_count = 0
-
         mask_results = mask_results.sigmoid()  # Ensure mask proposals are in the range [0, 1]
 
-        for b in range(len(targets)):
-            maski = mask_results[b].unsqueeze(0)  # shape: (1, 100, h, w)
-
-            for i in range(targets[b]['masks'].shape[0]):
-                logiti = logits_per_image[b, :, targets[b]['labels'][i]].unsqueeze(0)  # shape: (1, 100)
-                labeli = targets[b]['masks'][i].unsqueeze(0)  # shape: (1, h, w)
-
-                # Compute IoU directly for current instance
-                iou = self.get_iou(maski, labeli).detach()  # shape: (1, 100)
-
-                # Compute loss for current instance
-                loss = self.sl1(logiti, iou)
-                total_loss += loss
-                total_count += 1
-
-        # Average the loss over the number of instances
-        ma_loss = total_loss / total_count if total_count > 0 else 0
+        # targets padded to the largest number of instances in the batch, with a validity mask
+        num_queries = mask_results.shape[1]
+        num_targets = max((t['masks'].shape[0] for t in targets), default=0)
+        ious = mask_results.new_zeros((len(targets), num_queries, num_targets))
+        labels = torch.zeros((len(targets), num_targets), dtype=torch.long, device=mask_results.device)
+        valid = torch.zeros((len(targets), num_targets), dtype=torch.bool, device=mask_results.device)
+
+        # the IoUs are targets of the loss, so no graph is kept for them
+        with torch.no_grad():
+            for b in range(len(targets)):
+                k = targets[b]['masks'].shape[0]
+                if k == 0:
+                    continue
+                # query x instance IoUs of the image at once, shape: (100, k)
+                ious[b, :, :k] = self.get_iou(mask_results[b].unsqueeze(0), targets[b]['masks'].unsqueeze(0))[0]
+                labels[b, :k] = targets[b]['labels']
+                valid[b, :k] = True
+
+        total_count = sum(t['masks'].shape[0] for t in targets)
+        if total_count == 0:
+            return 0
+
+        # class probability of every query for the class of every instance, shape: (bs, 100, k)
+        logits = logits_per_image.gather(2, labels.unsqueeze(1).expand(-1, num_queries, -1))
+
+        # SmoothL1 averaged over the queries of every instance, then over the instances
+        loss = F.smooth_l1_loss(logits, ious, reduction="none", beta=self.sl1.beta).mean(dim=1)
+        ma_loss = (loss * valid).sum() / total_count
         return ma_loss
 
     def get_iou(self, pred, target):
@@ -52,11 +60,11 @@ class MA_Loss(nn.Module):
             pred = F.interpolate(pred, size=(target.shape[-2], target.shape[-1]), mode="bilinear", align_corners=False)
 
         pred = pred.reshape(b, c, -1)
-        target = target.reshape(b, 1, -1)
+        target = target.reshape(b, target.shape[1], -1).to(pred.dtype)
         
-        # Compute the IoU of the foreground
-        Iand1 = torch.sum(target * pred, dim=-1)
-        Ior1 = torch.sum(target, dim=-1) + torch.sum(pred, dim=-1) - Iand1 + 1e-7
+        # Compute the IoU of the foreground, for every prediction and target: (b, c, k)
+        Iand1 = torch.einsum('bcn,bkn->bck', pred, target)
+        Ior1 = torch.sum(target, dim=-1)[:, None, :] + torch.sum(pred, dim=-1)[:, :, None] - Iand1 + 1e-7
         IoU1 = Iand1 / Ior1
 
         return IoU1
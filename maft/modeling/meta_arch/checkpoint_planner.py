@@ -0,0 +1,94 @@
+# Copyright (c) 2024 ByteDance. All Rights Reserved.
+"""
+Chooses which blocks of a sequential stack to recompute in the backward pass (activation
+checkpointing), so that the activations kept for the backward pass fit a memory budget at the
+lowest recompute cost.
+
+The blocks are profiled once on a single sample: the storages that autograd saves in each of
+them, the input that a checkpoint of the block would save instead, and their multiply-accumulates
+(convolutions and linear layers), the recompute cost of checkpointing them. Every subset of the
+blocks is then scored for the actual number of samples, which is cheap for the few blocks of a head.
+"""
+import itertools
+
+import torch
+from torch import nn
+
+__all__ = ["profile_blocks", "plan_checkpointing"]
+
+
+def profile_blocks(blocks, inputs, parameters):
+    """
+    Args:
+        blocks (list[(str, callable)]): the named blocks, applied in sequence to `inputs`.
+        inputs (Tensor): the input of the first block, for a single sample.
+        parameters (iterable[Tensor]): the parameters of the blocks, which are not activations.
+
+    Returns:
+        list[dict]: for every block its "name", the storages autograd saves for its backward
+        pass as "saved" ({storage: bytes}), its "input" (storage, bytes) and its "macs".
+    """
+    param_storages = {p.untyped_storage().data_ptr() for p in parameters}
+    saved, macs = {}, [0]
+    # the saved tensors are kept alive until the end, so that their storages are not reused
+    keep_alive = []
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in param_storages:
+            saved[storage.data_ptr()] = storage.nbytes()
+            keep_alive.append(tensor)
+        return tensor
+
+    def count_macs(module, args, output):
+        if isinstance(module, (nn.Conv2d, nn.Linear)):
+            macs[0] += output.numel() * module.weight[0].numel()
+
+    profiles = []
+    # a copy, so that its storage is not the one of the whole batch
+    outputs = inputs.detach().clone()
+    handle = torch.nn.modules.module.register_module_forward_hook(count_macs)
+    try:
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            for name, block in blocks:
+                storage = outputs.untyped_storage()
+                block_input = (storage.data_ptr(), storage.nbytes())
+                saved, macs = {}, [0]
+                outputs = block(outputs)
+                keep_alive.append(outputs)
+                profiles.append({"name": name, "saved": saved, "input": block_input, "macs": macs[0]})
+    finally:
+        handle.remove()
+    return profiles
+
+
+def plan_checkpointing(profiles, num_samples, budget):
+    """
+    Args:
+        profiles (list[dict]): see :func:`profile_blocks`.
+        num_samples (int): the number of samples of the forward, relative to the profiled one.
+        budget (int): the bytes of activations that can be kept for the backward pass.
+
+    Returns:
+        names (tuple[str]): the blocks to checkpoint, or the subset keeping the least
+            memory if none fits the budget.
+        memory (int): the estimated bytes of activations kept for the backward pass.
+        macs (int): the multiply-accumulates recomputed in the backward pass.
+    """
+    best = None
+    for checkpointed in itertools.product((False, True), repeat=len(profiles)):
+        kept = {}
+        for profile, is_checkpointed in zip(profiles, checkpointed):
+            if is_checkpointed:
+                kept[profile["input"][0]] = profile["input"][1]
+            else:
+                kept.update(profile["saved"])
+        memory = sum(kept.values()) * num_samples
+        macs = sum(p["macs"] for p, c in zip(profiles, checkpointed) if c) * num_samples
+        names = tuple(p["name"] for p, c in zip(profiles, checkpointed) if c)
+        fits = memory <= budget
+        # the cheapest subset that fits, else the one keeping the least memory
+        score = (0, macs, len(names)) if fits else (1, memory, macs)
+        if best is None or score < best[0]:
+            best = (score, names, memory, macs)
+    return best[1:]
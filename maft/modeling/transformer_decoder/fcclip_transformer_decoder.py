@@ -19,6 +19,7 @@ from detectron2.utils.registry import Registry
 
 
 from .position_encoding import PositionEmbeddingSine
+from ...utils.precision import float32
 
 
 TRANSFORMER_DECODER_REGISTRY = Registry("TRANSFORMER_MODULE")
@@ -35,6 +36,20 @@ def build_transformer_decoder(cfg, in_channels, mask_classification=True):
     return TRANSFORMER_DECODER_REGISTRY.get(name)(cfg, in_channels, mask_classification)
 
 
+# the softmax over all the pixels and the weighted sum are kept in float32 under autocast
+@float32
+def pool_clip_feature(maps_for_pooling, clip_feature):
+    # maps_for_pooling in shape of [B, N, H, W]
+    # clip_feature in shape of [B, C, H, W]
+    # return: [B, N, C], clip_feature averaged with a per-map softmax over the pixels of logsigmoid(maps)
+    B, N = maps_for_pooling.shape[:2]
+    C = clip_feature.shape[1]
+    maps_for_pooling = F.softmax(F.logsigmoid(maps_for_pooling).view(B, N, -1), dim=-1)
+    return torch.bmm(maps_for_pooling, clip_feature.view(B, C, -1).permute(0, 2, 1))
+
+
+# the normalization and the exponentiated logit scale are kept in float32 under autocast
+@float32
 def get_classification_logits(x, text_classifier, logit_scale, num_templates=None):
     # x in shape of [B, *, C]
     # text_classifier in shape of [num_classes, C]
@@ -0,0 +1,75 @@
+# Copyright (c) 2024 ByteDance. All Rights Reserved.
+"""
+Mixed precision: the autocast context of a SOLVER.AMP.PRECISION / TEST.PRECISION name,
+and a decorator keeping the numerically sensitive functions in float32 under autocast.
+"""
+import contextlib
+import functools
+
+import torch
+
+__all__ = ["PRECISIONS", "autocast", "float32", "autocast_forward"]
+
+PRECISIONS = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+def autocast(device, precision):
+    """
+    Returns the autocast context of `precision` (a key of :data:`PRECISIONS`) on `device`.
+    "float32" disables autocast.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision {}, expected one of {}".format(precision, list(PRECISIONS)))
+    device_type = torch.device(device).type
+    if precision == "float32":
+        return torch.autocast(device_type=device_type, enabled=False)
+    return torch.autocast(device_type=device_type, dtype=PRECISIONS[precision])
+
+
+def _no_autocast():
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.autocast(device_type="cpu", enabled=False))
+    if torch.cuda.is_available():
+        stack.enter_context(torch.autocast(device_type="cuda", enabled=False))
+    return stack
+
+
+def _to_float32(x):
+    if torch.is_tensor(x) and x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+
+def float32(fn):
+    """
+    Decorator running `fn` with autocast disabled on every device, and with its float16 /
+    bfloat16 tensor arguments cast to float32. Without autocast it only adds the casts.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _no_autocast():
+            args = [_to_float32(x) for x in args]
+            kwargs = {k: _to_float32(v) for k, v in kwargs.items()}
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def autocast_forward(forward):
+    """
+    Decorator of a meta-architecture forward, running it under the autocast of its
+    `train_precision` or `test_precision` attribute depending on the mode.
+    """
+
+    @functools.wraps(forward)
+    def wrapper(self, *args, **kwargs):
+        precision = self.train_precision if self.training else self.test_precision
+        with autocast(self.device, precision):
+            return forward(self, *args, **kwargs)
+
+    return wrapper
@@ -35,7 +35,16 @@ from .data.dataset_mappers.mask_former_semantic_dataset_mapper import (
 from .data.dataset_mappers.coco_combine_new_baseline_dataset_mapper import (
     COCOCombineNewBaselineDatasetMapper,
 )
+from .data.dataset_mappers.multi_vocab_test_dataset_mapper import (
+    MultiVocabTestDatasetMapper,
+    group_datasets_by_images,
+    merge_vocabulary_dataset_dicts,
+)
 from .data.custom_dataset_dataloader import *
+
+# checkpointing
+from .checkpoint import TrainableCheckpointer
+
 # models
 from .mask_adapter import MASK_Adapter
 from .test_time_augmentation import SemanticSegmentorWithTTA
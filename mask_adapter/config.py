@@ -135,6 +135,12 @@ def add_mask_adapter_config(cfg):
     cfg.MODEL.MASK_ADAPTER.MASK_IN_CHANNELS = 16
     cfg.MODEL.MASK_ADAPTER.NUM_CHANNELS = 768
     cfg.MODEL.MASK_ADAPTER.USE_CHECKPOINT = False
+    # blocks of MASKAdapterHead recomputed one by one in the backward pass, among "mask_downscaling",
+    # "fuse", "cnext1", "cnext2", "cnext3" and "final" (USE_CHECKPOINT recomputes all but the first as one)
+    cfg.MODEL.MASK_ADAPTER.CHECKPOINT_BLOCKS = []
+    # if > 0, budget in MiB of the activations MASKAdapterHead keeps for the backward pass: the blocks
+    # to recompute are then planned for the shapes of every batch, at the lowest recompute cost
+    cfg.MODEL.MASK_ADAPTER.CHECKPOINT_MEMORY_BUDGET = 0
     cfg.MODEL.MASK_ADAPTER.NUM_OUTPUT_MAPS = 16
     
     cfg.MODEL.MASK_ADAPTER.MASK_THRESHOLD  = 0.45
@@ -147,4 +153,41 @@ def add_mask_adapter_config(cfg):
     cfg.DATALOADER.DATASET_BS = [2, 2]
     cfg.DATALOADER.USE_RFS = [False, False]
     cfg.DATALOADER.MULTI_DATASET_GROUPING = True
-    cfg.DATALOADER.DATASET_ANN = ['box', 'box']
\ No newline at end of file
+    cfg.DATALOADER.DATASET_ANN = ['box', 'box']
+    # save only the trainable weights in the training checkpoints, with a reference to
+    # MODEL.WEIGHTS for the frozen ones (see TrainableCheckpointer)
+    cfg.SOLVER.CHECKPOINT_TRAINABLE_ONLY = False
+    # autocast dtype of the training forward when SOLVER.AMP.ENABLED: "float16" or "bfloat16"
+    # (bfloat16 has the float32 exponent range: the loss scaling of AMPTrainer is kept but not needed)
+    cfg.SOLVER.AMP.PRECISION = "float16"
+    # autocast dtype of the inference forward: "float32" (no autocast), "bfloat16" (also on CPU) or "float16";
+    # LayerNorm2d, the mask pooling, the CLIP classification and the post-processing stay in float32
+    cfg.TEST.PRECISION = "float32"
+    # send the training masks bit-packed from the dataloader workers (8x less shared memory),
+    # MASK_Adapter.prepare_targets unpacks them on the device
+    cfg.INPUT.PACK_MASKS = False
+
+    # batch the images of each dataset by their size quantized to SIZE_BUCKET_QUANTUM pixels
+    # instead of by w > h only, to pad less. A pending image waits at most SIZE_BUCKET_MAX_WAIT
+    # images before its bucket is completed with the closest sizes.
+    cfg.DATALOADER.SIZE_BUCKETING = False
+    cfg.DATALOADER.SIZE_BUCKET_QUANTUM = 128
+    cfg.DATALOADER.SIZE_BUCKET_MAX_WAIT = 64
+    # keep the training dataset dicts as one memory-mapped serialized blob instead of
+    # python objects, so the dataloader workers do not copy them
+    cfg.DATALOADER.COMPACT_DATASET_DICTS = False
+    # cache the filtered training dataset dicts in this directory, keyed by the annotation
+    # files and the filter settings, so later launches skip parsing the annotations. "" disables it.
+    cfg.DATALOADER.DATASET_CACHE_DIR = ""
+
+    # save the evaluator state every EVAL_STATE_PERIOD test batches, so that an
+    # interrupted evaluation resumes where it stopped. 0 disables it.
+    cfg.TEST.EVAL_STATE_PERIOD = 0
+
+    # evaluate the test datasets that share their images (e.g. ADE-150 and A-847) in one
+    # pass, running the backbone once per image and classifying it with every vocabulary
+    cfg.TEST.MULTI_VOCAB_EVAL = False
+
+    # shard the test images over the ranks by estimated cost (pixels x masks)
+    # instead of contiguous shards of equal length
+    cfg.TEST.SIZE_BALANCED_SAMPLER = False
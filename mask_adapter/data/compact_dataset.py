@@ -0,0 +1,113 @@
+# Copyright (c) 2024 ByteDance. All Rights Reserved.
+import logging
+import operator
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import torch.utils.data
+
+__all__ = ["CompactDatasetDicts"]
+
+# per-image fields that samplers and groupers read for every image, kept as plain arrays
+# so that they do not need to unpickle the whole dataset
+_COLUMNS = ("height", "width", "dataset_source")
+
+
+class CompactDatasetDicts(torch.utils.data.Dataset):
+    """
+    A read-only list of dataset dicts stored as one serialized blob plus an offsets array,
+    instead of millions of small Python objects. A dict is unpickled only when it is indexed.
+
+    Unlike a list of dicts, reading it does not touch any refcount in the shared pages, so the
+    dataloader workers forked from the main process do not copy it. When the arrays are
+    memory-mapped from disk (see :meth:`save` / :meth:`load`), the page cache is also shared
+    by the processes of all ranks on a machine.
+    """
+
+    def __init__(self, blob, offsets, columns):
+        """
+        Args:
+            blob (np.ndarray): uint8 array with all the pickled dicts.
+            offsets (np.ndarray): int64 array of length N + 1, dict i is blob[offsets[i]:offsets[i + 1]].
+            columns (dict[str, np.ndarray]): per-image fields stored as arrays of length N.
+        """
+        self._blob = blob
+        self._offsets = offsets
+        self._columns = columns
+
+    @classmethod
+    def from_dicts(cls, dataset_dicts):
+        buffers = [pickle.dumps(d, protocol=pickle.HIGHEST_PROTOCOL) for d in dataset_dicts]
+        offsets = np.zeros(len(buffers) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in buffers], out=offsets[1:])
+        blob = np.frombuffer(b"".join(buffers), dtype=np.uint8)
+        columns = {
+            k: np.asarray([d[k] for d in dataset_dicts], dtype=np.int64)
+            for k in _COLUMNS
+            if len(dataset_dicts) and all(k in d for d in dataset_dicts)
+        }
+        logging.getLogger(__name__).info(
+            "Serialized {} dataset dicts into {:.2f} MiB".format(len(buffers), blob.nbytes / 1024 ** 2)
+        )
+        return cls(blob, offsets, columns)
+
+    def save(self, path):
+        """
+        Writes the store to the directory `path`, as .npy files that :meth:`load` memory-maps.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "blob.npy"), self._blob)
+        np.save(os.path.join(path, "offsets.npy"), self._offsets)
+        for k, v in self._columns.items():
+            np.save(os.path.join(path, f"column_{k}.npy"), v)
+
+    @classmethod
+    def load(cls, path):
+        blob = np.load(os.path.join(path, "blob.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        columns = {
+            f[len("column_"):-len(".npy")]: np.load(os.path.join(path, f), mmap_mode="r")
+            for f in os.listdir(path)
+            if f.startswith("column_")
+        }
+        return cls(blob, offsets, columns)
+
+    def memory_mapped(self):
+        """
+        Returns the same store backed by an anonymous memory-mapped file, so its pages are never
+        private to a process. The file is unlinked right away; the mapping lives as long as the store.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix="dataset_dicts_")
+        try:
+            self.save(tmp_dir)
+            return self.load(tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def column(self, key):
+        """
+        Returns the int64 array of a per-image field, e.g. "dataset_source", or None if it is not stored.
+        """
+        return self._columns.get(key)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        # a slice returns a list of dicts, as for the list this replaces
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        idx = operator.index(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("dataset dict index out of range")
+        start, end = int(self._offsets[idx]), int(self._offsets[idx + 1])
+        return pickle.loads(memoryview(self._blob[start:end]))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
@@ -1,14 +1,19 @@
 # Copyright (c) 2024 ByteDance. All Rights Reserved.
 # Part of the code is from https://github.com/xingyizhou/UniDet/blob/master/projects/UniDet/unidet/data/multi_dataset_dataloader.py (Apache-2.0 License)
 import copy
+import hashlib
 import logging
+import os
+import shutil
+import time
 import numpy as np
 import operator
+import heapq
 import torch
 import torch.utils.data
 import json
 from detectron2.utils.comm import get_world_size
-from detectron2.utils.logger import _log_api_usage, log_first_n
+from detectron2.utils.logger import _log_api_usage, log_every_n_seconds, log_first_n
 
 from detectron2.config import configurable
 from detectron2.data import samplers
@@ -28,6 +33,8 @@ import math
 from collections import defaultdict
 from typing import Optional
 
+from .compact_dataset import CompactDatasetDicts
+
 
 def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=None):
     sampler_name = cfg.DATALOADER.SAMPLER_TRAIN # "MultiDatasetSampler"
@@ -38,6 +45,7 @@ def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=
             min_keypoints=cfg.MODEL.ROI_KEYPOINT_HEAD.MIN_KEYPOINTS_PER_IMAGE
             if cfg.MODEL.KEYPOINT_ON else 0,
             proposal_files=cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None,
+            cache_dir=cfg.DATALOADER.DATASET_CACHE_DIR,
         )
     else: # False
         dataset_dicts = get_detection_dataset_dicts(
@@ -71,6 +79,10 @@ def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=
     else:
         raise ValueError("Unknown training sampler: {}".format(sampler_name))
 
+    if cfg.DATALOADER.COMPACT_DATASET_DICTS and not isinstance(dataset_dicts, CompactDatasetDicts):
+        # the samplers above are built, from now on the dicts are only read by index
+        dataset_dicts = CompactDatasetDicts.from_dicts(dataset_dicts).memory_mapped()
+
     return {
         "dataset": dataset_dicts,
         "sampler": sampler,
@@ -81,7 +93,10 @@ def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=
         'multi_dataset_grouping': cfg.DATALOADER.MULTI_DATASET_GROUPING, # True
         'use_diff_bs_size': cfg.DATALOADER.USE_DIFF_BS_SIZE, # True
         'dataset_bs': cfg.DATALOADER.DATASET_BS, # [8, 32]
-        'num_datasets': len(cfg.DATASETS.TRAIN) # 2
+        'num_datasets': len(cfg.DATASETS.TRAIN), # 2
+        'size_bucketing': cfg.DATALOADER.SIZE_BUCKETING,
+        'size_bucket_quantum': cfg.DATALOADER.SIZE_BUCKET_QUANTUM,
+        'size_bucket_max_wait': cfg.DATALOADER.SIZE_BUCKET_MAX_WAIT,
     }
 
 
@@ -94,7 +109,10 @@ def build_custom_train_loader(
         num_datasets=1, # 2
         multi_dataset_grouping=False, # True
         use_diff_bs_size=False, # True
-        dataset_bs=[] # [8, 32]
+        dataset_bs=[], # [8, 32]
+        size_bucketing=False,
+        size_bucket_quantum=128,
+        size_bucket_max_wait=64,
     ):
     """
     Modified from detectron2.data.build.build_custom_train_loader, but supports
@@ -116,6 +134,9 @@ def build_custom_train_loader(
             total_batch_size,
             num_datasets=num_datasets,
             num_workers=num_workers,
+            size_bucketing=size_bucketing,
+            size_bucket_quantum=size_bucket_quantum,
+            size_bucket_max_wait=size_bucket_max_wait,
         )
     else: # False
         return build_batch_data_loader(
@@ -129,7 +150,8 @@ def build_custom_train_loader(
 
 def build_multi_dataset_batch_data_loader(
     use_diff_bs_size, dataset_bs,
-    dataset, sampler, total_batch_size, num_datasets, num_workers=0
+    dataset, sampler, total_batch_size, num_datasets, num_workers=0,
+    size_bucketing=False, size_bucket_quantum=128, size_bucket_max_wait=64,
 ):
     """
     """
@@ -149,6 +171,10 @@ def build_multi_dataset_batch_data_loader(
         collate_fn=operator.itemgetter(0),  # don't batch, but yield individual elements
         worker_init_fn=worker_init_reset_seed,
     )  # yield individual mapped dict
+    if size_bucketing:
+        batch_sizes = dataset_bs if use_diff_bs_size else [batch_size] * num_datasets
+        return MDSizeGroupedDataset(
+            data_loader, batch_sizes, num_datasets, size_bucket_quantum, size_bucket_max_wait)
     if use_diff_bs_size:
         return DIFFMDAspectRatioGroupedDataset(
             data_loader, dataset_bs, num_datasets)
@@ -157,10 +183,54 @@ def build_multi_dataset_batch_data_loader(
             data_loader, batch_size, num_datasets)
 
 
+# bump when the layout of the cached dataset dicts changes
+_DATASET_CACHE_VERSION = 1
+# metadata fields pointing at the annotations a registered dataset is loaded from
+_ANNOTATION_FIELDS = ("json_file", "panoptic_json", "panoptic_root", "sem_seg_root")
+
+
+def _dataset_cache_key(dataset_names, filter_empty, min_keypoints):
+    """
+    Hash of everything the filtered dataset dicts depend on: the dataset names, the
+    filter settings and the size and mtime of the annotation files of every dataset.
+    """
+    key = [_DATASET_CACHE_VERSION, list(dataset_names), filter_empty, min_keypoints]
+    for dataset_name in dataset_names:
+        meta = MetadataCatalog.get(dataset_name)
+        for field in _ANNOTATION_FIELDS:
+            path = getattr(meta, field, None)
+            if path is None:
+                continue
+            # hashing the content of a multi-GB json would cost as much as parsing it
+            stat = os.stat(path) if os.path.exists(path) else None
+            key.append((field, path, stat.st_size if stat else None, stat.st_mtime if stat else None))
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+
 def get_detection_dataset_dicts_with_source(
-    dataset_names, filter_empty=True, min_keypoints=0, proposal_files=None
+    dataset_names, filter_empty=True, min_keypoints=0, proposal_files=None, cache_dir=None
 ):
+    """
+    Args:
+        cache_dir (str or None): if given, the filtered dataset dicts are cached there as a
+            memory-mapped :class:`CompactDatasetDicts`, keyed by the annotation files and the
+            filter settings, and returned from the cache on the next runs.
+    """
     assert len(dataset_names)
+    logger = logging.getLogger(__name__)
+    start_time = time.perf_counter()
+    if cache_dir:
+        cache_path = os.path.join(
+            cache_dir, _dataset_cache_key(dataset_names, filter_empty, min_keypoints)
+        )
+        if os.path.isdir(cache_path):
+            dataset_dicts = CompactDatasetDicts.load(cache_path)
+            logger.info(
+                "Loaded {} cached dataset dicts of {} from {} in {:.2f}s".format(
+                    len(dataset_dicts), dataset_names, cache_path, time.perf_counter() - start_time
+                )
+            )
+            return dataset_dicts
     dataset_dicts = [DatasetCatalog.get(dataset_name) for dataset_name in dataset_names]
     for dataset_name, dicts in zip(dataset_names, dataset_dicts):
         assert len(dicts), "Dataset '{}' is empty!".format(dataset_name)
@@ -188,6 +258,27 @@ def get_detection_dataset_dicts_with_source(
         dataset_dicts = filter_images_with_only_crowd_annotations(dataset_dicts)
     if min_keypoints > 0 and has_instances:
         dataset_dicts = filter_images_with_few_keypoints(dataset_dicts, min_keypoints)
+    logger.info(
+        "Loaded {} dataset dicts of {} in {:.2f}s".format(
+            len(dataset_dicts), dataset_names, time.perf_counter() - start_time
+        )
+    )
+
+    if cache_dir:
+        dataset_dicts = CompactDatasetDicts.from_dicts(dataset_dicts)
+        if comm.is_main_process():
+            # other ranks may read the cache as soon as the directory appears, so it is renamed into place
+            tmp_path = "{}.tmp{}".format(cache_path, os.getpid())
+            dataset_dicts.save(tmp_path)
+            try:
+                os.rename(tmp_path, cache_path)
+                logger.info("Cached the dataset dicts in {}".format(cache_path))
+            except OSError:
+                # another run wrote the same cache meanwhile
+                shutil.rmtree(tmp_path)
+            dataset_dicts = CompactDatasetDicts.load(cache_path)
+        else:
+            dataset_dicts = dataset_dicts.memory_mapped()
 
     return dataset_dicts
 
@@ -204,9 +295,14 @@ class MultiDatasetSampler(Sampler):
         ):
         """
         """
+        if isinstance(dataset_dicts, CompactDatasetDicts):
+            # a cached store keeps the sources as an array, no need to unpickle every dict
+            dataset_sources = dataset_dicts.column('dataset_source')
+        else:
+            dataset_sources = [d['dataset_source'] for d in dataset_dicts]
         sizes = [0 for _ in range(len(dataset_ratio))]
-        for d in dataset_dicts:
-            sizes[d['dataset_source']] += 1 # size of each dataset
+        for source in dataset_sources:
+            sizes[source] += 1 # size of each dataset
         print('dataset sizes', sizes)
         self.sizes = sizes
         assert len(dataset_ratio) == len(sizes), \
@@ -219,9 +315,6 @@ class MultiDatasetSampler(Sampler):
         self._rank = comm.get_rank()
         self._world_size = comm.get_world_size()
         
-        self.dataset_ids =  torch.tensor(
-            [d['dataset_source'] for d in dataset_dicts], dtype=torch.long)
-
         dataset_weight = [torch.ones(s) * max(sizes) / s * r / sum(dataset_ratio) \
             for i, (r, s) in enumerate(zip(dataset_ratio, sizes))]
         dataset_weight = torch.cat(dataset_weight)
@@ -234,8 +327,9 @@ class MultiDatasetSampler(Sampler):
                     rfs_func = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency
                 else:
                     rfs_func = repeat_factors_from_tag_frequency
+                # materialized, the dicts may be a CompactDatasetDicts read by index (DATASET_CACHE_DIR)
                 rfs_factor = rfs_func(
-                    dataset_dicts[st: st + s],
+                    [dataset_dicts[j] for j in range(st, st + s)],
                     repeat_thresh=repeat_threshold)
                 rfs_factor = rfs_factor * (s / rfs_factor.sum())
             else:
@@ -246,23 +340,44 @@ class MultiDatasetSampler(Sampler):
 
         self.weights = dataset_weight * rfs_factors # weights for each element in the dataset_dict
         self.sample_epoch_size = len(self.weights)
+        self._prob, self._alias = _build_alias_table(self.weights)
 
     def __iter__(self):
-        start = self._rank
-        yield from itertools.islice(
-            self._infinite_indices(), start, None, self._world_size) # itertools.islice(iterable, start, stop[, step])
-
+        yield from self._infinite_indices()
 
     def _infinite_indices(self):
+        # samples are drawn with replacement, so every rank can draw its own share of each
+        # epoch independently; seeding with the rank keeps the ranks' streams distinct
         g = torch.Generator()
-        g.manual_seed(self._seed)
+        g.manual_seed(self._seed + self._rank)
+        num_per_rank = max(self.sample_epoch_size // self._world_size, 1)
         while True:
-            ids = torch.multinomial(
-                self.weights, self.sample_epoch_size, generator=g, 
-                replacement=True) # randomly sample according to the given weights
-            nums = [(self.dataset_ids[ids] == i).sum().int().item() \
-                for i in range(len(self.sizes))]
-            yield from ids
+            # alias method: O(1) per sample, whatever the dataset size
+            ids = torch.randint(self.sample_epoch_size, (num_per_rank,), generator=g)
+            keep = torch.rand(num_per_rank, generator=g, dtype=torch.float64) < self._prob[ids]
+            yield from torch.where(keep, ids, self._alias[ids])
+
+
+def _build_alias_table(weights):
+    """
+    Builds the tables of Vose's alias method, to sample from the categorical distribution
+    given by `weights` in O(1): draw a uniform index i, keep it with probability prob[i]
+    and take alias[i] otherwise.
+    """
+    n = len(weights)
+    prob = weights.double().numpy() * (n / float(weights.double().sum()))
+    alias = np.arange(n)
+    small = [i for i in range(n) if prob[i] < 1.0]
+    large = [i for i in range(n) if prob[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] -= 1.0 - prob[s]
+        (small if prob[l] < 1.0 else large).append(l)
+    # the remaining ones are 1 up to rounding errors
+    for i in small + large:
+        prob[i] = 1.0
+    return torch.from_numpy(prob), torch.from_numpy(alias)
 
 
 class MDAspectRatioGroupedDataset(torch.utils.data.IterableDataset):
@@ -305,6 +420,84 @@ class DIFFMDAspectRatioGroupedDataset(torch.utils.data.IterableDataset):
                 del bucket[:]
 
 
+class MDSizeGroupedDataset(torch.utils.data.IterableDataset):
+    """
+    Groups the mapped images of each dataset source into batches of similar size,
+    bucketed by their (height, width) quantized to `size_quantum` pixels, so that
+    :meth:`ImageList.from_tensors` pads less than with the w > h split above.
+
+    A bucket may fill slowly; once the oldest pending image of a dataset source has
+    waited for `max_wait` images, its bucket is completed with the pending images of
+    that source closest in size, so every image is batched after a bounded delay.
+    """
+
+    def __init__(self, dataset, batch_sizes, num_datasets, size_quantum=128, max_wait=64):
+        """
+        Args:
+            dataset: an iterable of mapped dicts with "image" and "dataset_source".
+            batch_sizes (list[int]): the batch size of each dataset source.
+            num_datasets (int): number of dataset sources.
+            size_quantum (int): bucket granularity in pixels.
+            max_wait (int): how many images may arrive after an image before it is batched.
+        """
+        self.dataset = dataset
+        self.batch_sizes = batch_sizes
+        self.size_quantum = size_quantum
+        self.max_wait = max_wait
+        # per dataset source: bucket key -> pending (arrival index, dict)
+        self._buckets = [defaultdict(list) for _ in range(num_datasets)]
+        self._useful_pixels = 0
+        self._padded_pixels = 0
+
+    def _bucket_key(self, d):
+        h, w = d["image"].shape[-2:]
+        return (-(-h // self.size_quantum), -(-w // self.size_quantum))
+
+    def __iter__(self):
+        for arrival, d in enumerate(self.dataset):
+            source = d['dataset_source']
+            buckets = self._buckets[source]
+            key = self._bucket_key(d)
+            buckets[key].append((arrival, d))
+            if len(buckets[key]) == self.batch_sizes[source]:
+                yield self._emit(buckets.pop(key))
+                continue
+            # bounded wait: complete the bucket of the oldest pending image of this source
+            oldest_key = min(buckets, key=lambda k: buckets[k][0][0])
+            if arrival - buckets[oldest_key][0][0] >= self.max_wait and \
+                    sum(len(b) for b in buckets.values()) >= self.batch_sizes[source]:
+                yield self._emit(self._fill(buckets, oldest_key, self.batch_sizes[source]))
+
+    def _fill(self, buckets, key, batch_size):
+        batch = buckets.pop(key)
+        # take the missing images from the buckets closest in size
+        for other in sorted(buckets, key=lambda k: abs(k[0] - key[0]) + abs(k[1] - key[1])):
+            take = batch_size - len(batch)
+            if take == 0:
+                break
+            batch.extend(buckets[other][:take])
+            del buckets[other][:take]
+            if not buckets[other]:
+                del buckets[other]
+        return batch
+
+    def _emit(self, bucket):
+        batch = [d for _, d in bucket]
+        sizes = [d["image"].shape[-2:] for d in batch]
+        useful = sum(h * w for h, w in sizes)
+        padded = len(sizes) * max(h for h, _ in sizes) * max(w for _, w in sizes)
+        self._useful_pixels += useful
+        self._padded_pixels += padded
+        log_every_n_seconds(
+            logging.INFO,
+            "Padding efficiency (useful / padded pixels): batch {:.3f}, running {:.3f}".format(
+                useful / padded, self._useful_pixels / self._padded_pixels
+            ),
+            n=60,
+        )
+        return batch
+
+
 def repeat_factors_from_tag_frequency(dataset_dicts, repeat_thresh):
     """
     """
@@ -328,4 +521,84 @@ def repeat_factors_from_tag_frequency(dataset_dicts, repeat_thresh):
         rep_factor = max({category_rep[cat_id] for cat_id in cat_ids}, default=1.0)
         rep_factors.append(rep_factor)
 
-    return torch.tensor(rep_factors, dtype=torch.float32)
\ No newline at end of file
+    return torch.tensor(rep_factors, dtype=torch.float32)
+
+def _estimate_inference_cost(dataset_dict):
+    """
+    Estimated inference cost of one image: its pixel count times the number of masks
+    that will be classified (1 when the annotations are not known before loading).
+    """
+    if "vocabularies" in dataset_dict:
+        # a merged multi-vocabulary record: one image, classified once per vocabulary
+        vocab_dicts = list(dataset_dict["vocabularies"].values())
+        height, width = _image_size(vocab_dicts[0])
+        return height * width * sum(_expected_num_masks(d) for d in vocab_dicts)
+    height, width = _image_size(dataset_dict)
+    return height * width * _expected_num_masks(dataset_dict)
+
+
+def _image_size(dataset_dict):
+    if "height" in dataset_dict and "width" in dataset_dict:
+        return dataset_dict["height"], dataset_dict["width"]
+    # semantic segmentation datasets do not record the image size, only the header is read
+    from PIL import Image
+    from detectron2.utils.file_io import PathManager
+
+    with PathManager.open(dataset_dict["file_name"], "rb") as f:
+        width, height = Image.open(f).size
+    return height, width
+
+
+def _expected_num_masks(dataset_dict):
+    for key in ("segments_info", "annotations"):
+        if key in dataset_dict:
+            return max(len(dataset_dict[key]), 1)
+    return 1
+
+
+class SizeBalancedInferenceSampler(Sampler):
+    """
+    Produce indices for inference across all workers, like detectron2's
+    :class:`InferenceSampler`, but instead of contiguous shards of equal length
+    the shards have a similar estimated cost (pixels x expected masks), so that
+    ranks given high-resolution images do not keep the others waiting.
+
+    Images are assigned greedily, most expensive first, to the rank with the least
+    total cost so far. Every rank computes the same assignment from the dataset dicts.
+    """
+
+    def __init__(self, dataset_dicts):
+        """
+        Args:
+            dataset_dicts (list[dict]): the dataset dicts that will be evaluated.
+        """
+        self._rank = comm.get_rank()
+        self._world_size = comm.get_world_size()
+
+        costs = [_estimate_inference_cost(d) for d in dataset_dicts]
+        shards = [[] for _ in range(self._world_size)]
+        loads = [(0, rank) for rank in range(self._world_size)]
+        for idx in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+            load, rank = heapq.heappop(loads)
+            shards[rank].append(idx)
+            heapq.heappush(loads, (load + costs[idx], rank))
+        # keep the dataset order inside a shard
+        self._local_indices = sorted(shards[self._rank])
+
+        shard_costs = sorted(loads, key=operator.itemgetter(1))
+        logger = logging.getLogger(__name__)
+        logger.info(
+            "Size-balanced inference shards: {} images and {:.3g} estimated cost on rank {} "
+            "(max / mean cost over ranks: {:.3f})".format(
+                len(self._local_indices),
+                shard_costs[self._rank][0],
+                self._rank,
+                max(c for c, _ in shard_costs) / max(sum(costs) / self._world_size, 1),
+            )
+        )
+
+    def __iter__(self):
+        yield from self._local_indices
+
+    def __len__(self):
+        return len(self._local_indices)
@@ -20,6 +20,8 @@ from detectron2.projects.point_rend import ColorAugSSDTransform
 from detectron2.structures import BitMasks, Instances, polygons_to_bitmask, BoxMode,Boxes
 from PIL import Image
 
+from ...utils.mask_packing import pack_bitmasks
+
 __all__ = ["COCOCombineNewBaselineDatasetMapper"]
 
 
@@ -44,6 +46,7 @@ class COCOCombineNewBaselineDatasetMapper:
         augmentations,
         image_format,
         size_divisibility,
+        pack_masks=False,
     ):
         """
         NOTE: this interface is experimental.
@@ -52,11 +55,14 @@ class COCOCombineNewBaselineDatasetMapper:
             augmentations: a list of augmentations or deterministic transforms to apply
             image_format: an image format supported by :func:`detection_utils.read_image`.
             size_divisibility: pad image size to be divisible by this value
+            pack_masks: send the instance masks bit-packed in "gt_masks_packed" instead of
+                as "gt_masks", they are unpacked on the device by the model
         """
         self.is_train = is_train
         self.tfm_gens = augmentations
         self.img_format = image_format
         self.size_divisibility = size_divisibility
+        self.pack_masks = pack_masks
 
         
         logger = logging.getLogger(__name__)
@@ -94,6 +100,7 @@ class COCOCombineNewBaselineDatasetMapper:
             "augmentations": augmentation,
             "image_format": cfg.INPUT.FORMAT,
             "size_divisibility": cfg.INPUT.SIZE_DIVISIBILITY,
+            "pack_masks": cfg.INPUT.PACK_MASKS,
         }
         return ret
 
@@ -223,7 +230,14 @@ class COCOCombineNewBaselineDatasetMapper:
         instances.gt_classes = classes
         
         #boxes = np.zeros((0, 4))
-        if len(masks) == 0:
+        if self.pack_masks:
+            # 1 bit per pixel through the dataloader shared memory, unpacked in prepare_targets
+            if len(masks) == 0:
+                masks = torch.zeros((0, image.shape[-2], image.shape[-1]), dtype=torch.bool)
+            else:
+                masks = torch.stack(masks)
+            instances.gt_masks_packed = pack_bitmasks(masks)
+        elif len(masks) == 0:
             # Some image does not have annotation (all ignored)
             instances.gt_masks = torch.zeros((0, image.shape[-2], image.shape[-1]))
         else:
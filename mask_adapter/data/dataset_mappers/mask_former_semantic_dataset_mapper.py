@@ -19,6 +19,9 @@ from detectron2.data import transforms as T
 from detectron2.projects.point_rend import ColorAugSSDTransform
 from detectron2.structures import BitMasks, Instances
 
+from ...utils.mask_packing import pack_bitmasks
+from ...utils.misc import sem_seg_to_masks
+
 __all__ = ["MaskFormerSemanticDatasetMapper"]
 # don't need to in this case, but just use conventional expression
 
@@ -53,6 +56,7 @@ class MaskFormerSemanticDatasetMapper:
         image_format,
         ignore_label,
         size_divisibility,
+        pack_masks=False,
     ):
         """
         NOTE: this interface is experimental.
@@ -62,12 +66,15 @@ class MaskFormerSemanticDatasetMapper:
             image_format: an image format supported by :func:`detection_utils.read_image`.
             ignore_label: the label that is ignored to evaluation
             size_divisibility: pad image size to be divisible by this value
+            pack_masks: send the per-class masks bit-packed in "gt_masks_packed" instead of
+                as "gt_masks", they are unpacked on the device by the model
         """
         self.is_train = is_train
         self.tfm_gens = augmentations
         self.img_format = image_format
         self.ignore_label = ignore_label
         self.size_divisibility = size_divisibility
+        self.pack_masks = pack_masks
 
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
@@ -133,6 +140,7 @@ class MaskFormerSemanticDatasetMapper:
             "image_format": cfg.INPUT.FORMAT, # image format to read the image, e.g., "RGB", "BGR"
             "ignore_label": ignore_label, # the label that is ignored to evaluation, usually 255 for semantic segmentation
             "size_divisibility": cfg.INPUT.SIZE_DIVISIBILITY, # pad image size to be divisible by this value
+            "pack_masks": cfg.INPUT.PACK_MASKS, # ship the masks bit-packed, the model unpacks them
         }
         return ret
 
@@ -204,25 +212,16 @@ class MaskFormerSemanticDatasetMapper:
 
         # Prepare per-category binary masks
         if sem_seg_gt is not None:
-            sem_seg_gt = sem_seg_gt.numpy()
             instances = Instances(image_shape)
-            classes = np.unique(sem_seg_gt)
-            # remove ignored region
-            classes = classes[classes != self.ignore_label]
-            instances.gt_classes = torch.tensor(classes, dtype=torch.int64)
-
-            masks = []
-            for class_id in classes:
-                masks.append(sem_seg_gt == class_id)
-
-            if len(masks) == 0:
-                # Some image does not have annotation (all ignored)
-                instances.gt_masks = torch.zeros((0, sem_seg_gt.shape[-2], sem_seg_gt.shape[-1]))
-            else:
-                masks = BitMasks(
-                    torch.stack([torch.from_numpy(np.ascontiguousarray(x.copy())) for x in masks])
-                )
-                instances.gt_masks = masks.tensor
+            # classes without the ignored region, and their masks
+            classes, masks = sem_seg_to_masks(sem_seg_gt, self.ignore_label)
+            instances.gt_classes = classes
+            instances.gt_masks = masks
+
+            if self.pack_masks:
+                # 1 bit per pixel through the dataloader shared memory, unpacked in prepare_targets
+                instances.gt_masks_packed = pack_bitmasks(instances.gt_masks)
+                instances.remove("gt_masks")
 
             dataset_dict["instances"] = instances
 
@@ -0,0 +1,130 @@
+"""
+Copyright (2023) Bytedance Ltd. and/or its affiliates
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import copy
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from detectron2.config import configurable
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+
+__all__ = ["group_datasets_by_images", "merge_vocabulary_dataset_dicts", "MultiVocabTestDatasetMapper"]
+
+
+def _image_key(dataset_dict):
+    # ADE-150 and A-847 keep the same validation images in different directories
+    # (and PC-59 / PC-459 in the same one), so images are matched by their basename
+    return os.path.splitext(os.path.basename(dataset_dict["file_name"]))[0]
+
+
+def group_datasets_by_images(dataset_names):
+    """
+    Groups the semantic segmentation datasets that are evaluated on exactly the same set
+    of images. Every other dataset (e.g. a panoptic or instance split of the same images)
+    is a group of its own, since :class:`MultiVocabTestDatasetMapper` only loads "sem_seg".
+
+    Args:
+        dataset_names (list[str]): registered dataset names, e.g. cfg.DATASETS.TEST.
+
+    Returns:
+        list[list[str]]: the groups, in the order of their first dataset in `dataset_names`.
+    """
+    groups = OrderedDict()
+    for name in dataset_names:
+        dataset_dicts = DatasetCatalog.get(name)
+        if MetadataCatalog.get(name).get("evaluator_type") == "sem_seg" and all(
+            "sem_seg_file_name" in d for d in dataset_dicts
+        ):
+            key = frozenset(_image_key(d) for d in dataset_dicts)
+        else:
+            key = name
+        groups.setdefault(key, []).append(name)
+    return list(groups.values())
+
+
+def merge_vocabulary_dataset_dicts(dataset_names):
+    """
+    Merges the dataset dicts of datasets sharing their images into one record per image:
+    {"file_name": ..., "vocabularies": {dataset_name: dataset_dict}}.
+    The image of the first dataset is the one that is read.
+    """
+    per_dataset = [{_image_key(d): d for d in DatasetCatalog.get(name)} for name in dataset_names]
+    merged = []
+    for key, record in per_dataset[0].items():
+        merged.append({
+            "file_name": record["file_name"],
+            "image_id": record.get("image_id", key),
+            "vocabularies": OrderedDict(
+                (name, records[key]) for name, records in zip(dataset_names, per_dataset)
+            ),
+        })
+    return merged
+
+
+class MultiVocabTestDatasetMapper:
+    """
+    A callable which takes a record of :func:`merge_vocabulary_dataset_dicts`, reads
+    and transforms the image once and applies the same transforms to the semantic
+    segmentation ground truth of every vocabulary.
+
+    The image goes to "image" of the returned dict, every vocabulary gets its own
+    input dict under "vocabularies" with "sem_seg", "height" and "width".
+    """
+
+    @configurable
+    def __init__(self, *, augmentations, image_format):
+        """
+        Args:
+            augmentations: a list of deterministic transforms to apply
+            image_format: an image format supported by :func:`detection_utils.read_image`.
+        """
+        self.augmentations = augmentations
+        self.image_format = image_format
+
+        logger = logging.getLogger(__name__)
+        logger.info(f"[{self.__class__.__name__}] Augmentations used in inference: {augmentations}")
+
+    @classmethod
+    def from_config(cls, cfg):
+        return {
+            "augmentations": utils.build_augmentation(cfg, False),
+            "image_format": cfg.INPUT.FORMAT,
+        }
+
+    def __call__(self, dataset_dict):
+        dataset_dict = copy.deepcopy(dataset_dict)
+        image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
+        height, width = image.shape[:2]
+
+        aug_input = T.AugInput(image)
+        transforms = T.AugmentationList(self.augmentations)(aug_input)
+        image = aug_input.image
+        image_shape = image.shape[:2]
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+        for vocab_dict in dataset_dict["vocabularies"].values():
+            vocab_dict["height"], vocab_dict["width"] = height, width
+            sem_seg_gt = utils.read_image(vocab_dict.pop("sem_seg_file_name"), "L").squeeze(2)
+            sem_seg_gt = transforms.apply_segmentation(sem_seg_gt)
+            assert sem_seg_gt.shape == image_shape, "{} does not match the image".format(vocab_dict["file_name"])
+            vocab_dict["sem_seg"] = torch.as_tensor(sem_seg_gt.astype("long"))
+        return dataset_dict
+
@@ -31,10 +31,7 @@ from . import (
     openseg_classes
 )
 
-from .class_list import (
-    ade_common_ids,
-    ade_only_ids,
-)
+from .class_split import get_seen_unseen_ids
 
 #from .register_grand_data import register_all_grand
 # from .register_objects365 import register_all_obj365v1
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+Copyright (2023) Bytedance Ltd. and/or its affiliates
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from detectron2.data import MetadataCatalog
+from detectron2.utils.file_io import PathManager
+
+__all__ = ["get_seen_unseen_ids"]
+
+_DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mask_adapter", "class_split")
+
+
+def _class_synonyms(dataset_name):
+    meta = MetadataCatalog.get(dataset_name)
+    # sem_seg / panoptic datasets list every class in stuff_classes, instance datasets only have thing_classes
+    classes = meta.stuff_classes if hasattr(meta, "stuff_classes") else meta.thing_classes
+    # every class name is a comma separated list of synonyms, as in MASK_Adapter.prepare_class_names_from_metadata
+    return [[name.strip().lower() for name in c.split(",")] for c in classes]
+
+
+@functools.lru_cache(maxsize=None)
+def get_seen_unseen_ids(train_dataset_name, test_dataset_name, cache_dir=_DEFAULT_CACHE_DIR):
+    """
+    Splits the classes of a test dataset into the ones seen during training, i.e. sharing
+    at least one synonym with a class of the training vocabulary, and the unseen ones.
+
+    The split is computed from the MetadataCatalog on first use and cached in memory and
+    in `cache_dir`, keyed by a hash of both vocabularies.
+
+    Args:
+        train_dataset_name (str): dataset defining the training vocabulary, e.g. cfg.DATASETS.TRAIN[0].
+        test_dataset_name (str): the evaluated dataset.
+        cache_dir (str or None): directory of the on-disk cache, None disables it.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the contiguous ids of the seen and of the unseen test classes.
+    """
+    train_classes = _class_synonyms(train_dataset_name)
+    test_classes = _class_synonyms(test_dataset_name)
+
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1(json.dumps([train_classes, test_classes]).encode("utf-8")).hexdigest()
+        cache_file = os.path.join(cache_dir, f"{test_dataset_name}_{key[:16]}.json")
+        if PathManager.exists(cache_file):
+            with PathManager.open(cache_file, "r") as f:
+                split = json.load(f)
+            return np.asarray(split["seen"], dtype=np.int64), np.asarray(split["unseen"], dtype=np.int64)
+
+    train_names = {name for synonyms in train_classes for name in synonyms}
+    seen = [i for i, synonyms in enumerate(test_classes) if not train_names.isdisjoint(synonyms)]
+    seen_set = set(seen)
+    unseen = [i for i in range(len(test_classes)) if i not in seen_set]
+    logging.getLogger(__name__).info(
+        "{}: {} classes seen in {}, {} unseen".format(
+            test_dataset_name, len(seen), train_dataset_name, len(unseen)
+        )
+    )
+
+    if cache_file is not None:
+        try:
+            PathManager.mkdirs(cache_dir)
+            with PathManager.open(cache_file, "w") as f:
+                json.dump({"seen": seen, "unseen": unseen}, f)
+        except OSError:
+            # the cache is only an optimization, e.g. a read-only home directory is fine
+            pass
+    return np.asarray(seen, dtype=np.int64), np.asarray(unseen, dtype=np.int64)
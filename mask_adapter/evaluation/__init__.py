@@ -13,4 +13,6 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and 
 limitations under the License. 
 """
-from .sem_seg_evaluation import SeenUnseenSemSegEvaluator
\ No newline at end of file
+from .sem_seg_evaluation import SeenUnseenSemSegEvaluator
+from .evaluator import EvalStateCheckpointer, inference_on_dataset
+from .multi_vocab_evaluation import MultiVocabEvaluator
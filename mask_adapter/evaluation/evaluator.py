@@ -0,0 +1,305 @@
+"""
+This file may have been modified by Bytedance Ltd. and/or its affiliates.
+All Bytedance's Modifications are Copyright (year) Bytedance Ltd. and/or its affiliates.
+
+Reference: https://github.com/facebookresearch/detectron2/blob/main/detectron2/evaluation/evaluator.py
+"""
+import datetime
+import glob
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import abc
+from contextlib import ExitStack
+
+import torch
+from torch import nn
+
+from detectron2.evaluation import DatasetEvaluators
+from detectron2.evaluation.evaluator import inference_context
+from detectron2.utils.comm import all_gather, get_rank, get_world_size, is_main_process, synchronize
+from detectron2.utils.file_io import PathManager
+from detectron2.utils.logger import log_every_n_seconds
+
+
+# accumulators of the detectron2 evaluators that do not implement `state_dict`
+_ACCUMULATORS = ("_conf_matrix", "_b_conf_matrix", "_predictions")
+
+
+def get_evaluator_state(evaluator):
+    """
+    Returns the accumulated state of an evaluator. Evaluators that implement
+    `state_dict` are asked for it, for the detectron2 ones the known accumulators are saved.
+    """
+    if isinstance(evaluator, DatasetEvaluators):
+        return [get_evaluator_state(e) for e in evaluator._evaluators]
+    if hasattr(evaluator, "state_dict"):
+        return evaluator.state_dict()
+    return {k: getattr(evaluator, k) for k in _ACCUMULATORS if hasattr(evaluator, k)}
+
+
+def load_evaluator_state(evaluator, state):
+    """
+    Accumulates a state returned by :func:`get_evaluator_state` into `evaluator`.
+    """
+    if isinstance(evaluator, DatasetEvaluators):
+        assert len(state) == len(evaluator._evaluators)
+        for e, s in zip(evaluator._evaluators, state):
+            load_evaluator_state(e, s)
+    elif hasattr(evaluator, "load_state_dict"):
+        evaluator.load_state_dict(state)
+    else:
+        for k, v in state.items():
+            if isinstance(v, list):
+                getattr(evaluator, k).extend(v)
+            else:
+                setattr(evaluator, k, getattr(evaluator, k) + v)
+
+
+class EvalStateCheckpointer:
+    """
+    Periodically saves the evaluator state and the inputs processed by this rank,
+    so that an interrupted evaluation can continue from where it stopped.
+
+    Every rank writes its own `{dataset_name}_{identity hash}_rank{rank}.pth` file. When
+    resuming, the inputs recorded in all files are skipped and every rank merges the states
+    of the files assigned to it, so the world size may change between runs. The files of
+    another identity (e.g. the evaluation of other weights) are ignored and removed.
+    """
+
+    def __init__(self, save_dir, dataset_name, period, identity=""):
+        """
+        Args:
+            save_dir (str): directory holding the state files. It must be shared by all ranks.
+            dataset_name (str): name of the evaluated dataset.
+            period (int): save the state every `period` batches.
+            identity (str): what is evaluated, e.g. the weights and the training iteration.
+                Only the states saved with the same identity are resumed.
+        """
+        self._logger = logging.getLogger(__name__)
+        self.save_dir = save_dir
+        self.dataset_name = dataset_name
+        self.period = period
+        self.identity = identity
+        self._digest = hashlib.sha1(identity.encode()).hexdigest()[:8]
+        self._processed = []
+        self._merged_files = []
+        self._num_steps = 0
+
+    @staticmethod
+    def input_key(input):
+        # works for both dataset dicts and the model inputs built from them
+        return input.get("image_id", input["file_name"])
+
+    def _state_files(self):
+        """
+        Returns the (rank, path) of the state files saved with this identity, sorted by rank.
+        The main process removes the files of other identities.
+        """
+        # files without an identity hash were saved before it was recorded
+        pattern = re.compile(re.escape(self.dataset_name) + r"_(?:([0-9a-f]{8})_)?rank(\d+)\.pth$")
+        files = []
+        for path in glob.glob(os.path.join(self.save_dir, f"{self.dataset_name}_*rank*.pth")):
+            match = pattern.match(os.path.basename(path))
+            if not match:
+                continue
+            if match.group(1) == self._digest:
+                files.append((int(match.group(2)), path))
+            elif is_main_process():
+                self._logger.info("Removing {}, saved for another evaluation".format(path))
+                os.remove(path)
+        return sorted(files)
+
+    def _path(self, rank):
+        return os.path.join(self.save_dir, f"{self.dataset_name}_{self._digest}_rank{rank}.pth")
+
+    def _load_file(self, path):
+        with PathManager.open(path, "rb") as f:
+            return torch.load(f, map_location="cpu")
+
+    def processed_inputs(self):
+        """
+        Returns the keys of all inputs processed by any rank in a previous run.
+        """
+        processed = set()
+        for _, path in self._state_files():
+            processed.update(self._load_file(path)["processed"])
+        return processed
+
+    def load(self, evaluator):
+        """
+        Merges the saved states assigned to this rank into `evaluator`.
+        """
+        # every rank must have listed the processed inputs before any file is merged away
+        synchronize()
+        rank, world_size = get_rank(), get_world_size()
+        files = self._state_files()
+        # a rank keeps its own file, the files of the ranks of a previous, larger world size
+        # are spread over the current ranks
+        assigned = [path for file_rank, path in files if file_rank == rank]
+        leftovers = [path for file_rank, path in files if file_rank >= world_size]
+        assigned += leftovers[rank::world_size]
+        for path in assigned:
+            state = self._load_file(path)
+            load_evaluator_state(evaluator, state["evaluator"])
+            self._processed.extend(state["processed"])
+            self._merged_files.append(path)
+            self._logger.info(
+                "Resumed {} processed inputs of {} from {}".format(
+                    len(state["processed"]), self.dataset_name, path
+                )
+            )
+
+    def step(self, inputs, evaluator):
+        self._processed.extend(self.input_key(x) for x in inputs)
+        self._num_steps += 1
+        if self._num_steps % self.period == 0:
+            self.save(evaluator)
+
+    def save(self, evaluator):
+        PathManager.mkdirs(self.save_dir)
+        path = self._path(get_rank())
+        state = {
+            "identity": self.identity,
+            "processed": self._processed,
+            "evaluator": get_evaluator_state(evaluator),
+        }
+        # write to a temporary file first, a preemption must never leave a truncated state
+        with PathManager.open(path + ".tmp", "wb") as f:
+            torch.save(state, f)
+        os.replace(path + ".tmp", path)
+        # states of a previous, larger world size are now part of this rank's file
+        for merged in self._merged_files:
+            if merged != path:
+                os.remove(merged)
+        self._merged_files = []
+
+    def clear(self):
+        synchronize()
+        if is_main_process():
+            for _, path in self._state_files():
+                os.remove(path)
+
+
+def inference_on_dataset(model, data_loader, evaluator, eval_state=None):
+    """
+    Same as :func:`detectron2.evaluation.inference_on_dataset`, but optionally resumes
+    the evaluator state from `eval_state` and checkpoints it while running.
+
+    Args:
+        model (callable): a callable which takes an object from `data_loader` and returns some outputs.
+        data_loader: an iterable object with a length.
+        evaluator: the evaluator(s) to run.
+        eval_state (EvalStateCheckpointer or None): where to resume and save the evaluator state.
+            The data loader is expected to already skip the inputs processed before.
+
+    Returns:
+        The return value of `evaluator.evaluate()`
+    """
+    num_devices = get_world_size()
+    logger = logging.getLogger(__name__)
+    logger.info("Start inference on {} batches".format(len(data_loader)))
+
+    total = len(data_loader)  # inference data loader must have a fixed length
+    if evaluator is None:
+        # create a no-op evaluator
+        evaluator = DatasetEvaluators([])
+    if isinstance(evaluator, abc.MutableSequence):
+        evaluator = DatasetEvaluators(evaluator)
+    evaluator.reset()
+    if eval_state is not None:
+        eval_state.load(evaluator)
+
+    num_warmup = min(5, total - 1) if total > 0 else 0
+    start_time = time.perf_counter()
+    total_data_time = 0
+    total_compute_time = 0
+    total_eval_time = 0
+    with ExitStack() as stack:
+        if isinstance(model, nn.Module):
+            stack.enter_context(inference_context(model))
+        stack.enter_context(torch.no_grad())
+
+        start_data_time = time.perf_counter()
+        for idx, inputs in enumerate(data_loader):
+            total_data_time += time.perf_counter() - start_data_time
+            if idx == num_warmup:
+                start_time = time.perf_counter()
+                total_data_time = 0
+                total_compute_time = 0
+                total_eval_time = 0
+
+            start_compute_time = time.perf_counter()
+            outputs = model(inputs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            total_compute_time += time.perf_counter() - start_compute_time
+
+            start_eval_time = time.perf_counter()
+            evaluator.process(inputs, outputs)
+            if eval_state is not None:
+                eval_state.step(inputs, evaluator)
+            total_eval_time += time.perf_counter() - start_eval_time
+
+            iters_after_start = idx + 1 - num_warmup * int(idx >= num_warmup)
+            data_seconds_per_iter = total_data_time / iters_after_start
+            compute_seconds_per_iter = total_compute_time / iters_after_start
+            eval_seconds_per_iter = total_eval_time / iters_after_start
+            total_seconds_per_iter = (time.perf_counter() - start_time) / iters_after_start
+            if idx >= num_warmup * 2 or compute_seconds_per_iter > 5:
+                eta = datetime.timedelta(seconds=int(total_seconds_per_iter * (total - idx - 1)))
+                log_every_n_seconds(
+                    logging.INFO,
+                    (
+                        f"Inference done {idx + 1}/{total}. "
+                        f"Dataloading: {data_seconds_per_iter:.4f} s/iter. "
+                        f"Inference: {compute_seconds_per_iter:.4f} s/iter. "
+                        f"Eval: {eval_seconds_per_iter:.4f} s/iter. "
+                        f"Total: {total_seconds_per_iter:.4f} s/iter. "
+                        f"ETA={eta}"
+                    ),
+                    n=5,
+                )
+            start_data_time = time.perf_counter()
+
+    # Measure the time only for this worker (before the synchronization barrier)
+    total_time = time.perf_counter() - start_time
+    total_time_str = str(datetime.timedelta(seconds=total_time))
+    num_timed_iters = max(total - num_warmup, 1)
+    # NOTE this format is parsed by grep
+    logger.info(
+        "Total inference time: {} ({:.6f} s / iter per device, on {} devices)".format(
+            total_time_str, total_time / num_timed_iters, num_devices
+        )
+    )
+    total_compute_time_str = str(datetime.timedelta(seconds=int(total_compute_time)))
+    logger.info(
+        "Total inference pure compute time: {} ({:.6f} s / iter per device, on {} devices)".format(
+            total_compute_time_str, total_compute_time / num_timed_iters, num_devices
+        )
+    )
+    if num_devices > 1:
+        # the slowest rank decides when evaluate() can start, the others wait for it
+        rank_times = all_gather((total, total_time))
+        logger.info(
+            "Per-rank inference wall time: {} (slowest / fastest: {:.3f})".format(
+                ", ".join(
+                    "rank {}: {} batches in {:.1f}s".format(r, n, t) for r, (n, t) in enumerate(rank_times)
+                ),
+                max(t for _, t in rank_times) / max(min(t for _, t in rank_times), 1e-6),
+            )
+        )
+
+    if eval_state is not None:
+        # the state of the last, possibly partial, period must survive a crash inside evaluate()
+        eval_state.save(evaluator)
+    results = evaluator.evaluate()
+    if eval_state is not None:
+        eval_state.clear()
+    # An evaluator may return None when not in main process.
+    # Replace it by an empty dict instead to make it easier for downstream code to handle
+    if results is None:
+        results = {}
+    return results
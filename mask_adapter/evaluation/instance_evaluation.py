@@ -46,6 +46,15 @@ class InstanceSegEvaluator(COCOEvaluator):
     instance segmentation, or keypoint detection dataset.
     """
 
+    def state_dict(self):
+        return {"predictions": self._predictions}
+
+    def load_state_dict(self, state):
+        """
+        Accumulates a state returned by :meth:`state_dict` into the current one.
+        """
+        self._predictions.extend(state["predictions"])
+
     def _eval_predictions(self, predictions, img_ids=None):
         """
         Evaluate predictions. Fill self._results with the metrics of the tasks.
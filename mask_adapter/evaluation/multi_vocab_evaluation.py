@@ -0,0 +1,51 @@
+"""
+Copyright (2023) Bytedance Ltd. and/or its affiliates
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import OrderedDict
+
+from detectron2.evaluation import DatasetEvaluators
+from detectron2.utils.comm import is_main_process
+
+
+class MultiVocabEvaluator(DatasetEvaluators):
+    """
+    Evaluates several datasets sharing their images in one pass. Every input holds the
+    inputs of each dataset under "vocabularies" and every output the outputs of each
+    dataset under its name; they are dispatched to the evaluator of that dataset.
+    """
+
+    def __init__(self, dataset_names, evaluators):
+        """
+        Args:
+            dataset_names (list[str]): the datasets evaluated together.
+            evaluators (list[DatasetEvaluator]): the evaluator of each dataset.
+        """
+        assert len(dataset_names) == len(evaluators)
+        super().__init__(evaluators)
+        self._dataset_names = list(dataset_names)
+
+    def process(self, inputs, outputs):
+        for name, evaluator in zip(self._dataset_names, self._evaluators):
+            evaluator.process(
+                [x["vocabularies"][name] for x in inputs], [y[name] for y in outputs]
+            )
+
+    def evaluate(self):
+        results = OrderedDict()
+        for name, evaluator in zip(self._dataset_names, self._evaluators):
+            result = evaluator.evaluate()
+            if is_main_process() and result is not None:
+                results[name] = result
+        return results
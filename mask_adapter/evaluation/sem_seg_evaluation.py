@@ -15,9 +15,7 @@ from detectron2.utils.comm import all_gather, is_main_process, synchronize
 from detectron2.utils.file_io import PathManager
 
 from detectron2.evaluation import DatasetEvaluator
-from ..data.datasets.class_list import (
-    ade_common_ids,
-    ade_only_ids,)
+from ..data.datasets.class_split import get_seen_unseen_ids
 
 _CV2_IMPORTED = True
 try:
@@ -54,6 +52,7 @@ class SeenUnseenSemSegEvaluator(DatasetEvaluator):
         sem_seg_loading_fn=load_image_into_numpy_array, #corverts PIL Image of sem_segmentation GT to numpy array 
         num_classes=None,
         ignore_label=None,
+        train_dataset_name=None,
     ):
         """
         Args:
@@ -64,6 +63,8 @@ class SeenUnseenSemSegEvaluator(DatasetEvaluator):
             sem_seg_loading_fn: function to read sem seg file and load into numpy array.
                 Default provided, but projects can customize.
             num_classes, ignore_label: deprecated argument
+            train_dataset_name (str): dataset defining the training vocabulary. If given,
+                the mIoU of the test classes seen and unseen during training is also reported.
         """
         self._logger = logging.getLogger(__name__)
         if num_classes is not None:
@@ -77,6 +78,7 @@ class SeenUnseenSemSegEvaluator(DatasetEvaluator):
         self._dataset_name = dataset_name
         self._distributed = distributed
         self._output_dir = output_dir
+        self._train_dataset_name = train_dataset_name
 
         self._cpu_device = torch.device("cpu")
 
@@ -124,6 +126,22 @@ class SeenUnseenSemSegEvaluator(DatasetEvaluator):
         )
         self._predictions = []
 
+    def state_dict(self):
+        return {
+            "conf_matrix": self._conf_matrix,
+            "b_conf_matrix": self._b_conf_matrix,
+            "predictions": self._predictions,
+        }
+
+    def load_state_dict(self, state):
+        """
+        Accumulates a state returned by :meth:`state_dict` into the current one,
+        so that the states saved by several ranks can be merged.
+        """
+        self._conf_matrix += state["conf_matrix"]
+        self._b_conf_matrix += state["b_conf_matrix"]
+        self._predictions.extend(state["predictions"])
+
     def process(self, inputs, outputs):
         """
         Args:
@@ -239,10 +257,10 @@ class SeenUnseenSemSegEvaluator(DatasetEvaluator):
                 return float('nan')
             return 100 * float(np.sum(iou_array[mask]) / len(mask))
 
-        seen_mIoU = compute_group_iou(iou, iou_valid, ade_common_ids)
-        unseen_mIoU = compute_group_iou(iou, iou_valid, ade_only_ids)
-        res["seen_mIoU"] = seen_mIoU
-        res["unseen_mIoU"] = unseen_mIoU
+        if self._train_dataset_name is not None:
+            seen_ids, unseen_ids = get_seen_unseen_ids(self._train_dataset_name, self._dataset_name)
+            res["seen_mIoU"] = compute_group_iou(iou, iou_valid, seen_ids)
+            res["unseen_mIoU"] = compute_group_iou(iou, iou_valid, unseen_ids)
 
 
         results = OrderedDict({"sem_seg": res})
@@ -20,6 +20,9 @@ from detectron2.structures import Boxes, ImageList, Instances, BitMasks
 from detectron2.utils.memory import retry_if_cuda_oom
 from .modeling.maft.content_dependent_transfer import ContentDependentTransfer
 from .modeling.meta_arch.mask_adapter_head import build_mask_adapter
+from .utils.mask_packing import unpack_bitmasks
+from .utils.misc import sem_seg_to_masks
+from .utils.precision import autocast_forward, float32
 
 
 
@@ -71,6 +74,8 @@ class MASK_Adapter(nn.Module):
         test_topk_per_image: int,
         train_maft : bool,
         num_output_maps: int,
+        train_precision: str = "float32",
+        test_precision: str = "float32",
     ):
         """
         Args:
@@ -131,8 +136,11 @@ class MASK_Adapter(nn.Module):
         self.test_dataname = None
         self.train_num_templates = {}
         self.train_text_classifier = {}
+        self.test_text_classifiers = {}
         self.train_maft = train_maft
         self.num_output_maps = num_output_maps
+        self.train_precision = train_precision
+        self.test_precision = test_precision
         
         if self.train_maft:
             if '_base' in backbone.model_name.lower():
@@ -228,24 +236,30 @@ class MASK_Adapter(nn.Module):
             self.train_text_classifier[dataname] = text_classifier
             return self.train_text_classifier[dataname], self.train_num_templates[dataname]
         else:
-            if self.test_dataname != dataname:
-                self.category_overlapping_mask, self.test_num_templates, self.test_class_names = self.prepare_class_names_from_metadata(
+            if dataname not in self.test_text_classifiers:
+                category_overlapping_mask, num_templates, class_names = self.prepare_class_names_from_metadata(
                     self.test_metadata[dataname], self.test_metadata[dataname]
                 )
                 text_classifier = []
                 bs = 128
-                for idx in range(0, len(self.test_class_names), bs):
+                for idx in range(0, len(class_names), bs):
                     text_classifier.append(
-                        self.backbone.get_text_classifier(self.test_class_names[idx:idx+bs], self.device).detach()
+                        self.backbone.get_text_classifier(class_names[idx:idx+bs], self.device).detach()
                     )
                 text_classifier = torch.cat(text_classifier, dim=0)
 
                 text_classifier /= text_classifier.norm(dim=-1, keepdim=True)
                 text_classifier = text_classifier.reshape(text_classifier.shape[0] // len(VILD_PROMPT), len(VILD_PROMPT), text_classifier.shape[-1]).mean(1)
                 text_classifier /= text_classifier.norm(dim=-1, keepdim=True)
-                self.test_text_classifier = text_classifier
-                self.test_dataname = dataname
-                
+                # cache every test vocabulary, multi-vocabulary evaluation switches between them per batch
+                self.test_text_classifiers[dataname] = (text_classifier, num_templates, category_overlapping_mask, class_names)
+
+            text_classifier, num_templates, category_overlapping_mask, class_names = self.test_text_classifiers[dataname]
+            self.test_text_classifier = text_classifier
+            self.test_num_templates = num_templates
+            self.category_overlapping_mask = category_overlapping_mask
+            self.test_class_names = class_names
+            self.test_dataname = dataname
             return self.test_text_classifier, self.test_num_templates
 
     @classmethod
@@ -296,13 +310,16 @@ class MASK_Adapter(nn.Module):
             "panoptic_on": cfg.MODEL.MASK_FORMER.TEST.PANOPTIC_ON,
             "test_topk_per_image": cfg.TEST.DETECTIONS_PER_IMAGE,
             "train_maft": cfg.MODEL.MASK_ADAPTER.TRAIN_MAFT,
-            "num_output_maps": cfg.MODEL.MASK_ADAPTER.NUM_OUTPUT_MAPS
+            "num_output_maps": cfg.MODEL.MASK_ADAPTER.NUM_OUTPUT_MAPS,
+            "train_precision": cfg.SOLVER.AMP.PRECISION if cfg.SOLVER.AMP.ENABLED else "float32",
+            "test_precision": cfg.TEST.PRECISION,
         }
 
     @property
     def device(self):
         return self.pixel_mean.device
 
+    @autocast_forward
     def forward(self, batched_inputs):
         """
         Args:
@@ -345,19 +362,30 @@ class MASK_Adapter(nn.Module):
         features = self.backbone(images.tensor)
         
         clip_feature = features['clip_vis_dense']
-        text_classifier, num_templates = self.get_text_classifier(dataname)
-        
-        text_classifier = torch.cat([text_classifier, F.normalize(self.void_embedding.weight, dim=-1)], dim=0)
-                
+
         if self.train_maft:
             #https://github.com/jiaosiyu1999/MAFT-Plus/blob/fd12806df651d309883229de9503e40533f92689/maft/maft_plus.py#L352
             #For maftp,it uses a wrong reshape operation to get clip_vis_dense. Since we don't finetune cdt, we follow them. 
-            img_feat = self.visual_prediction_forward_convnext(clip_feature)
-            text_classifier = self.cdt(img_feat, text_classifier)
-            clip_vis_dense = img_feat
+            clip_vis_dense = self.visual_prediction_forward_convnext(clip_feature)
         else:
             clip_vis_dense = self.visual_prediction_forward_convnext_2d(clip_feature)
-            
+
+        if not self.training and "vocabularies" in batched_inputs[0]:
+            # multi-vocabulary evaluation: the backbone runs once and every vocabulary
+            # is classified with its own ground-truth masks and text classifier
+            processed_results = [{} for _ in batched_inputs]
+            for dataname in batched_inputs[0]["vocabularies"]:
+                vocab_inputs = [x["vocabularies"][dataname] for x in batched_inputs]
+                text_classifier, num_templates = self.get_vocabulary_classifier(dataname, clip_vis_dense)
+                vocab_results = self.gt_mask_inference(
+                    vocab_inputs, images, clip_feature, clip_vis_dense, text_classifier, num_templates
+                )
+                for r, vocab_r in zip(processed_results, vocab_results):
+                    r[dataname] = vocab_r
+            return processed_results
+
+        text_classifier, num_templates = self.get_vocabulary_classifier(dataname, clip_vis_dense)
+
         if self.training:
             # mask classification target
             if "instances" in batched_inputs[0]:
@@ -374,8 +402,7 @@ class MASK_Adapter(nn.Module):
                 B, C = clip_feature.size(0),clip_feature.size(1)
                 N = maps_for_pooling.size(1)
                 num_instances = N // self.num_output_maps
-                maps_for_pooling = F.softmax(F.logsigmoid(maps_for_pooling).view(B, N,-1), dim=-1)
-                pooled_clip_feature = torch.bmm(maps_for_pooling, clip_feature.view(B, C, -1).permute(0, 2, 1))
+                pooled_clip_feature = pool_clip_feature(maps_for_pooling, clip_feature)
                 pooled_clip_feature = self.backbone.visual_prediction_forward(pooled_clip_feature)
                 pooled_clip_feature = (pooled_clip_feature.reshape(B,num_instances, self.num_output_maps, -1).mean(dim=-2).contiguous())
             else:
@@ -392,100 +419,104 @@ class MASK_Adapter(nn.Module):
                     # remove this loss if not specified in `weight_dict`
                     losses.pop(k)
             return losses
-        else:          
-            masks = []
-            classes = []
-            for input_per_image in batched_inputs:
-                height = input_per_image.get("height")
-                width = input_per_image.get("width")
-                sem_seg = input_per_image["sem_seg"].to(self.device)
-                total_masks,class_label = self.sem_seg_2_gt_masks(sem_seg, height, width)
-                masks.append(total_masks)
-                classes.append(class_label)
-            masks = torch.stack(masks)            
-            classes =  torch.stack(classes)
-                        
-            outputs = self.mask_adapter(clip_vis_dense, masks)
-            
-            maps_for_pooling = F.interpolate(outputs, size=clip_vis_dense.shape[-2:],
-                                                mode='bilinear', align_corners=False)
-            if "convnext" in self.backbone.model_name.lower():
-                B,C = clip_feature.size(0),clip_feature.size(1)
-                N = maps_for_pooling.size(1)
-                num_instances = N // self.num_output_maps
-                maps_for_pooling = F.softmax(F.logsigmoid(maps_for_pooling).view(B, N,-1), dim=-1)
-                pooled_clip_feature = torch.bmm(maps_for_pooling, clip_feature.view(B, C, -1).permute(0, 2, 1))
-                pooled_clip_feature = self.backbone.visual_prediction_forward(pooled_clip_feature)
-                pooled_clip_feature = (pooled_clip_feature.reshape(B,num_instances, self.num_output_maps, -1).mean(dim=-2).contiguous())
-            else:
-                raise NotImplementedError
-            
-            mask_cls_results = get_classification_logits(pooled_clip_feature, text_classifier, self.backbone.clip_model.logit_scale, num_templates)
-
-            mask_cls_results = mask_cls_results.softmax(-1)
-
-            #upsample masks
-            mask_pred_results = F.interpolate(
-                masks,
-                size=(images.tensor.shape[-2], images.tensor.shape[-1]),
-                mode="bilinear",
-                align_corners=False,
+        else:
+            return self.gt_mask_inference(
+                batched_inputs, images, clip_feature, clip_vis_dense, text_classifier, num_templates
             )
 
-            processed_results = []
-            for mask_cls_result, mask_pred_result, input_per_image, image_size in zip(
-                mask_cls_results, mask_pred_results, batched_inputs, images.image_sizes
-            ):  
-                
-                height = input_per_image.get("height", image_size[0])
-                width = input_per_image.get("width", image_size[1])
-                processed_results.append({})
-                
-                if self.sem_seg_postprocess_before_inference:
-                    mask_pred_result = retry_if_cuda_oom(sem_seg_postprocess)(
-                        mask_pred_result, image_size, height, width
-                    )
-                    mask_cls_result = mask_cls_result.to(mask_pred_result)
+    def get_vocabulary_classifier(self, dataname, clip_vis_dense):
+        """
+        Returns the text classifier of `dataname` with the void embedding appended,
+        adapted to the image features by CDT for MAFT+.
+        """
+        text_classifier, num_templates = self.get_text_classifier(dataname)
+        text_classifier = torch.cat([text_classifier, F.normalize(self.void_embedding.weight, dim=-1)], dim=0)
+        if self.train_maft:
+            text_classifier = self.cdt(clip_vis_dense, text_classifier)
+        return text_classifier, num_templates
+
+    def gt_mask_inference(self, batched_inputs, images, clip_feature, clip_vis_dense, text_classifier, num_templates):
+        """
+        Classifies the ground-truth masks of each input "sem_seg" with `text_classifier`
+        and returns the processed results of every image.
+        """
+        masks = []
+        classes = []
+        for input_per_image in batched_inputs:
+            height = input_per_image.get("height")
+            width = input_per_image.get("width")
+            sem_seg = input_per_image["sem_seg"].to(self.device)
+            total_masks,class_label = self.sem_seg_2_gt_masks(sem_seg, height, width)
+            masks.append(total_masks)
+            classes.append(class_label)
+        masks = torch.stack(masks)            
+        classes =  torch.stack(classes)
                     
-                mask_pred_result = mask_pred_result.squeeze(1)
-                # semantic segmentation inference
-                if self.semantic_on:
-                    r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
-                    if not self.sem_seg_postprocess_before_inference:
-                        r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
-                    processed_results[-1]["sem_seg"] = r
-
-                # panoptic segmentation inference
-                if self.panoptic_on:
-                    panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result)
-                    processed_results[-1]["panoptic_seg"] = panoptic_r
-                
-                # instance segmentation inference
-                if self.instance_on:
-                    instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result)
-                    processed_results[-1]["instances"] = instance_r
+        outputs = self.mask_adapter(clip_vis_dense, masks)
+        
+        maps_for_pooling = F.interpolate(outputs, size=clip_vis_dense.shape[-2:],
+                                            mode='bilinear', align_corners=False)
+        if "convnext" in self.backbone.model_name.lower():
+            B,C = clip_feature.size(0),clip_feature.size(1)
+            N = maps_for_pooling.size(1)
+            num_instances = N // self.num_output_maps
+            pooled_clip_feature = pool_clip_feature(maps_for_pooling, clip_feature)
+            pooled_clip_feature = self.backbone.visual_prediction_forward(pooled_clip_feature)
+            pooled_clip_feature = (pooled_clip_feature.reshape(B,num_instances, self.num_output_maps, -1).mean(dim=-2).contiguous())
+        else:
+            raise NotImplementedError
+        
+        mask_cls_results = get_classification_logits(pooled_clip_feature, text_classifier, self.backbone.clip_model.logit_scale, num_templates)
 
-            return processed_results
+        mask_cls_results = mask_cls_results.softmax(-1)
 
-    def sem_seg_2_gt_masks(self, sem_seg, height, width):
-        classes = torch.unique(sem_seg,sorted=False,return_inverse=False,return_counts=False)
-        gt_labels = classes[classes != 255]
-        masks = [sem_seg == class_id for class_id in gt_labels]
+        #upsample masks
+        mask_pred_results = F.interpolate(
+            masks,
+            size=(images.tensor.shape[-2], images.tensor.shape[-1]),
+            mode="bilinear",
+            align_corners=False,
+        )
 
-        if len(masks) == 0:
-            gt_masks = torch.zeros((0, sem_seg.shape[-2],
-                                            sem_seg.shape[-1])).to(sem_seg)
-        else:
-            gt_masks = torch.stack(masks).squeeze(1)
+        processed_results = []
+        for mask_cls_result, mask_pred_result, input_per_image, image_size in zip(
+            mask_cls_results, mask_pred_results, batched_inputs, images.image_sizes
+        ):  
             
-        num_masks = gt_masks.shape[0]
-        total_masks = torch.zeros((num_masks, gt_masks.shape[1], gt_masks.shape[2]), dtype=gt_masks.dtype, device=gt_masks.device)
-        labels = torch.zeros((num_masks), device=gt_masks.device)
-        
-        total_masks[:num_masks] = gt_masks[:num_masks]
-        labels[:num_masks] = gt_labels[:num_masks]
-        
-        return total_masks.float(), labels
+            height = input_per_image.get("height", image_size[0])
+            width = input_per_image.get("width", image_size[1])
+            processed_results.append({})
+            
+            if self.sem_seg_postprocess_before_inference:
+                mask_pred_result = retry_if_cuda_oom(sem_seg_postprocess)(
+                    mask_pred_result, image_size, height, width
+                )
+                mask_cls_result = mask_cls_result.to(mask_pred_result)
+                
+            mask_pred_result = mask_pred_result.squeeze(1)
+            # semantic segmentation inference
+            if self.semantic_on:
+                r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
+                if not self.sem_seg_postprocess_before_inference:
+                    r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
+                processed_results[-1]["sem_seg"] = r
+
+            # panoptic segmentation inference
+            if self.panoptic_on:
+                panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result)
+                processed_results[-1]["panoptic_seg"] = panoptic_r
+            
+            # instance segmentation inference
+            if self.instance_on:
+                instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result)
+                processed_results[-1]["instances"] = instance_r
+
+        return processed_results
+
+    def sem_seg_2_gt_masks(self, sem_seg, height, width):
+        # the ground truth may come with a leading channel dimension
+        class_label, total_masks = sem_seg_to_masks(sem_seg.reshape(sem_seg.shape[-2:]), 255)
+        return total_masks.float(), class_label.float()
     
     def visual_prediction_forward_convnext(self, x):
         batch, channel, h, w = x.shape
@@ -526,53 +557,44 @@ class MASK_Adapter(nn.Module):
         min_mask_area = 0
         
         for targets_per_image in targets:
-            gt_masks = targets_per_image.gt_masks
+            if targets_per_image.has("gt_masks_packed"):
+                # masks sent bit-packed by the dataset mapper (INPUT.PACK_MASKS)
+                gt_masks = unpack_bitmasks(targets_per_image.gt_masks_packed, targets_per_image.image_size[1])
+            else:
+                gt_masks = targets_per_image.gt_masks
             if isinstance(gt_masks, BitMasks):
                 gt_masks = gt_masks.tensor
-            valid_mask_indices = [i for i, mask in enumerate(gt_masks) if mask.sum() > min_mask_area]  
-
-            if len(valid_mask_indices) > 0:
-                valid_gt_masks = gt_masks[valid_mask_indices]
-                valid_gt_classes = targets_per_image.gt_classes[valid_mask_indices]
-                
-                padded_masks = torch.zeros((valid_gt_masks.shape[0], h_pad, w_pad), dtype=valid_gt_masks.dtype, device=valid_gt_masks.device)
-                padded_masks[:, : valid_gt_masks.shape[1], : valid_gt_masks.shape[2]] = valid_gt_masks
-                new_targets.append(
-                    {
-                        "labels": valid_gt_classes,
-                        "masks": padded_masks,
-                    }
-                )
+            # one area reduction for all the masks instead of a .sum() (and a host sync) per mask
+            valid = gt_masks.flatten(1).sum(-1) > min_mask_area
+            valid_gt_masks = gt_masks[valid]
+            num_valid = valid_gt_masks.shape[0]
+            if num_valid > 0:
+                valid_gt_classes = targets_per_image.gt_classes[valid]
+            else:
+                valid_gt_classes = torch.zeros((0), device=gt_masks.device)
 
-                total_masks = torch.zeros((num_masks, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-                selected_labels = torch.zeros((num_masks), device=gt_masks.device)
+            padded_masks = torch.zeros((num_valid, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
+            padded_masks[:, : gt_masks.shape[1], : gt_masks.shape[2]] = valid_gt_masks
+            new_targets.append(
+                {
+                    "labels": valid_gt_classes,
+                    "masks": padded_masks,
+                }
+            )
 
-                if valid_gt_masks.shape[0] > num_masks:
-                    selected_indices = torch.randperm(valid_gt_masks.shape[0])[:num_masks]
-                    for idx, mask_idx in enumerate(selected_indices):
-                        total_masks[idx, :valid_gt_masks[mask_idx].shape[0], :valid_gt_masks[mask_idx].shape[1]] = valid_gt_masks[mask_idx]
-                        selected_labels[idx] = valid_gt_classes[mask_idx]
-                else:
-                    for idx in range(valid_gt_masks.shape[0]):
-                        total_masks[idx, :valid_gt_masks[idx].shape[0], :valid_gt_masks[idx].shape[1]] = valid_gt_masks[idx]
-                        selected_labels[idx] = valid_gt_classes[idx]
-                    
-                    for idx in range(valid_gt_masks.shape[0], num_masks):
-                        total_masks[idx] = torch.zeros((h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-                        selected_labels[idx] = -1
+            # at most num_masks masks are kept, drawn with the same (CPU) randperm as before
+            if num_valid > num_masks:
+                selected_indices = torch.randperm(num_valid)[:num_masks].to(gt_masks.device)
+                selected_masks = padded_masks[selected_indices]
+                selected_classes = valid_gt_classes[selected_indices]
             else:
-                total_masks = torch.zeros((num_masks, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-                selected_labels = torch.zeros((num_masks), device=gt_masks.device)
-                selected_labels.fill_(-1)  
-                
-                padded_masks = torch.zeros((0, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-                valid_gt_classes = torch.zeros((0), device=gt_masks.device)
-                new_targets.append(
-                    {
-                        "labels": valid_gt_classes,
-                        "masks": padded_masks,
-                    }
-                )
+                selected_masks = padded_masks
+                selected_classes = valid_gt_classes
+
+            total_masks = torch.zeros((num_masks, h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
+            total_masks[: selected_masks.shape[0]] = selected_masks
+            selected_labels = torch.full((num_masks,), -1, dtype=torch.long, device=gt_masks.device)
+            selected_labels[: selected_classes.shape[0]] = selected_classes
 
             masks_list.append(total_masks)
             labels_list.append(selected_labels)
@@ -583,6 +605,7 @@ class MASK_Adapter(nn.Module):
 
         return new_targets, masks, labels
 
+    @float32
     def semantic_inference(self, mask_cls, mask_pred):  
 
         mask_cls = F.softmax(mask_cls, dim=-1)[..., :-1]
@@ -592,6 +615,7 @@ class MASK_Adapter(nn.Module):
         semseg = torch.einsum("qc,qhw->chw", mask_cls, mask_pred)
         return semseg
 
+    @float32
     def panoptic_inference(self, mask_cls, mask_pred):
 
                 
@@ -651,6 +675,7 @@ class MASK_Adapter(nn.Module):
 
             return panoptic_seg, segments_info
 
+    @float32
     def instance_inference(self, mask_cls, mask_pred):
         # mask_pred is already processed to have the same shape as original input
 
@@ -725,6 +750,20 @@ class MaskPooling(nn.Module):
         )
         return mask_pooled_x
     
+# the softmax over all the pixels and the weighted sum are kept in float32 under autocast
+@float32
+def pool_clip_feature(maps_for_pooling, clip_feature):
+    # maps_for_pooling in shape of [B, N, H, W]
+    # clip_feature in shape of [B, C, H, W]
+    # return: [B, N, C], clip_feature averaged with a per-map softmax over the pixels of logsigmoid(maps)
+    B, N = maps_for_pooling.shape[:2]
+    C = clip_feature.shape[1]
+    maps_for_pooling = F.softmax(F.logsigmoid(maps_for_pooling).view(B, N, -1), dim=-1)
+    return torch.bmm(maps_for_pooling, clip_feature.view(B, C, -1).permute(0, 2, 1))
+
+
+# the normalization and the exponentiated logit scale are kept in float32 under autocast
+@float32
 def get_classification_logits(x, text_classifier, logit_scale, num_templates=None):
     # x in shape of [B, *, C]
     # text_classifier in shape of [num_classes, C]
@@ -1,3 +1,4 @@
+import functools
 import logging
 from copy import deepcopy
 from typing import Callable, Dict, List, Optional, Tuple, Union
@@ -9,10 +10,17 @@ import torch
 from detectron2.config import configurable
 from detectron2.layers import Conv2d, ShapeSpec, get_norm
 from detectron2.modeling import SEM_SEG_HEADS_REGISTRY
+from detectron2.utils.logger import log_every_n_seconds
 import torch.utils.checkpoint as cp
+from .checkpoint_planner import plan_checkpointing, profile_blocks
 from .convnext import ConvNextBlock
 from einops import rearrange,repeat
 
+from ...utils.precision import float32
+
+# the blocks of MASKAdapterHead, in order, that can be recomputed in the backward pass
+CHECKPOINT_BLOCKS = ("mask_downscaling", "fuse", "cnext1", "cnext2", "cnext3", "final")
+
 @SEM_SEG_HEADS_REGISTRY.register()
 class MASKAdapterHead(nn.Module):
 
@@ -24,6 +32,8 @@ class MASKAdapterHead(nn.Module):
         num_channels: int,
         use_checkpoint: bool,
         num_output_maps: int,
+        checkpoint_blocks: Tuple[str] = (),
+        checkpoint_memory_budget: int = 0,
     ):
         """
         NOTE: this interface is experimental.
@@ -38,6 +48,13 @@ class MASKAdapterHead(nn.Module):
         """
         super().__init__()
         self.use_checkpoint = use_checkpoint
+        unknown = set(checkpoint_blocks) - set(CHECKPOINT_BLOCKS)
+        if unknown:
+            raise ValueError("Unknown checkpoint blocks {}, expected some of {}".format(sorted(unknown), CHECKPOINT_BLOCKS))
+        self.checkpoint_blocks = tuple(checkpoint_blocks)
+        # bytes of activations kept for the backward pass, 0 to use checkpoint_blocks
+        self.checkpoint_memory_budget = checkpoint_memory_budget * 1024 ** 2
+        self._checkpoint_profiles = {}
         
         if '_base' in clip_model_name:
             clip_dim = 640
@@ -75,55 +92,91 @@ class MASKAdapterHead(nn.Module):
             "num_channels": cfg.MODEL.MASK_ADAPTER.NUM_CHANNELS,
             "use_checkpoint": cfg.MODEL.MASK_ADAPTER.USE_CHECKPOINT,
             "num_output_maps": cfg.MODEL.MASK_ADAPTER.NUM_OUTPUT_MAPS,
+            "checkpoint_blocks": cfg.MODEL.MASK_ADAPTER.CHECKPOINT_BLOCKS,
+            "checkpoint_memory_budget": cfg.MODEL.MASK_ADAPTER.CHECKPOINT_MEMORY_BUDGET,
         }
 
     def forward(self, clip_feature, masks):
-        #clip_feature: (B, C, H, W) : #clip_feature from backbone, e.g., {'clip_vis_dense': tensor, 'clip_vis_sparse': tensor, ...}
+        #clip_feature: (B, C, H, W)
         #masks: (B, N, H, W) where N is the number of masks
 
-        
-        N = masks.size(1) #masks.shape = (B, N, H, W) where N is the number of masks
-        masks = rearrange(masks, 'B N H W -> (B N) H W').unsqueeze(dim=1)  # masks.shape = (B*N, 1, H, W)
-        
-        clip_feature = repeat(clip_feature, "B C H W -> (B N) C H W", N=N) # repeat() is used to repeat the clip_feature for each mask, so that the shape of clip_feature is (B*N, C, H, W) where N is the number of masks
-        
-        H,W = clip_feature.shape[-2:]
-        masks = F.interpolate(masks.float(), size=(H*4,W*4),
-                                                mode='bilinear', align_corners=False)
-        masks = self.mask_downscaling(masks)
-        # self.mask_downscaling = nn.Sequential(
-        # nn.Conv2d(1, C, kernel_size=3, padding=1),
-        # nn.BatchNorm2d(C),
-        # nn.ReLU(inplace=True),
-        # )
-        
-        outputs = clip_feature + masks
-        
-        def _inner_forward(outputs):
-            outputs = self.fuse(outputs)
-        
-            outputs = self.cnext1(outputs)
-            
-            outputs = self.cnext2(outputs)
-            
-            outputs = self.cnext3(outputs)
-            
-            outputs = outputs.permute(0, 2, 3, 1) 
-            outputs = self.norm(outputs.contiguous())
-            outputs = outputs.permute(0, 3, 1, 2) 
-            
-            outputs = self.final(outputs.contiguous()) 
-            
-            outputs = rearrange(outputs, '(B N) C H W -> B (N C) H W',N=N)
-    
-            return outputs
-
-        if self.use_checkpoint and self.training:
-            outputs = cp.checkpoint(_inner_forward, outputs, use_reentrant=False)
+        N = masks.size(1)
+        masks = rearrange(masks, 'B N H W -> (B N) H W').unsqueeze(dim=1)
+        blocks = self._blocks(clip_feature)
+
+        if not self.training:
+            outputs = self._run_blocks(blocks, masks)
+        elif self.use_checkpoint:
+            # the blocks after the mask encoder as a single checkpoint
+            outputs = self._run_blocks(blocks[:1], masks)
+            outputs = cp.checkpoint(self._run_blocks, blocks[1:], outputs, use_reentrant=False)
+        elif self.checkpoint_memory_budget > 0:
+            outputs = self._run_blocks(blocks, masks, self.plan_checkpointing(clip_feature, masks))
         else:
-            outputs = _inner_forward(outputs)
+            outputs = self._run_blocks(blocks, masks, self.checkpoint_blocks)
+
+        return rearrange(outputs, '(B N) C H W -> B (N C) H W', N=N)
+
+    def _blocks(self, clip_feature):
+        # the (name, function) of every block of CHECKPOINT_BLOCKS, applied in sequence to the (B*N, 1, h, w) masks
+        H, W = clip_feature.shape[-2:]
+        return [
+            ("mask_downscaling", functools.partial(self._encode_masks, size=(H * 4, W * 4))),
+            ("fuse", functools.partial(self._fuse, clip_feature)),
+            ("cnext1", self.cnext1),
+            ("cnext2", self.cnext2),
+            ("cnext3", self.cnext3),
+            ("final", self._final),
+        ]
+
+    def _run_blocks(self, blocks, outputs, checkpointed=()):
+        for name, block in blocks:
+            if name in checkpointed:
+                outputs = cp.checkpoint(block, outputs, use_reentrant=False)
+            else:
+                outputs = block(outputs)
         return outputs
 
+    def _encode_masks(self, masks, size):
+        # upsampled inside the block, so that a checkpoint of it only keeps the input masks
+        masks = F.interpolate(masks.float(), size=size, mode='bilinear', align_corners=False)
+        return self.mask_downscaling(masks)
+
+    def _fuse(self, clip_feature, mask_embeddings):
+        # the CLIP features are repeated for each mask inside the block for the same reason
+        N = mask_embeddings.size(0) // clip_feature.size(0)
+        clip_feature = repeat(clip_feature, "B C H W -> (B N) C H W", N=N)
+        return self.fuse(clip_feature + mask_embeddings)
+
+    def _final(self, outputs):
+        outputs = outputs.permute(0, 2, 3, 1)
+        outputs = self.norm(outputs.contiguous())
+        outputs = outputs.permute(0, 3, 1, 2)
+        return self.final(outputs.contiguous())
+
+    def plan_checkpointing(self, clip_feature, masks):
+        """
+        Returns the blocks to checkpoint so that the activations kept for the backward pass fit
+        checkpoint_memory_budget at the lowest recompute cost, see :func:`plan_checkpointing`.
+        The blocks are profiled on one mask for every new input resolution and autocast state.
+        """
+        key = (tuple(clip_feature.shape[-2:]), tuple(masks.shape[-2:]), torch.is_autocast_enabled())
+        if key not in self._checkpoint_profiles:
+            self._checkpoint_profiles[key] = profile_blocks(
+                self._blocks(clip_feature[:1]), masks[:1], list(self.parameters())
+            )
+        names, memory, macs = plan_checkpointing(
+            self._checkpoint_profiles[key], masks.size(0), self.checkpoint_memory_budget
+        )
+        log_every_n_seconds(
+            logging.INFO,
+            "Mask-adapter checkpointing for {} masks of {}: {} ({:.0f} MiB of activations, {:.1f} GMACs recomputed)".format(
+                masks.size(0), tuple(masks.shape[-2:]), list(names), memory / 1024 ** 2, macs / 1e9
+            ),
+            n=300,
+        )
+        return names
+
 def build_mask_adapter(cfg,name):
     return SEM_SEG_HEADS_REGISTRY.get(name)(cfg)
 
@@ -136,6 +189,8 @@ class LayerNorm2d(nn.Module):
         self.bias = nn.Parameter(torch.zeros(num_channels))
         self.eps = eps
 
+    # the channel statistics are computed in float32 under autocast
+    @float32
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         u = x.mean(1, keepdim=True)
         s = (x - u).pow(2).mean(1, keepdim=True)
@@ -0,0 +1,44 @@
+# Copyright (c) 2024 ByteDance. All Rights Reserved.
+"""
+Bit-packing of binary masks, so that the dataloader workers send 1 bit per pixel
+through shared memory instead of 1 byte, and the masks are unpacked on the device.
+"""
+import torch
+
+__all__ = ["pack_bitmasks", "unpack_bitmasks"]
+
+
+def _bit_weights(device):
+    # most significant bit first, as np.packbits
+    return torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=device)
+
+
+def pack_bitmasks(masks):
+    """
+    Args:
+        masks (Tensor): bool or 0/1 tensor of shape (..., H, W).
+
+    Returns:
+        Tensor: uint8 tensor of shape (..., H, ceil(W / 8)).
+    """
+    w = masks.shape[-1]
+    masks = masks.to(torch.uint8)
+    if w % 8:
+        masks = torch.nn.functional.pad(masks, (0, 8 - w % 8))
+    masks = masks.reshape(*masks.shape[:-1], -1, 8)
+    return (masks * _bit_weights(masks.device)).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_bitmasks(packed, width):
+    """
+    Inverse of :func:`pack_bitmasks`.
+
+    Args:
+        packed (Tensor): uint8 tensor of shape (..., H, ceil(W / 8)).
+        width (int): the width W of the original masks.
+
+    Returns:
+        Tensor: bool tensor of shape (..., H, W).
+    """
+    bits = packed.unsqueeze(-1) & _bit_weights(packed.device)
+    return bits.bool().flatten(-2)[..., :width]
@@ -112,3 +112,22 @@ def is_dist_avail_and_initialized():
     if not dist.is_initialized():
         return False
     return True
+
+
+def sem_seg_to_masks(sem_seg: Tensor, ignore_label: int = 255):
+    """
+    Splits a semantic segmentation map into one binary mask per class present in it.
+
+    Args:
+        sem_seg (Tensor): integer tensor of shape (H, W).
+        ignore_label (int): label of the pixels that belong to no mask.
+
+    Returns:
+        classes (Tensor): the sorted classes present in `sem_seg`, of shape (K,).
+        masks (Tensor): bool tensor of shape (K, H, W), masks[i] is `sem_seg == classes[i]`.
+    """
+    classes = torch.unique(sem_seg)
+    classes = classes[classes != ignore_label]
+    # one broadcast comparison writes all the masks into a single allocation
+    masks = sem_seg[None] == classes[:, None, None]
+    return classes, masks
@@ -0,0 +1,104 @@
+"""
+Builds the frozen-teacher store of MODEL.MASK_ADAPTER.TEACHER_STORE for FC-CLIP or MAFT+
+mixed-mask training.
+
+Runs the frozen CLIP backbone and Mask2Former head once on `--variants` seeded augmentations
+of every training image, and writes the outputs that training reads instead of running them
+(see FCCLIP.teacher_outputs). Training must then use the same config, weights and
+MODEL.MASK_ADAPTER.TEACHER_STORE_VARIANTS, so that it draws the same augmentations.
+
+    python tools/build_teacher_store.py --model fcclip --num-gpus 8 --config-file ... \\
+        --store output/teacher_store MODEL.WEIGHTS ...
+"""
+import importlib
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import detectron2.utils.comm as comm
+from detectron2.engine import default_argument_parser, launch
+
+_TRAIN_NETS = {"fcclip": "train_net_fcclip", "maftp": "train_net_maftp"}
+
+
+def get_parser():
+    parser = default_argument_parser()
+    parser.add_argument("--model", choices=sorted(_TRAIN_NETS), required=True)
+    parser.add_argument("--store", required=True, help="Output directory of the teacher store")
+    parser.add_argument(
+        "--variants",
+        type=int,
+        default=None,
+        help="Seeded augmentations per image, MODEL.MASK_ADAPTER.TEACHER_STORE_VARIANTS by default",
+    )
+    parser.add_argument("--batch-size", type=int, default=8, help="Images per forward pass")
+    parser.add_argument("--shard-size", type=int, default=256, help="Samples per store shard")
+    return parser
+
+
+def main(args):
+    train_net = importlib.import_module(_TRAIN_NETS[args.model])
+    package = importlib.import_module(args.model if args.model == "fcclip" else "maft")
+    cfg = train_net.setup(args)
+    logger = logging.getLogger(__name__)
+    assert not cfg.MODEL.MASK_ADAPTER.TEACHER_STORE, "MODEL.MASK_ADAPTER.TEACHER_STORE must not be set here"
+
+    model = train_net.Trainer.build_model(cfg)
+    package.TrainableCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    # the frozen parts run as in training, e.g. with the training vocabulary
+    model.train()
+
+    mapper = package.TeacherStoreDatasetMapper(train_net.Trainer.build_train_mapper(cfg))
+    dataset_dicts = package.get_teacher_store_dataset_dicts(
+        cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS
+    )
+    num_variants = args.variants or cfg.MODEL.MASK_ADAPTER.TEACHER_STORE_VARIANTS
+    dataset_dicts = dataset_dicts[comm.get_rank()::comm.get_world_size()]
+    writer = package.TeacherStoreWriter(
+        args.store, prefix="rank{}".format(comm.get_rank()), shard_size=args.shard_size
+    )
+
+    start_time = time.perf_counter()
+    num_samples = 0
+    batch = []
+    for idx, dataset_dict in enumerate(dataset_dicts):
+        for variant in range(num_variants):
+            mapped = mapper(dict(dataset_dict, aug_variant=variant))
+            if mapped is not None:
+                batch.append(mapped)
+        if len(batch) < args.batch_size and idx + 1 < len(dataset_dicts):
+            continue
+        if batch:
+            outputs = model.teacher_outputs(batch)
+            for inputs, outputs_per_image in zip(batch, outputs):
+                writer.add(inputs["teacher_key"], outputs_per_image)
+            num_samples += len(batch)
+            batch = []
+        if (idx + 1) % 100 == 0:
+            logger.info(
+                "{}/{} images, {:.1f} samples/s".format(
+                    idx + 1, len(dataset_dicts), num_samples / (time.perf_counter() - start_time)
+                )
+            )
+    writer.close()
+    logger.info(
+        "Wrote {} samples of {} images to {} in {:.0f} s".format(
+            num_samples, len(dataset_dicts), args.store, time.perf_counter() - start_time
+        )
+    )
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    print("Command Line Args:", args)
+    launch(
+        main,
+        args.num_gpus,
+        num_machines=args.num_machines,
+        machine_rank=args.machine_rank,
+        dist_url=args.dist_url,
+        args=(args,),
+    )
@@ -0,0 +1,156 @@
+"""
+Fuses the weights of two checkpoints into one safetensors file, tensor by tensor.
+
+The output holds the model weights of `--model_first_phase_path`, where the weights of
+`--model_sem_seg_path` matching the `--rule` prefixes are copied over (by default the
+Mask2Former `sem_seg_head` and the `void` embedding). The sources are memory-mapped when
+torch supports it and every tensor is written as soon as it is read, so the fusion only
+holds one tensor in memory at a time. The output can be used directly as MODEL.WEIGHTS.
+"""
+import argparse
+import inspect
+import json
+import os
+import struct
+import time
+
+import torch
+
+# the dtype names of the safetensors format
+_DTYPE_NAMES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+_TORCH_LOAD_MMAP = "mmap" in inspect.signature(torch.load).parameters
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Fuse weights from two models")
+    parser.add_argument("--model_first_phase_path", type=str, required=True, help="Path to the first phase model")
+    parser.add_argument("--model_sem_seg_path", type=str, required=True, help="Path to the semantic segmentation model")
+    parser.add_argument("--output_path", type=str, required=True, help="Path to save the fused model (.safetensors)")
+    parser.add_argument(
+        "--rule",
+        action="append",
+        default=None,
+        metavar="PREFIX[:NEW_PREFIX]",
+        help="Copy the keys of the semantic segmentation model starting with PREFIX, renamed to "
+        "NEW_PREFIX if given. Can be repeated. Defaults to sem_seg_head and void.",
+    )
+    return parser
+
+
+def load_state_dict(path):
+    """
+    Returns the model weights of a checkpoint, with the tensors memory-mapped when torch supports it.
+    """
+    if _TORCH_LOAD_MMAP:
+        checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    else:
+        checkpoint = torch.load(path, map_location="cpu")
+    # detectron2 checkpoints keep the weights under "model", others are plain state dicts
+    if not (isinstance(checkpoint, dict) and isinstance(checkpoint.get("model"), dict)):
+        return checkpoint
+    if "base_weights" in checkpoint:
+        # a trainable-only checkpoint (SOLVER.CHECKPOINT_TRAINABLE_ONLY), applied over its base weights
+        state_dict = load_state_dict(checkpoint["base_weights"]["path"])
+        state_dict.update(checkpoint["model"])
+        return state_dict
+    return checkpoint["model"]
+
+
+def parse_rules(rules):
+    parsed = []
+    for rule in rules:
+        prefix, _, new_prefix = rule.partition(":")
+        parsed.append((prefix, new_prefix or prefix))
+    return parsed
+
+
+def fuse_keys(base, donor, rules):
+    """
+    Returns the ordered list of (output key, source state dict, source key) of the fused model,
+    checking that the copied weights have the shape of the weights they replace.
+    """
+    sources = {key: (base, key) for key in base}
+    for key in donor:
+        for prefix, new_prefix in rules:
+            if not key.startswith(prefix):
+                continue
+            new_key = new_prefix + key[len(prefix):]
+            if new_key in base and base[new_key].shape != donor[key].shape:
+                raise ValueError(
+                    "Shape mismatch for {}: {} in the first phase model, {} copied from {}".format(
+                        new_key, tuple(base[new_key].shape), tuple(donor[key].shape), key
+                    )
+                )
+            sources[new_key] = (donor, key)
+            print(key if key == new_key else "{} -> {}".format(key, new_key))
+            break
+    return [(key, source, source_key) for key, (source, source_key) in sources.items()]
+
+
+def save_safetensors(entries, path):
+    """
+    Writes the tensors of `entries` (output key, state dict, key) to a safetensors file,
+    reading them from their state dict one at a time.
+    """
+    header = {}
+    offset = 0
+    for key, source, source_key in entries:
+        tensor = source[source_key]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[key] = {
+            "dtype": _DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # the data starts 8-byte aligned
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for key, source, source_key in entries:
+            tensor = source[source_key].detach().contiguous().reshape(-1)
+            if tensor.numel():
+                f.write(tensor.view(torch.uint8).numpy())
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if not args.output_path.endswith(".safetensors"):
+        parser.error("--output_path must be a .safetensors file")
+    start_time = time.perf_counter()
+
+    base = load_state_dict(args.model_first_phase_path)
+    donor = load_state_dict(args.model_sem_seg_path)
+    entries = fuse_keys(base, donor, parse_rules(args.rule or ["sem_seg_head", "void"]))
+    save_safetensors(entries, args.output_path)
+
+    print(
+        "Saved {} tensors to {} ({:.1f} MiB) in {:.1f} s".format(
+            len(entries),
+            args.output_path,
+            os.path.getsize(args.output_path) / 1024 ** 2,
+            time.perf_counter() - start_time,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
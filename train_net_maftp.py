@@ -17,9 +17,11 @@ except:
     pass
 
 import copy
+import inspect
 import itertools
 import logging
 import os
+import time
 # os.environ['CUDA_VISIBLE_DEVICES'] = '2,4,6'
 
 from collections import OrderedDict
@@ -28,9 +30,8 @@ from typing import Any, Dict, List, Set
 import torch
 
 import detectron2.utils.comm as comm
-from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
-from detectron2.data import MetadataCatalog, build_detection_train_loader
+from detectron2.data import DatasetMapper, MetadataCatalog, build_detection_train_loader
 from detectron2.engine import (
     DefaultTrainer,
     default_argument_parser,
@@ -49,6 +50,7 @@ from detectron2.evaluation import (
 )
 from detectron2.projects.deeplab import add_deeplab_config, build_lr_scheduler
 from detectron2.solver.build import maybe_add_gradient_clipping
+from detectron2.utils.events import get_event_storage
 from detectron2.utils.logger import setup_logger
 
 from maft import (
@@ -61,17 +63,45 @@ from maft import (
     MaskFormerPanopticDatasetMapper,
     MaskFormerSemanticDatasetMapper,
     SemanticSegmentorWithTTA,
+    TeacherStore,
+    TeacherStoreDatasetMapper,
+    TrainableCheckpointer,
     add_maskformer2_config,
     add_fcclip_config,
     add_mask_adapter_config,
+    get_teacher_store_dataset_dicts,
 )
 
 
+def _adamw_kernel_kwargs(cfg):
+    # the fused AdamW kernel where this torch version has one, else the foreach kernels.
+    # GradScaler does not unscale the gradients before the step of a fused optimizer, which
+    # unscales them itself, so gradient clipping under AMP would clip the scaled gradients
+    signature = inspect.signature(torch.optim.AdamW).parameters
+    clipped_amp = cfg.SOLVER.CLIP_GRADIENTS.ENABLED and cfg.SOLVER.AMP.ENABLED
+    if "fused" in signature and cfg.MODEL.DEVICE.startswith("cuda") and not clipped_amp:
+        return {"fused": True}
+    if "foreach" in signature:
+        return {"foreach": True}
+    return {}
+
+
 class Trainer(DefaultTrainer):
     """
     Extension of the Trainer class adapted to FCCLIP.
     """
 
+    def build_hooks(self):
+        # replace the checkpointer before the periodic checkpointer hook is built with it
+        self.checkpointer = TrainableCheckpointer(
+            self.checkpointer.model,
+            self.cfg.OUTPUT_DIR,
+            trainable_only=self.cfg.SOLVER.CHECKPOINT_TRAINABLE_ONLY,
+            base_weights=self.cfg.MODEL.WEIGHTS,
+            **self.checkpointer.checkpointables,
+        )
+        return super().build_hooks()
+
     @classmethod
     def build_evaluator(cls, cfg, dataset_name, output_folder=None):
         """
@@ -108,35 +138,46 @@ class Trainer(DefaultTrainer):
         return DatasetEvaluators(evaluator_list)
 
     @classmethod
-    def build_train_loader(cls, cfg):
+    def build_train_mapper(cls, cfg):
         # Semantic segmentation dataset mapper
         if cfg.INPUT.DATASET_MAPPER_NAME == "mask_former_semantic":
             mapper = MaskFormerSemanticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # Panoptic segmentation dataset mapper
         elif cfg.INPUT.DATASET_MAPPER_NAME == "mask_former_panoptic":
             mapper = MaskFormerPanopticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # Instance segmentation dataset mapper
         elif cfg.INPUT.DATASET_MAPPER_NAME == "mask_former_instance":
             mapper = MaskFormerInstanceDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # coco instance segmentation lsj new baseline
         elif cfg.INPUT.DATASET_MAPPER_NAME == "coco_instance_lsj":
             mapper = COCOInstanceNewBaselineDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # coco panoptic segmentation lsj new baseline
         elif cfg.INPUT.DATASET_MAPPER_NAME == "coco_panoptic_lsj":
             mapper = COCOPanopticNewBaselineDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # coco panoptic segmentation lsj new baseline
         elif cfg.INPUT.DATASET_MAPPER_NAME == "coco_semantic_lsj":
             mapper = COCOSemanticNewBaselineDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         
         else:
-            mapper = None
-            return build_detection_train_loader(cfg, mapper=mapper)
+            mapper = DatasetMapper(cfg, True)
+        if cfg.MODEL.MASK_ADAPTER.TEACHER_STORE:
+            # read the frozen model outputs from the store, see tools/build_teacher_store.py
+            mapper = TeacherStoreDatasetMapper(
+                mapper,
+                store=TeacherStore(cfg.MODEL.MASK_ADAPTER.TEACHER_STORE),
+                num_variants=cfg.MODEL.MASK_ADAPTER.TEACHER_STORE_VARIANTS,
+            )
+        return mapper
+
+    @classmethod
+    def build_train_loader(cls, cfg):
+        if cfg.MODEL.MASK_ADAPTER.TEACHER_STORE:
+            # the store is keyed by the dataset names of the images
+            dataset = get_teacher_store_dataset_dicts(
+                cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS
+            )
+            return build_detection_train_loader(cfg, mapper=cls.build_train_mapper(cfg), dataset=dataset)
+        return build_detection_train_loader(cfg, mapper=cls.build_train_mapper(cfg))
 
     @classmethod
     def build_lr_scheduler(cls, cfg, optimizer):
@@ -169,7 +210,9 @@ class Trainer(DefaultTrainer):
             torch.nn.LocalResponseNorm,
         )
 
-        params: List[Dict[str, Any]] = []
+        # parameters with the same hyperparameters share one param group, so that the
+        # optimizer updates them together with its multi-tensor (foreach / fused) kernels
+        grouped_params: Dict[tuple, List[torch.nn.parameter.Parameter]] = OrderedDict()
         memo: Set[torch.nn.parameter.Parameter] = set()
         for module_name, module in model.named_modules():
             for module_param_name, value in module.named_parameters(recurse=False):
@@ -193,7 +236,11 @@ class Trainer(DefaultTrainer):
                     hyperparams["weight_decay"] = weight_decay_norm
                 if isinstance(module, torch.nn.Embedding):
                     hyperparams["weight_decay"] = weight_decay_embed
-                params.append({"params": [value], **hyperparams})
+                grouped_params.setdefault(tuple(sorted(hyperparams.items())), []).append(value)
+
+        params: List[Dict[str, Any]] = [
+            {"params": values, **dict(hyperparams)} for hyperparams, values in grouped_params.items()
+        ]
 
         def maybe_add_full_model_gradient_clipping(optim):
             # detectron2 doesn't have full model gradient clipping now
@@ -206,20 +253,31 @@ class Trainer(DefaultTrainer):
 
             class FullModelGradientClippingOptimizer(optim):
                 def step(self, closure=None):
-                    all_params = itertools.chain(*[x["params"] for x in self.param_groups])
+                    # one call over all the parameters, which torch reduces with multi-tensor norms
+                    all_params = list(itertools.chain(*[x["params"] for x in self.param_groups]))
                     torch.nn.utils.clip_grad_norm_(all_params, clip_norm_val)
                     super().step(closure=closure)
 
             return FullModelGradientClippingOptimizer if enable else optim
 
+        def add_step_timing(optim):
+            class TimedOptimizer(optim):
+                def step(self, closure=None):
+                    # host time of the step, gradient clipping included
+                    start_time = time.perf_counter()
+                    super().step(closure=closure)
+                    get_event_storage().put_scalar("time/optimizer_step", time.perf_counter() - start_time)
+
+            return TimedOptimizer
+
         optimizer_type = cfg.SOLVER.OPTIMIZER
         if optimizer_type == "SGD":
-            optimizer = maybe_add_full_model_gradient_clipping(torch.optim.SGD)(
+            optimizer = add_step_timing(maybe_add_full_model_gradient_clipping(torch.optim.SGD))(
                 params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM
             )
         elif optimizer_type == "ADAMW":
-            optimizer = maybe_add_full_model_gradient_clipping(torch.optim.AdamW)(
-                params, cfg.SOLVER.BASE_LR
+            optimizer = add_step_timing(maybe_add_full_model_gradient_clipping(torch.optim.AdamW))(
+                params, cfg.SOLVER.BASE_LR, **_adamw_kernel_kwargs(cfg)
             )
         else:
             raise NotImplementedError(f"no optimizer type {optimizer_type}")
@@ -270,7 +328,7 @@ def main(args):
 
     if args.eval_only:
         model = Trainer.build_model(cfg)
-        DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
+        TrainableCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
             cfg.MODEL.WEIGHTS, resume=args.resume
         )
         res = Trainer.test(cfg, model)
@@ -17,9 +17,11 @@ except:
     pass
 
 import copy
+import inspect
 import itertools
 import logging
 import os
+import time
 
 from collections import OrderedDict
 from typing import Any, Dict, List, Set
@@ -27,13 +29,19 @@ from typing import Any, Dict, List, Set
 import torch
 
 import detectron2.utils.comm as comm
-from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
-from detectron2.data import MetadataCatalog, build_detection_train_loader
+from detectron2.data import (
+    DatasetCatalog,
+    DatasetMapper,
+    MetadataCatalog,
+    build_detection_test_loader,
+    build_detection_train_loader,
+)
 from detectron2.engine import (
     DefaultTrainer,
     default_argument_parser,
     default_setup,
+    hooks,
     launch,
 )
 from detectron2.evaluation import (
@@ -41,40 +49,96 @@ from detectron2.evaluation import (
     CityscapesSemSegEvaluator,
     COCOEvaluator,
     COCOPanopticEvaluator,
+    DatasetEvaluator,
     DatasetEvaluators,
     LVISEvaluator,
     SemSegEvaluator,
+    print_csv_format,
     verify_results, 
     # verify_results(cfg, result) : verifcation function which checks whether model is satisfied with benchmark standard or not
 
 )
 
 from mask_adapter.evaluation import SeenUnseenSemSegEvaluator #import SeenUnseenSemSegEvaluator from mask_adapter.evaluation.sem_seg_evaluation.py
+from mask_adapter.evaluation import EvalStateCheckpointer, MultiVocabEvaluator, inference_on_dataset
 
 from detectron2.projects.deeplab import add_deeplab_config, build_lr_scheduler
 from detectron2.solver.build import maybe_add_gradient_clipping
+from detectron2.utils.events import get_event_storage
 from detectron2.utils.logger import setup_logger
 
 from mask_adapter import (
+    COCOCombineNewBaselineDatasetMapper,
     COCOInstanceNewBaselineDatasetMapper,
     COCOPanopticNewBaselineDatasetMapper,
     InstanceSegEvaluator,
     MaskFormerInstanceDatasetMapper,
     MaskFormerPanopticDatasetMapper,
     MaskFormerSemanticDatasetMapper,
+    MultiVocabTestDatasetMapper,
     SemanticSegmentorWithTTA,
+    TrainableCheckpointer,
+    SizeBalancedInferenceSampler,
     add_maskformer2_config,
     add_fcclip_config,
-    add_mask_adapter_config
+    add_mask_adapter_config,
+    build_custom_train_loader,
+    group_datasets_by_images,
+    merge_vocabulary_dataset_dicts,
 )
 
 
+def _adamw_kernel_kwargs(cfg):
+    # the fused AdamW kernel where this torch version has one, else the foreach kernels.
+    # GradScaler does not unscale the gradients before the step of a fused optimizer, which
+    # unscales them itself, so gradient clipping under AMP would clip the scaled gradients
+    signature = inspect.signature(torch.optim.AdamW).parameters
+    clipped_amp = cfg.SOLVER.CLIP_GRADIENTS.ENABLED and cfg.SOLVER.AMP.ENABLED
+    if "fused" in signature and cfg.MODEL.DEVICE.startswith("cuda") and not clipped_amp:
+        return {"fused": True}
+    if "foreach" in signature:
+        return {"foreach": True}
+    return {}
+
+
+def _weights_identity(weights):
+    # the evaluated weights, with their modification time when they are a local file
+    if os.path.isfile(weights):
+        return "{}@{}".format(weights, os.path.getmtime(weights))
+    return weights
+
+
 class Trainer(DefaultTrainer):
     """
     Extension of the Trainer class adapted to FCCLIP.
     (DefaultTrainer + Fcclip + MaskAdapter)
     """
 
+    def build_hooks(self):
+        # replace the checkpointer before the periodic checkpointer hook is built with it
+        self.checkpointer = TrainableCheckpointer(
+            self.checkpointer.model,
+            self.cfg.OUTPUT_DIR,
+            trainable_only=self.cfg.SOLVER.CHECKPOINT_TRAINABLE_ONLY,
+            base_weights=self.cfg.MODEL.WEIGHTS,
+            **self.checkpointer.checkpointables,
+        )
+        ret = super().build_hooks()
+
+        def test_and_save_results():
+            self._last_eval_results = self.test(
+                self.cfg, self.model, eval_identity="{}@{}".format(self.cfg.MODEL.WEIGHTS, self.iter)
+            )
+            return self._last_eval_results
+
+        # the EvalHook of DefaultTrainer, resuming only the evaluator states of this iteration
+        return [
+            hooks.EvalHook(self.cfg.TEST.EVAL_PERIOD, test_and_save_results)
+            if isinstance(h, hooks.EvalHook)
+            else h
+            for h in ret
+        ]
+
     @classmethod
     def build_evaluator(cls, cfg, dataset_name, output_folder=None):
         """
@@ -96,6 +160,7 @@ class Trainer(DefaultTrainer):
                     dataset_name,
                     distributed=True,
                     output_dir=output_folder,
+                    train_dataset_name=cfg.DATASETS.TRAIN[0],
                 )
             )
         # instance segmentation
@@ -227,7 +292,9 @@ class Trainer(DefaultTrainer):
             torch.nn.LocalResponseNorm,
         )
 
-        params: List[Dict[str, Any]] = []
+        # parameters with the same hyperparameters share one param group, so that the
+        # optimizer updates them together with its multi-tensor (foreach / fused) kernels
+        grouped_params: Dict[tuple, List[torch.nn.parameter.Parameter]] = OrderedDict()
         memo: Set[torch.nn.parameter.Parameter] = set()
         for module_name, module in model.named_modules():
             #example of module_name : "backbone", "backbone.body", "backbone.body.layer1", "backbone.body.layer1.conv1", "mask_head", "mask_head.mask_decoder"
@@ -260,7 +327,11 @@ class Trainer(DefaultTrainer):
                 if isinstance(module, torch.nn.Embedding):
                     hyperparams["weight_decay"] = weight_decay_embed
                     # embedding parameters should not be regularized with weight decay.
-                params.append({"params": [value], **hyperparams})
+                grouped_params.setdefault(tuple(sorted(hyperparams.items())), []).append(value)
+
+        params: List[Dict[str, Any]] = [
+            {"params": values, **dict(hyperparams)} for hyperparams, values in grouped_params.items()
+        ]
 
         def maybe_add_full_model_gradient_clipping(optim):
             # detectron2 doesn't have full model gradient clipping now
@@ -273,20 +344,31 @@ class Trainer(DefaultTrainer):
 
             class FullModelGradientClippingOptimizer(optim):
                 def step(self, closure=None):
-                    all_params = itertools.chain(*[x["params"] for x in self.param_groups])
+                    # one call over all the parameters, which torch reduces with multi-tensor norms
+                    all_params = list(itertools.chain(*[x["params"] for x in self.param_groups]))
                     torch.nn.utils.clip_grad_norm_(all_params, clip_norm_val)
                     super().step(closure=closure)
 
             return FullModelGradientClippingOptimizer if enable else optim
 
+        def add_step_timing(optim):
+            class TimedOptimizer(optim):
+                def step(self, closure=None):
+                    # host time of the step, gradient clipping included
+                    start_time = time.perf_counter()
+                    super().step(closure=closure)
+                    get_event_storage().put_scalar("time/optimizer_step", time.perf_counter() - start_time)
+
+            return TimedOptimizer
+
         optimizer_type = cfg.SOLVER.OPTIMIZER
         if optimizer_type == "SGD":
-            optimizer = maybe_add_full_model_gradient_clipping(torch.optim.SGD)(
+            optimizer = add_step_timing(maybe_add_full_model_gradient_clipping(torch.optim.SGD))(
                 params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM
             )
         elif optimizer_type == "ADAMW":
-            optimizer = maybe_add_full_model_gradient_clipping(torch.optim.AdamW)(
-                params, cfg.SOLVER.BASE_LR
+            optimizer = add_step_timing(maybe_add_full_model_gradient_clipping(torch.optim.AdamW))(
+                params, cfg.SOLVER.BASE_LR, **_adamw_kernel_kwargs(cfg)
             )
         else:
             raise NotImplementedError(f"no optimizer type {optimizer_type}")
@@ -294,6 +376,111 @@ class Trainer(DefaultTrainer):
             optimizer = maybe_add_gradient_clipping(cfg, optimizer)
         return optimizer
 
+    @classmethod
+    def test(cls, cfg, model, evaluators=None, eval_identity=""):
+        """
+        Same as :meth:`DefaultTrainer.test`, with these additions:
+
+        * with TEST.EVAL_STATE_PERIOD > 0 the evaluator state is checkpointed under
+          OUTPUT_DIR/eval_state and a restarted run skips the images that were already evaluated.
+          `eval_identity` names the evaluated weights (e.g. their path and the training
+          iteration), the states saved for other weights are discarded.
+        * with TEST.MULTI_VOCAB_EVAL the semantic segmentation datasets sharing their images
+          (e.g. ADE-150 / A-847, PC-59 / PC-459) are evaluated in one pass: every image is loaded and encoded once
+          and classified with the vocabulary of each dataset.
+        * with TEST.SIZE_BALANCED_SAMPLER the images are sharded over the ranks by
+          estimated cost, see :class:`SizeBalancedInferenceSampler`.
+        """
+        period = cfg.TEST.EVAL_STATE_PERIOD
+        if period <= 0 and not cfg.TEST.MULTI_VOCAB_EVAL and not cfg.TEST.SIZE_BALANCED_SAMPLER:
+            return super().test(cfg, model, evaluators)
+
+        logger = logging.getLogger(__name__)
+        if isinstance(evaluators, DatasetEvaluator):
+            evaluators = [evaluators]
+        if evaluators is not None:
+            assert len(cfg.DATASETS.TEST) == len(evaluators), "{} != {}".format(
+                len(cfg.DATASETS.TEST), len(evaluators)
+            )
+            evaluators = dict(zip(cfg.DATASETS.TEST, evaluators))
+
+        if cfg.TEST.MULTI_VOCAB_EVAL:
+            groups = group_datasets_by_images(cfg.DATASETS.TEST)
+        else:
+            groups = [[dataset_name] for dataset_name in cfg.DATASETS.TEST]
+
+        results = OrderedDict()
+        for group in groups:
+            group_names, group_evaluators = [], []
+            for dataset_name in group:
+                if evaluators is not None:
+                    group_evaluators.append(evaluators[dataset_name])
+                    group_names.append(dataset_name)
+                    continue
+                try:
+                    group_evaluators.append(cls.build_evaluator(cfg, dataset_name))
+                    group_names.append(dataset_name)
+                except NotImplementedError:
+                    logger.warn(
+                        "No evaluator found. Use `DefaultTrainer.test(evaluators=)`, "
+                        "or implement its `build_evaluator` method."
+                    )
+                    results[dataset_name] = {}
+            if len(group_names) == 0:
+                continue
+
+            if len(group_names) == 1:
+                eval_name = group_names[0]
+                dataset_dicts = DatasetCatalog.get(eval_name)
+                mapper = DatasetMapper(cfg, False)
+                evaluator = group_evaluators[0]
+            else:
+                eval_name = "+".join(group_names)
+                dataset_dicts = merge_vocabulary_dataset_dicts(group_names)
+                mapper = MultiVocabTestDatasetMapper(cfg)
+                evaluator = MultiVocabEvaluator(group_names, group_evaluators)
+                logger.info("Evaluating {} in a single pass over their shared images".format(group_names))
+
+            eval_state = None
+            if period > 0:
+                eval_state = EvalStateCheckpointer(
+                    os.path.join(cfg.OUTPUT_DIR, "eval_state"), eval_name, period, identity=eval_identity
+                )
+                # drop the evaluated images before sharding, so every rank skips the same ones
+                processed = eval_state.processed_inputs()
+                dataset_dicts = [
+                    d for d in dataset_dicts
+                    if EvalStateCheckpointer.input_key(d) not in processed
+                ]
+                logger.info(
+                    "Evaluating {}: {} images left, {} resumed".format(
+                        eval_name, len(dataset_dicts), len(processed)
+                    )
+                )
+            data_loader = build_detection_test_loader(
+                dataset_dicts,
+                mapper=mapper,
+                sampler=SizeBalancedInferenceSampler(dataset_dicts) if cfg.TEST.SIZE_BALANCED_SAMPLER else None,
+                num_workers=cfg.DATALOADER.NUM_WORKERS,
+            )
+            results_i = inference_on_dataset(model, data_loader, evaluator, eval_state=eval_state)
+            if len(group_names) == 1:
+                results_i = {eval_name: results_i}
+            for dataset_name in group_names:
+                results[dataset_name] = results_i.get(dataset_name, {})
+                if comm.is_main_process():
+                    assert isinstance(
+                        results[dataset_name], dict
+                    ), "Evaluator must return a dict on the main process. Got {} instead.".format(
+                        results[dataset_name]
+                    )
+                    logger.info("Evaluation results for {} in csv format:".format(dataset_name))
+                    print_csv_format(results[dataset_name])
+
+        if len(results) == 1:
+            results = list(results.values())[0]
+        return results
+
     @classmethod
     def test_with_TTA(cls, cfg, model):
         logger = logging.getLogger("detectron2.trainer")
@@ -371,14 +558,16 @@ def main(args):
             frozen_params_exclude_text += p.numel() #only visual frozen
         print(f"total_params: {total_params}, trainable_params: {trainable_params}, frozen_params: {frozen_params}, frozen_params_exclude_text: {frozen_params_exclude_text}")
 
-        DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
-            cfg.MODEL.WEIGHTS, resume=args.resume
-        )
+        checkpointer = TrainableCheckpointer(model, save_dir=cfg.OUTPUT_DIR)
+        weights = cfg.MODEL.WEIGHTS
+        if args.resume and checkpointer.has_checkpoint():
+            weights = checkpointer.get_checkpoint_file()
+        checkpointer.resume_or_load(cfg.MODEL.WEIGHTS, resume=args.resume)
         #cfg.MODEL.WEIGHTS : Path of model weight
         #if resume == True, resume with optimizer, or just load only weight.
         #sequence = model.state_dict() -> torch.load(path) -> model.load_state_dict(checkpoint["model"])
 
-        res = Trainer.test(cfg, model) 
+        res = Trainer.test(cfg, model, eval_identity=_weights_identity(weights))
         #just test to validation dataset (res = mIoU, mask AP, and etc.)
         # {'bbox/AP' : 42.1, 'segm/AP' : 37.5}
         if cfg.TEST.AUG.ENABLED: